@@ -334,16 +334,17 @@ class Ec2Space(vcycle.BaseSpace):
     self.machinetypes[machinetypeName]._keyPairName = keyName
     return self.machinetypes[machinetypeName]._keyPairName
 
-  def createMachine(self, machineName, machinetypeName, zone = None):
+  def runInstances(self, machineNames, machinetypeName):
 
-    # EC2-specific machine creation steps
+    # Send one RunInstances request for up to len(machineNames) VMs,
+    # all using the user_data of the first machine name
 
     try:
       formRequest = { 'Action'       : 'RunInstances',
                       'Version'      : self.version,
                       'MinCount'     : '1',
-                      'MaxCount'     : '1',
-                      'UserData'     : base64.b64encode(self.getFileContents(machineName, 'user_data')),
+                      'MaxCount'     : str(len(machineNames)),
+                      'UserData'     : base64.b64encode(self.getFileContents(machineNames[0], 'user_data')),
                       'ImageId'      : self.getImageID(machinetypeName),
                       'InstanceType' : self.machinetypes[machinetypeName].flavor_names[0] }
 
@@ -351,15 +352,22 @@ class Ec2Space(vcycle.BaseSpace):
         formRequest['KeyName'] = self.getKeyPairName(machinetypeName)
 
     except Exception as e:
-      raise Ec2Error('Failed to create new machine: ' + str(e))
+      if len(machineNames) == 1:
+        raise Ec2Error('Failed to create new machine: ' + str(e))
+      else:
+        raise Ec2Error('Failed to create %d new machines: %s' % (len(machineNames), str(e)))
 
     try:
-      result = self.ec2Request( formRequest = formRequest, verbose = False )
+      return self.ec2Request( formRequest = formRequest, verbose = False )
     except Exception as e:
       raise Ec2Error('Cannot connect to ' + self.url + ' (' + str(e) + ')')
 
+  def addInstanceMachine(self, machineName, machinetypeName, item, reservationId = None):
+
+    # Record one instance from a RunInstancesResponse instancesSet item
+
     try:
-      instanceId = result['response']['RunInstancesResponse']['instancesSet'][0]['item'][0]['instanceId'][0]['#text']
+      instanceId = item['instanceId'][0]['#text']
     except:
       instanceId = None
     else:
@@ -367,12 +375,15 @@ class Ec2Space(vcycle.BaseSpace):
       self.setFileContents(machineName, 'instance_id', instanceId)
 
     try:
-      privateDnsName = result['response']['RunInstancesResponse']['instancesSet'][0]['item'][0]['privateDnsName'][0]['#text']
+      privateDnsName = item['privateDnsName'][0]['#text']
     except:
       privateDnsName = None
     else:
       self.setFileContents(machineName, 'private_dns_name', privateDnsName)
 
+    if reservationId:
+      self.setFileContents(machineName, 'reservation_id', reservationId)
+
     vcycle.vacutils.logLine('Created ' + machineName + ' ( ' + str(instanceId) + ' / ' + str(privateDnsName) + ' ) for ' + machinetypeName + ' within ' + self.spaceName)
 
     self.machines[machineName] = vcycle.shared.Machine(name        = machineName,
@@ -385,6 +396,40 @@ class Ec2Space(vcycle.BaseSpace):
                                                        uuidStr     = instanceId,
                                                        machinetypeName  = machinetypeName)
 
+  def createMachine(self, machineName, machinetypeName, zone = None):
+
+    # EC2-specific machine creation steps
+
+    result = self.runInstances([machineName], machinetypeName)
+
+    try:
+      item = result['response']['RunInstancesResponse']['instancesSet'][0]['item'][0]
+    except:
+      item = {}
+
+    self.addInstanceMachine(machineName, machinetypeName, item)
+
+  def createMachines(self, machineNames, machinetypeName, zone = None):
+
+    # Create several machines with one RunInstances request. The
+    # tags, including each machine's name, are added by scanMachines()
+
+    result = self.runInstances(machineNames, machinetypeName)
+
+    try:
+      reservationId = result['response']['RunInstancesResponse']['reservationId'][0]['#text']
+    except:
+      reservationId = None
+
+    try:
+      items = result['response']['RunInstancesResponse']['instancesSet'][0]['item']
+    except:
+      raise Ec2Error('Could not get instances from RunInstances response')
+
+    # EC2 may return fewer instances than MaxCount, so unused names are left without VMs
+    for (machineName, item) in zip(machineNames, items):
+      self.addInstanceMachine(machineName, machinetypeName, item, reservationId)
+
   def createTags(self, instanceId, machineName, machinetypeName):
 
     try:
@@ -308,9 +308,12 @@ class GoogleSpace(vcycle.BaseSpace):
           imageFile = vcycle.vacutils.getRemoteRootImage(self.machinetypes[machinetypeName].root_image,
                                          '/var/lib/vcycle/imagecache',
                                          '/var/lib/vcycle/tmp',
-                                         'Vcycle ' + vcycle.shared.vcycleVersion)
+                                         'Vcycle ' + vcycle.shared.vcycleVersion,
+                                         int(self.image_cache_gb * 1024 * 1024 * 1024),
+                                         self.image_download_segments,
+                                         keepDigests = vcycle.vacutils.getUploadingDigests('/var/lib/vcycle/imageuploads'))
 
-          imageLastModified = int(os.stat(imageFile).st_mtime)
+          imageLastModified = vcycle.vacutils.getImageLastModified(imageFile)
           imageURL = self.machinetypes[machinetypeName].root_image
 
       except Exception as e:
@@ -342,14 +345,14 @@ class GoogleSpace(vcycle.BaseSpace):
     imageFamily = base64.b32encode(hashlib.sha256(imageURL).digest()).lower().replace('=','0')
 
     if self.machinetypes[machinetypeName].cernvm_signing_dn:
-      cernvmDict = vac.vacutils.getCernvmImageData(imageFile)
+      cernvmDict = vcycle.vacutils.getCernvmImageData(imageFile, '/var/lib/vcycle/cernvmcache', '/var/lib/vcycle/tmp')
 
       if cernvmDict['verified'] == False:
         raise GoogleError('Failed to verify signature/cert for ' + self.machinetypes[machinetypeName].root_image)
       elif re.search(self.machinetypes[machinetypeName].cernvm_signing_dn,  cernvmDict['dn']) is None:
         raise GoogleError('Signing DN ' + cernvmDict['dn'] + ' does not match cernvm_signing_dn = ' + self.machinetypes[machinetypeName].cernvm_signing_dn)
       else:
-        vac.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
+        vcycle.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
 
     # Try to upload the image
     try:
@@ -53,32 +53,75 @@ class GlanceBase(object):
 
   v1 and v2 api classes derive from this
   """
-  def __init__(self, token, imageURL):
+  # Buffer size for reading image files during uploads
+  uploadBufferSize = 1048576
+
+  def __init__(self, token, imageURL, visibility = 'private'):
     self.token = token
     self.imageURL = imageURL
+    self.visibility = visibility
     self.curl = pycurl.Curl()
 
   @abstractmethod
   def uploadImage(self):
     raise NotImplementedError(__name__)
 
+  def _setUploadOptions(self, f, progress = None):
+    """ Options for streaming a large image file to Glance
+
+    There is no overall time limit, only a limit on stalled transfers.
+    progress(bytesUploaded) is called as the upload proceeds.
+    """
+    self.curl.setopt(pycurl.UPLOAD, True)
+    self.curl.setopt(pycurl.READFUNCTION, f.read)
+    self.curl.setopt(pycurl.INFILESIZE_LARGE, os.fstat(f.fileno()).st_size)
+    self.curl.setopt(pycurl.TIMEOUT, 0)
+    self.curl.setopt(pycurl.CONNECTTIMEOUT, 30)
+    self.curl.setopt(pycurl.LOW_SPEED_LIMIT, 1024)
+    self.curl.setopt(pycurl.LOW_SPEED_TIME, 300)
+
+    if hasattr(pycurl, 'UPLOAD_BUFFERSIZE'):
+      # Fewer, larger calls of f.read() if libcurl supports it
+      self.curl.setopt(pycurl.UPLOAD_BUFFERSIZE, self.uploadBufferSize)
+
+    if progress:
+      self.curl.setopt(pycurl.NOPROGRESS, False)
+      self.curl.setopt(pycurl.PROGRESSFUNCTION,
+                       lambda downloadTotal, downloaded, uploadTotal, uploaded: progress(int(uploaded)))
+    else:
+      self.curl.setopt(pycurl.NOPROGRESS, True)
+
   @abstractmethod
   def getImageDetails(self):
     raise NotImplementedError(__name__)
 
+  def getImageStatus(self, imageID):
+    """ Status of one image, or None if this API cannot tell us """
+    return None
+
 class GlanceV2(GlanceBase):
   """ Class to interact with Glance v2 API """
 
-  def __init__(self, token, imageURL):
-    super(GlanceV2, self).__init__(token, imageURL)
+  # Images requested in each page of the image list
+  pageSize = 200
+
+  def __init__(self, token, imageURL, visibility = 'private'):
+    super(GlanceV2, self).__init__(token, imageURL, visibility)
     vcycle.vacutils.logLine('Using Glance v2 api')
 
   def uploadImage(self, imageFile, imageName, imageLastModified,
-                  verbose = False):
-    """ Upload an image using Glance v2 API """
-    imageID = self._createImage(imageFile, imageName, imageLastModified,
-                                verbose)
-    self._uploadImageData(imageFile, imageID, verbose)
+                  verbose = False, progress = None, imageID = None):
+    """ Upload an image using Glance v2 API
+
+    If imageID is given, the data is uploaded to that existing (queued)
+    image, for example after a failed attempt. The ID of the image being
+    uploaded is kept in self.lastImageID so the caller can do this.
+    """
+    if not imageID:
+      imageID = self._createImage(imageFile, imageName, imageLastModified,
+                                  verbose)
+    self.lastImageID = imageID
+    self._uploadImageData(imageFile, imageID, verbose, progress)
     vcycle.vacutils.logLine('Uploaded image file to Glance')
     return imageID
 
@@ -106,7 +149,7 @@ class GlanceV2(GlanceBase):
         "name": imageName,
         "disk_format": disk_format,
         "container_format": "bare",
-        "visibility": "private",
+        "visibility": self.visibility,
         "tags" : [
           "last_modified: " + str(imageLastModified),
           "architecture: x86_64"
@@ -137,22 +180,20 @@ class GlanceV2(GlanceBase):
 
     return imageID
 
-  def _uploadImageData(self, imageFile, imageID, verbose):
+  def _uploadImageData(self, imageFile, imageID, verbose, progress = None):
     """ Upload image data """
     # Upload data
     imageFileURL = self.imageURL + '/v2/images/' + imageID + '/file'
     self.curl.setopt(pycurl.URL, str(imageFileURL))
 
     try:
-      f = open(str(imageFile), 'r')
+      f = open(str(imageFile), 'rb', self.uploadBufferSize)
     except Exception as e:
       raise OpenstackError('Failed to open file ' + imageFile + '(' + str(e)
                             + ')')
-    self.curl.setopt(pycurl.UPLOAD, True)
-    self.curl.setopt(pycurl.READFUNCTION, f.read)
+    self._setUploadOptions(f, progress)
 
     self.curl.setopt(pycurl.USERAGENT, 'Vcycle ' + vcycle.shared.vcycleVersion)
-    self.curl.setopt(pycurl.TIMEOUT, 30)
     self.curl.setopt(pycurl.FOLLOWLOCATION, False)
     self.curl.setopt(pycurl.SSL_VERIFYPEER, 1)
     self.curl.setopt(pycurl.SSL_VERIFYHOST, 2)
@@ -168,6 +209,8 @@ class GlanceV2(GlanceBase):
       self.curl.perform()
     except Exception as e:
       raise OpenstackError('Failed uploading image (' + str(e) + ')')
+    finally:
+      f.close()
 
     if self.curl.getinfo(pycurl.RESPONSE_CODE) / 100 != 2:
       raise OpenstackError('Image upload returns HTTP error code '
@@ -175,37 +218,76 @@ class GlanceV2(GlanceBase):
 
     return imageID
 
-  def getImageDetails(self):
-    """ Get the existing images details """
-    self.curl.setopt(pycurl.URL, self.imageURL + '/v2/images')
+  def getImageStatus(self, imageID):
+    """ Get the status of one image, or 'missing' if it does not exist """
+    self.curl.setopt(pycurl.URL, str(self.imageURL + '/v2/images/' + imageID))
     self.curl.setopt(pycurl.USERAGENT, 'Vcycle ' + vcycle.shared.vcycleVersion)
     self.curl.setopt(pycurl.TIMEOUT, 30)
     self.curl.setopt(pycurl.FOLLOWLOCATION, False)
     self.curl.setopt(pycurl.SSL_VERIFYPEER, 1)
     self.curl.setopt(pycurl.SSL_VERIFYHOST, 2)
     self.curl.setopt(pycurl.CUSTOMREQUEST, 'GET')
-
+    self.curl.setopt(pycurl.UPLOAD, False)
     self.curl.setopt(pycurl.HTTPHEADER, ['X-Auth-Token: ' + self.token])
 
     outputBuffer = StringIO.StringIO()
     self.curl.setopt(pycurl.WRITEFUNCTION, outputBuffer.write)
 
-    headersBuffer = StringIO.StringIO()
-    self.curl.setopt(pycurl.HEADERFUNCTION, headersBuffer.write)
-
     try:
       self.curl.perform()
     except Exception as e:
-      raise OpenstackError('Failed to get image details (' + str(e) + ')')
+      raise OpenstackError('Failed to get image ' + imageID + ' (' + str(e) + ')')
+
+    if self.curl.getinfo(pycurl.RESPONSE_CODE) == 404:
+      return 'missing'
 
-    # Any 2xx code is OK; otherwise raise an exception
     if self.curl.getinfo(pycurl.RESPONSE_CODE) / 100 != 2:
-      raise OpenstackError('Image details query returns HTTP error code ' + str(self.curl.getinfo(pycurl.RESPONSE_CODE)))
+      raise OpenstackError('Image query returns HTTP error code ' + str(self.curl.getinfo(pycurl.RESPONSE_CODE)))
 
-    response = json.loads(outputBuffer.getvalue())
+    return str(json.loads(outputBuffer.getvalue())['status'])
+
+  def getImageDetails(self):
+    """ Get the existing images details, following Glance v2 pagination """
+    images = []
+    nextURL = self.imageURL + '/v2/images?limit=' + str(self.pageSize)
+
+    while nextURL:
+      self.curl.setopt(pycurl.URL, str(nextURL))
+      self.curl.setopt(pycurl.USERAGENT, 'Vcycle ' + vcycle.shared.vcycleVersion)
+      self.curl.setopt(pycurl.TIMEOUT, 30)
+      self.curl.setopt(pycurl.FOLLOWLOCATION, False)
+      self.curl.setopt(pycurl.SSL_VERIFYPEER, 1)
+      self.curl.setopt(pycurl.SSL_VERIFYHOST, 2)
+      self.curl.setopt(pycurl.CUSTOMREQUEST, 'GET')
+
+      self.curl.setopt(pycurl.HTTPHEADER, ['X-Auth-Token: ' + self.token])
+
+      outputBuffer = StringIO.StringIO()
+      self.curl.setopt(pycurl.WRITEFUNCTION, outputBuffer.write)
+
+      headersBuffer = StringIO.StringIO()
+      self.curl.setopt(pycurl.HEADERFUNCTION, headersBuffer.write)
+
+      try:
+        self.curl.perform()
+      except Exception as e:
+        raise OpenstackError('Failed to get image details (' + str(e) + ')')
+
+      # Any 2xx code is OK; otherwise raise an exception
+      if self.curl.getinfo(pycurl.RESPONSE_CODE) / 100 != 2:
+        raise OpenstackError('Image details query returns HTTP error code ' + str(self.curl.getinfo(pycurl.RESPONSE_CODE)))
+
+      response = json.loads(outputBuffer.getvalue())
+      images.extend(response.get('images', []))
+
+      # 'next' is a path like /v2/images?marker=ID relative to the endpoint
+      if response.get('next'):
+        nextURL = self.imageURL + response['next']
+      else:
+        nextURL = None
 
     return {
-        'response' : response,
+        'response' : { 'images' : images },
         'status' : self.curl.getinfo(pycurl.RESPONSE_CODE)
         }
 
@@ -213,24 +295,26 @@ class GlanceV2(GlanceBase):
 class GlanceV1(GlanceBase):
   """ Class to interact with Glance v1 API """
 
-  def __init__(self, token, imageURL):
-    super(GlanceV1, self).__init__(token, imageURL)
+  def __init__(self, token, imageURL, visibility = 'private'):
+    super(GlanceV1, self).__init__(token, imageURL, visibility)
     vcycle.vacutils.logLine('Using Glance v1 api')
 
   def uploadImage(self, imageFile, imageName, imageLastModified,
-                  verbose = False):
-    """ Upload an image using Glance v1 API """
+                  verbose = False, progress = None, imageID = None):
+    """ Upload an image using Glance v1 API
+
+    imageID is ignored, as v1 creates the image and uploads its data in
+    one request.
+    """
     try:
-      f = open(imageFile, 'r')
+      f = open(imageFile, 'rb', self.uploadBufferSize)
     except Exception as e:
       raise OpenstackError('Failed to open image file ' + imageName + ' (' + str(e) + ')')
 
-    self.curl.setopt(pycurl.READFUNCTION, f.read)
-    self.curl.setopt(pycurl.UPLOAD, True)
+    self._setUploadOptions(f, progress)
     self.curl.setopt(pycurl.CUSTOMREQUEST, 'POST')
     self.curl.setopt(pycurl.URL, self.imageURL + '/v1/images')
     self.curl.setopt(pycurl.USERAGENT, 'Vcycle ' + vcycle.shared.vcycleVersion)
-    self.curl.setopt(pycurl.TIMEOUT, 30)
     self.curl.setopt(pycurl.FOLLOWLOCATION, False)
     self.curl.setopt(pycurl.SSL_VERIFYPEER, 1)
     self.curl.setopt(pycurl.SSL_VERIFYHOST, 2)
@@ -242,7 +326,7 @@ class GlanceV1(GlanceBase):
           'Accept: application/json',
           'Transfer-Encoding: chunked',
           'x-image-meta-container_format: bare',
-          'x-image-meta-is_public: False',
+          'x-image-meta-is_public: ' + str(self.visibility == 'public'),
           'x-image-meta-name: ' + imageName,
           'x-image-meta-property-architecture: x86_64',
           'x-image-meta-property-last-modified: ' + str(imageLastModified),
@@ -264,6 +348,8 @@ class GlanceV1(GlanceBase):
       self.curl.perform()
     except Exception as e:
       raise OpenstackError('Failed uploading image (' + str(e) + ')')
+    finally:
+      f.close()
 
     # Any 2xx code is OK; otherwise raise an exception
     if self.curl.getinfo(pycurl.RESPONSE_CODE) / 100 != 2:
@@ -314,3 +400,39 @@ class GlanceV1(GlanceBase):
         'response' : response,
         'status' : self.curl.getinfo(pycurl.RESPONSE_CODE)
         }
+
+  def getImageStatus(self, imageID):
+    """ Get the status of one image from its headers, or 'missing' if it does not exist """
+    self.curl.setopt(pycurl.URL, str(self.imageURL + '/v1/images/' + imageID))
+    self.curl.setopt(pycurl.USERAGENT, 'Vcycle ' + vcycle.shared.vcycleVersion)
+    self.curl.setopt(pycurl.TIMEOUT, 30)
+    self.curl.setopt(pycurl.FOLLOWLOCATION, False)
+    self.curl.setopt(pycurl.SSL_VERIFYPEER, 1)
+    self.curl.setopt(pycurl.SSL_VERIFYHOST, 2)
+    self.curl.setopt(pycurl.CUSTOMREQUEST, 'HEAD')
+    self.curl.setopt(pycurl.NOBODY, True)
+    self.curl.setopt(pycurl.UPLOAD, False)
+    self.curl.setopt(pycurl.HTTPHEADER, ['X-Auth-Token: ' + self.token])
+
+    headers = {}
+
+    def headerFunction(line):
+      if ':' in line:
+        headers[line.split(':', 1)[0].strip().lower()] = line.split(':', 1)[1].strip()
+
+    self.curl.setopt(pycurl.HEADERFUNCTION, headerFunction)
+
+    try:
+      self.curl.perform()
+    except Exception as e:
+      raise OpenstackError('Failed to get image ' + imageID + ' (' + str(e) + ')')
+    finally:
+      self.curl.setopt(pycurl.NOBODY, False)
+
+    if self.curl.getinfo(pycurl.RESPONSE_CODE) == 404:
+      return 'missing'
+
+    if self.curl.getinfo(pycurl.RESPONSE_CODE) / 100 != 2:
+      raise OpenstackError('Image query returns HTTP error code ' + str(self.curl.getinfo(pycurl.RESPONSE_CODE)))
+
+    return headers.get('x-image-meta-status')
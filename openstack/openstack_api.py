@@ -48,9 +48,12 @@ import string
 import pycurl
 import random
 import base64
+import urllib
+import fcntl
 import StringIO
 import tempfile
 import calendar
+import hashlib
 
 import vcycle.vacutils
 import vcycle.openstack.image_api
@@ -60,6 +63,9 @@ class OpenstackError(Exception):
 
 class OpenstackSpace(vcycle.BaseSpace):
 
+  # Background uploads whose state is not updated for this long have died
+  imageUploadStaleSeconds = 600
+
   def __init__(self, api, apiVersion, spaceName, parser, spaceSectionName, updatePipes):
   # Initialize data structures from configuration files
 
@@ -166,16 +172,62 @@ class OpenstackSpace(vcycle.BaseSpace):
     if self.apiVersion and self.apiVersion != '2' and not self.apiVersion.startswith('2.') and self.apiVersion != '3' and not self.apiVersion.startswith('3.'):
       raise OpenstackError('api_version %s not recognised' % self.apiVersion)
 
+    try:
+      self.image_index_seconds = int(parser.get(spaceSectionName, 'image_index_seconds'))
+    except Exception as e:
+      self.image_index_seconds = 600
+
+    try:
+      self.image_upload_retries = int(parser.get(spaceSectionName, 'image_upload_retries'))
+    except Exception as e:
+      self.image_upload_retries = 3
+
+    try:
+      self.image_upload_retry_seconds = int(parser.get(spaceSectionName, 'image_upload_retry_seconds'))
+    except Exception as e:
+      self.image_upload_retry_seconds = 60
+
+    try:
+      self.image_visibility = parser.get(spaceSectionName, 'image_visibility').strip().lower()
+    except Exception as e:
+      self.image_visibility = 'private'
+
+    if self.image_visibility not in ('private', 'community', 'public'):
+      raise OpenstackError('image_visibility must be private, community or public in [space ' + spaceName + ']')
+
+    try:
+      self.garbage_collection = parser.get(spaceSectionName, 'garbage_collection').strip().lower()
+    except Exception as e:
+      self.garbage_collection = 'dry_run'
+
+    if self.garbage_collection not in ('off', 'dry_run', 'on'):
+      raise OpenstackError('garbage_collection must be off, dry_run or on in [space ' + spaceName + ']')
+
+    try:
+      self.gc_seconds = int(parser.get(spaceSectionName, 'gc_seconds'))
+    except Exception as e:
+      self.gc_seconds = 3600
+
+    # Image index and IDs found for image names, shared by all machinetypes
+    self._imageIndex = None
+    self._imageIndexFromFile = False
+    self._imageOwners = {}
+    self._imageIDs   = {}
+    self._imagesFound = set()
+    self._imageFiles = {}
+    self._imageLastModifieds = {}
+    self._serverImageIDs = set()
+
+    # Background image uploads to be started at the end of the cycle
+    self._pendingImageUploads = []
+
+    # Warm pool volumes found this cycle, which createMachine() can take
+    self._poolVolumes = []
+
   def connect(self):
   # Wrapper around the connect methods and some common post-connection updates
 
-    if not self.apiVersion or self.apiVersion == '2' or self.apiVersion.startswith('2.'):
-      self._connectV2()
-    elif self.apiVersion == '3' or self.apiVersion.startswith('3.'):
-      self._connectV3()
-    else:
-      # This rechecks the checking done in the constructor called by readConf()
-      raise OpenstackError('api_version %s not recognised' % self.apiVersion)
+    self._getToken()
 
     # Save token locally for debugging with openstack command-line client
     vcycle.vacutils.createFile('/var/lib/vcycle/spaces/' + self.spaceName + '/token',
@@ -184,9 +236,9 @@ class OpenstackSpace(vcycle.BaseSpace):
     # initialise glance api (has to be here as we don't have imageURL until
     # after connecting)
     if self.glanceAPIVersion == '2':
-      self.imageAPI = vcycle.openstack.image_api.GlanceV2(self.token, self.imageURL)
+      self.imageAPI = vcycle.openstack.image_api.GlanceV2(self.token, self.imageURL, self.image_visibility)
     elif self.glanceAPIVersion == '1':
-      self.imageAPI = vcycle.openstack.image_api.GlanceV1(self.token, self.imageURL)
+      self.imageAPI = vcycle.openstack.image_api.GlanceV1(self.token, self.imageURL, self.image_visibility)
     else:
       raise OpenstackError('glanceAPIVersion %s not recongnised'
           % self.glanceAPIVersion)
@@ -207,6 +259,17 @@ class OpenstackSpace(vcycle.BaseSpace):
     else:
       vcycle.vacutils.logLine('Processors limit set to %d in Vcycle configuration' % self.processors_limit)
 
+  def _getToken(self):
+  # Get a new token and the service URLs from Keystone
+
+    if not self.apiVersion or self.apiVersion == '2' or self.apiVersion.startswith('2.'):
+      self._connectV2()
+    elif self.apiVersion == '3' or self.apiVersion.startswith('3.'):
+      self._connectV3()
+    else:
+      # This rechecks the checking done in the constructor called by readConf()
+      raise OpenstackError('api_version %s not recognised' % self.apiVersion)
+
   def _connectV2(self):
   # Connect to the OpenStack service with Identity v2
 
@@ -222,6 +285,11 @@ class OpenstackSpace(vcycle.BaseSpace):
 
     self.token = str(result['response']['access']['token']['id'])
 
+    try:
+      self.projectID = str(result['response']['access']['token']['tenant']['id'])
+    except:
+      self.projectID = None
+
     self.computeURL = None
     self.imageURL   = None
     self.volumeURL  = None
@@ -282,6 +350,11 @@ class OpenstackSpace(vcycle.BaseSpace):
     except Exception as e:
       raise OpenstackError('Cannot read X-Subject-Token: from ' + self.identityURL + ' response with v' + self.apiVersion + ' API (' + str(e) + ')')
 
+    try:
+      self.projectID = str(result['response']['token']['project']['id'])
+    except:
+      self.projectID = None
+
     self.computeURL = None
     self.imageURL   = None
     self.volumeURL  = None
@@ -368,89 +441,142 @@ class OpenstackSpace(vcycle.BaseSpace):
     # Convert machines from None to an empty dictionary since we successfully connected
     self.machines = {}
 
+    # Images used by any server in the project, which must not be deleted
+    self._serverImageIDs = set()
+
     for oneServer in result['response']['servers']:
 
       try:
-        machineName = str(oneServer['metadata']['name'])
+        self._serverImageIDs.add(str(oneServer['image']['id']))
       except:
-        machineName = oneServer['name']
+        # Servers booted from volumes have no image here
+        pass
+
+      self._addServerMachine(oneServer)
+
+    # Machines whose boot volumes are still being made have no servers yet
+    try:
+      dirsList = os.listdir('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/current')
+    except:
+      dirsList = []
+
+    for machineName in dirsList:
+      if machineName in self.machines or \
+         os.path.exists(self.machineDir(machineName) + '/deleted'):
+        continue
 
       try:
-        flavorID = oneServer['flavor']['id']
+        provisioning = self.getFileContents(machineName, 'provisioning').strip()
       except:
-        flavorID   = None
-        processors = 1
-      else:
-        try:
-          processors = self.flavors[self.getFlavorName(flavorID)]['processors']
-        except:
-          processors = 1
-
-      # Just in case other VMs are in this space
-      if machineName[:7] != 'vcycle-':
-        # Still count VMs that we didn't create and won't manage, to avoid going above space limit
-        self.totalProcessors += processors
         continue
 
-      uuidStr = str(oneServer['id'])
+      if provisioning == 'volume_requested':
+        self.machines[machineName] = vcycle.shared.Machine(name             = machineName,
+                                                           spaceName        = self.spaceName,
+                                                           state            = vcycle.MachineState.starting,
+                                                           ip               = '0.0.0.0',
+                                                           createdTime      = None,
+                                                           startedTime      = None,
+                                                           updatedTime      = None,
+                                                           uuidStr          = None,
+                                                           machinetypeName  = None)
 
-      # Try to get the IP address. Always use the zeroth member of the earliest network
-      try:
-        ip = str(oneServer['addresses'][ min(oneServer['addresses']) ][0]['addr'])
-      except:
-        ip = '0.0.0.0'
+  def _addServerMachine(self, oneServer):
+    """Create a Machine object in self.machines for one server from the compute service"""
 
-      createdTime  = calendar.timegm(time.strptime(str(oneServer['created']), "%Y-%m-%dT%H:%M:%SZ"))
-      updatedTime  = calendar.timegm(time.strptime(str(oneServer['updated']), "%Y-%m-%dT%H:%M:%SZ"))
+    try:
+      machineName = str(oneServer['metadata']['name'])
+    except:
+      machineName = oneServer['name']
 
+    try:
+      flavorID = oneServer['flavor']['id']
+    except:
+      flavorID   = None
+      processors = 1
+    else:
       try:
-        startedTime = calendar.timegm(time.strptime(str(oneServer['OS-SRV-USG:launched_at']).split('.')[0], "%Y-%m-%dT%H:%M:%S"))
+        processors = self.flavors[self.getFlavorName(flavorID)]['processors']
       except:
-        startedTime = None
+        processors = 1
 
-      taskState  = str(oneServer['OS-EXT-STS:task_state'])
-      powerState = int(oneServer['OS-EXT-STS:power_state'])
-      status     = str(oneServer['status'])
+    # Just in case other VMs are in this space
+    if machineName[:7] != 'vcycle-':
+      # Still count VMs that we didn't create and won't manage, to avoid going above space limit
+      self.totalProcessors += processors
+      return
 
-      try:
-        machinetypeName = str(oneServer['metadata']['machinetype'])
-      except:
+    uuidStr = str(oneServer['id'])
+
+    # Try to get the IP address. Always use the zeroth member of the earliest network
+    try:
+      ip = str(oneServer['addresses'][ min(oneServer['addresses']) ][0]['addr'])
+    except:
+      ip = '0.0.0.0'
+
+    createdTime  = calendar.timegm(time.strptime(str(oneServer['created']), "%Y-%m-%dT%H:%M:%SZ"))
+    updatedTime  = calendar.timegm(time.strptime(str(oneServer['updated']), "%Y-%m-%dT%H:%M:%SZ"))
+
+    try:
+      startedTime = calendar.timegm(time.strptime(str(oneServer['OS-SRV-USG:launched_at']).split('.')[0], "%Y-%m-%dT%H:%M:%S"))
+    except:
+      startedTime = None
+
+    taskState  = str(oneServer['OS-EXT-STS:task_state'])
+    powerState = int(oneServer['OS-EXT-STS:power_state'])
+    status     = str(oneServer['status'])
+
+    try:
+      machinetypeName = str(oneServer['metadata']['machinetype'])
+    except:
+      machinetypeName = None
+    else:
+      if machinetypeName not in self.machinetypes:
         machinetypeName = None
-      else:
-        if machinetypeName not in self.machinetypes:
-          machinetypeName = None
 
-      try:
-        zone = str(oneServer['OS-EXT-AZ:availability_zone'])
-      except:
-        zone = None
+    try:
+      zone = str(oneServer['OS-EXT-AZ:availability_zone'])
+    except:
+      zone = None
+
+    if taskState == 'Deleting':
+      state = vcycle.MachineState.deleting
+    elif status == 'ACTIVE' and powerState == 1:
+      state = vcycle.MachineState.running
+    elif status == 'BUILD' or status == 'ACTIVE':
+      state = vcycle.MachineState.starting
+    elif status == 'SHUTOFF':
+      state = vcycle.MachineState.shutdown
+    elif status == 'ERROR':
+      state = vcycle.MachineState.failed
+    elif status == 'DELETED':
+      state = vcycle.MachineState.deleting
+    else:
+      state = vcycle.MachineState.unknown
 
-      if taskState == 'Deleting':
-        state = vcycle.MachineState.deleting
-      elif status == 'ACTIVE' and powerState == 1:
-        state = vcycle.MachineState.running
-      elif status == 'BUILD' or status == 'ACTIVE':
-        state = vcycle.MachineState.starting
-      elif status == 'SHUTOFF':
-        state = vcycle.MachineState.shutdown
-      elif status == 'ERROR':
-        state = vcycle.MachineState.failed
-      elif status == 'DELETED':
-        state = vcycle.MachineState.deleting
-      else:
-        state = vcycle.MachineState.unknown
+    self.machines[machineName] = vcycle.shared.Machine(name             = machineName,
+                                                       spaceName        = self.spaceName,
+                                                       state            = state,
+                                                       ip               = ip,
+                                                       createdTime      = createdTime,
+                                                       startedTime      = startedTime,
+                                                       updatedTime      = updatedTime,
+                                                       uuidStr          = uuidStr,
+                                                       machinetypeName  = machinetypeName,
+                                                       zone             = zone,
+                                                       processors       = processors)
 
-      self.machines[machineName] = vcycle.shared.Machine(name             = machineName,
-                                                         spaceName        = self.spaceName,
-                                                         state            = state,
-                                                         ip               = ip,
-                                                         createdTime      = createdTime,
-                                                         startedTime      = startedTime,
-                                                         updatedTime      = updatedTime,
-                                                         uuidStr          = uuidStr,
-                                                         machinetypeName  = machinetypeName,
-                                                         zone             = zone,
-                                                         processors       = processors)
+  def scanOneMachine(self, machineName):
+    """Query the compute service for just one machine, without listing the whole space"""
+
+    try:
+      result = self.httpRequest(self.computeURL + '/servers/detail?name=' + urllib.quote('^' + machineName + '$'),
+                                headers = [ 'X-Auth-Token: ' + self.token ])
+    except Exception as e:
+      raise OpenstackError('Cannot connect to ' + self.computeURL + ' (' + str(e) + ')')
+
+    for oneServer in result['response']['servers']:
+      self._addServerMachine(oneServer)
 
   def getFlavorName(self, flavorID):
     """Get the "flavor" ID"""
@@ -461,6 +587,151 @@ class OpenstackSpace(vcycle.BaseSpace):
 
     raise OpenstackError('Flavor "' + flavorID + '" not available!')
 
+  def _getImageIndex(self, refresh = False):
+    """ Get the index of images in this space, shared by all its machinetypes """
+
+    if self._imageIndex is not None and not refresh:
+      return
+
+    indexFile = '/var/lib/vcycle/imageindex/' + self.spaceName + '.json'
+
+    # Try the copy saved by a recent cycle first
+    if not refresh:
+      try:
+        if os.stat(indexFile).st_mtime > time.time() - self.image_index_seconds:
+          self._imageIndex = json.load(open(indexFile, 'r'))
+          self._imageIndexFromFile = True
+          return
+      except:
+        pass
+
+    result = self.imageAPI.getImageDetails()
+
+    # Index is { name : [ [ id, active, [ last_modified, ... ] ], ... ] }
+    # Glance v2 api differs by keeping metadata in tags
+    self._imageIndex = {}
+    self._imageIndexFromFile = False
+
+    # Owner and visibility of images, where Glance gives them, for the
+    # garbage collector. These are not saved with the index
+    self._imageOwners = {}
+
+    for image in result['response']['images']:
+      try:
+        if self.glanceAPIVersion == '1':
+          active = (image['status'] == 'ACTIVE')
+          try:
+            lastModifieds = [ str(image['metadata']['last_modified']) ]
+          except:
+            lastModifieds = []
+        else:
+          active = (image['status'] == 'active')
+          lastModifieds = [ str(tag.lstrip('last_modified: ')) for tag in image.get('tags', []) ]
+
+        self._imageIndex.setdefault(image['name'], []).append([ str(image['id']), active, lastModifieds ])
+
+        if 'visibility' in image:
+          visibility = str(image['visibility'])
+        elif 'is_public' in image:
+          visibility = 'public' if image['is_public'] else 'private'
+        else:
+          visibility = None
+
+        self._imageOwners[str(image['id'])] = (image.get('owner'), visibility)
+      except:
+        pass
+
+    self._saveImageIndex()
+
+  def _saveImageIndex(self):
+
+    try:
+      os.makedirs('/var/lib/vcycle/imageindex', stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+    except:
+      pass
+
+    vcycle.vacutils.createFile('/var/lib/vcycle/imageindex/' + self.spaceName + '.json',
+                               json.dumps(self._imageIndex),
+                               stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH,
+                               '/var/lib/vcycle/tmp')
+
+  def _removeFromImageIndex(self, imageIDs):
+    """ Remove images which no longer exist from the index and its saved copy """
+
+    if self._imageIndex is None:
+      self._getImageIndex()
+
+    removed = False
+
+    for imageName in self._imageIndex.keys():
+      entries = [ entry for entry in self._imageIndex[imageName] if entry[0] not in imageIDs ]
+
+      if len(entries) != len(self._imageIndex[imageName]):
+        removed = True
+
+        if entries:
+          self._imageIndex[imageName] = entries
+        else:
+          del self._imageIndex[imageName]
+
+    if removed:
+      self._saveImageIndex()
+
+  def _forgetMissingImage(self, machinetypeName):
+    """ After a failed request, forget the machinetype's image if Glance no longer has it
+
+    The saved index can be up to image_index_seconds old, so an image deleted
+    outside Vcycle would otherwise be used until it expires.
+    """
+
+    imageID = getattr(self.machinetypes[machinetypeName], '_imageID', None)
+
+    # Each image is only checked until it is found once in this cycle
+    if not imageID or imageID in self._imagesFound:
+      return
+
+    try:
+      imageStatus = self.imageAPI.getImageStatus(imageID)
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed to check status of image ' + imageID + ' (' + str(e) + ')')
+      return
+
+    if imageStatus != 'missing':
+      self._imagesFound.add(imageID)
+      return
+
+    vcycle.vacutils.logLine('Image ' + imageID + ' for machinetype ' + machinetypeName + ' no longer exists, so removing it from the image index')
+
+    self._removeFromImageIndex([ imageID ])
+    self._removeStagedImages([ imageID ])
+
+    # Machinetypes sharing the image look it up again when next needed
+    for imageName in [ imageName for imageName in self._imageIDs if self._imageIDs[imageName] == imageID ]:
+      del self._imageIDs[imageName]
+
+    for machinetype in self.machinetypes.values():
+      if getattr(machinetype, '_imageID', None) == imageID:
+        del machinetype._imageID
+
+  def _findImage(self, imageName, imageLastModified = None):
+    """ Look up an image ID by name and optionally last_modified in the image index """
+
+    for refresh in (False, True):
+      self._getImageIndex(refresh)
+
+      for (imageID, active, lastModifieds) in self._imageIndex.get(imageName, []):
+        if imageLastModified is None:
+          # Specific image, not managed by Vcycle
+          return str(imageID)
+        elif active and str(imageLastModified) in lastModifieds:
+          return str(imageID)
+
+      # Only ask Glance again if the index was a saved copy that may be out of date
+      if not self._imageIndexFromFile:
+        break
+
+    return None
+
   def getImageID(self, machinetypeName):
     """ Get the image ID """
 
@@ -472,15 +743,13 @@ class OpenstackSpace(vcycle.BaseSpace):
         # If _imageID is None, then it's not available for this cycle
         raise OpenstackError('Image "' + self.machinetypes[machinetypeName].root_image + '" for machinetype ' + machinetypeName + ' not available!')
 
-    # Get the existing images for this tenancy
-    result = self.imageAPI.getImageDetails()
-
     # Specific image, not managed by Vcycle, lookup ID
     if self.machinetypes[machinetypeName].root_image[:6] == 'image:':
-      for image in result['response']['images']:
-         if self.machinetypes[machinetypeName].root_image[6:] == image['name']:
-           self.machinetypes[machinetypeName]._imageID = str(image['id'])
-           return self.machinetypes[machinetypeName]._imageID
+      imageID = self._findImage(self.machinetypes[machinetypeName].root_image[6:])
+
+      if imageID:
+        self.machinetypes[machinetypeName]._imageID = imageID
+        return self.machinetypes[machinetypeName]._imageID
 
       raise OpenstackError('Image "' + self.machinetypes[machinetypeName].root_image[6:] + '" for machinetype ' + machinetypeName + ' not available!')
 
@@ -492,6 +761,12 @@ class OpenstackSpace(vcycle.BaseSpace):
     else:
       imageName = '/var/lib/vcycle/spaces/' + self.spaceName + '/machinetypes/' + machinetypeName + '/files/' + self.machinetypes[machinetypeName].root_image
 
+    # Machinetypes with the same image name share one lookup
+    if imageName in self._imageIDs:
+      self.machinetypes[machinetypeName]._imageFile = self._imageFiles[imageName]
+      self.machinetypes[machinetypeName]._imageID   = self._imageIDs[imageName]
+      return self.machinetypes[machinetypeName]._imageID
+
     # Find the local copy of the image file
     if not hasattr(self.machinetypes[machinetypeName], '_imageFile'):
 
@@ -499,12 +774,17 @@ class OpenstackSpace(vcycle.BaseSpace):
          self.machinetypes[machinetypeName].root_image[:8] == 'https://':
 
         try:
-          imageFile = vcycle.vacutils.getRemoteRootImage(self.machinetypes[machinetypeName].root_image,
+          # The content file keeps the bytes of this version for the upload,
+          # even if the URL's cache entry is replaced or pruned in the meantime
+          (imageFile, imageLastModified) = \
+            vcycle.vacutils.getRemoteRootImageContent(self.machinetypes[machinetypeName].root_image,
                                          '/var/lib/vcycle/imagecache',
                                          '/var/lib/vcycle/tmp',
-                                         'Vcycle ' + vcycle.shared.vcycleVersion)
-
-          imageLastModified = int(os.stat(imageFile).st_mtime)
+                                         'Vcycle ' + vcycle.shared.vcycleVersion,
+                                         int(self.image_cache_gb * 1024 * 1024 * 1024),
+                                         self.image_download_segments,
+                                         keepDigests = vcycle.vacutils.getUploadingDigests('/var/lib/vcycle/imageuploads',
+                                                                                           self.imageUploadStaleSeconds))
         except Exception as e:
           raise OpenstackError('Failed fetching ' + self.machinetypes[machinetypeName].root_image + ' (' + str(e) + ')')
 
@@ -529,51 +809,398 @@ class OpenstackSpace(vcycle.BaseSpace):
 
         self.machinetypes[machinetypeName]._imageFile = imageName
 
+    elif imageName in self._imageLastModifieds:
+      # The version found with the image file, which may be a content file
+      imageLastModified = self._imageLastModifieds[imageName]
+
     else:
-      imageLastModified = int(os.stat(self.machinetypes[machinetypeName]._imageFile).st_mtime)
+      imageLastModified = vcycle.vacutils.getImageLastModified(self.machinetypes[machinetypeName]._imageFile)
 
-    # Go through the existing images looking for a name and time stamp match
-    # We should delete old copies of the current image name if we find them here
-    # Glance v2 api differs by keeping metadata in tags
-    if self.glanceAPIVersion == '1':
-      for image in result['response']['images']:
-        try:
-          if image['name'] == imageName and \
-              image['status'] == 'ACTIVE' and \
-              image['metadata']['last_modified'] == str(imageLastModified):
-            self.machinetypes[machinetypeName]._imageID = str(image['id'])
-            return self.machinetypes[machinetypeName]._imageID
-        except:
-          pass
-    elif self.glanceAPIVersion == '2':
-      for image in result['response']['images']:
-        try:
-          if image['name'] == imageName and image['status'] == 'active':
-            for tag in image['tags']:
-              if tag.lstrip('last_modified: ') == str(imageLastModified):
-                self.machinetypes[machinetypeName]._imageID = str(image['id'])
-                return self.machinetypes[machinetypeName]._imageID
-        except:
-          pass
+    self._imageFiles[imageName]         = self.machinetypes[machinetypeName]._imageFile
+    self._imageLastModifieds[imageName] = imageLastModified
+
+    # Look for a name and time stamp match in the image index
+    imageID = self._findImage(imageName, imageLastModified)
+
+    if imageID:
+      self._imageIDs[imageName] = imageID
+      self.machinetypes[machinetypeName]._imageID = imageID
+      return self.machinetypes[machinetypeName]._imageID
+
+    # Check if another space with the same scope has already uploaded it
+    imageID = self._getStagedImage(imageName, imageLastModified)
+
+    if imageID:
+      try:
+        imageStatus = self.imageAPI.getImageStatus(imageID)
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed to check status of staged image ' + imageID + ' (' + str(e) + ')')
+        imageStatus = None
+
+      if imageStatus == 'active':
+        vcycle.vacutils.logLine('Using image ' + imageID + ' for ' + imageName + ' uploaded by another space')
+        return self._addUploadedImage(machinetypeName, imageName, imageLastModified, imageID)
+
+      if imageStatus == 'missing':
+        vcycle.vacutils.logLine('Staged image ' + imageID + ' for ' + imageName + ' no longer exists')
+        self._removeFromImageIndex([ imageID ])
+        self._removeStagedImages([ imageID ])
+
+    # Check for an upload of this image in the background
+    uploadState = self._getImageUploadState(imageName)
+
+    if uploadState and uploadState['last_modified'] == str(imageLastModified):
+      if uploadState['status'] == 'active' and uploadState['image_id']:
+        vcycle.vacutils.logLine('Background upload of ' + imageName + ' has finished as image ' + uploadState['image_id'])
+        self._removeImageUploadState(imageName)
+        return self._addUploadedImage(machinetypeName, imageName, imageLastModified, uploadState['image_id'])
+
+      if uploadState['status'] == 'uploading' and self._imageUploadRunning(uploadState):
+        vcycle.vacutils.logLine('Background upload of %s has sent %d of %d bytes (attempt %d)'
+                                % (imageName, uploadState['bytes_uploaded'], uploadState['bytes_total'], uploadState['attempts']))
+        self.machinetypes[machinetypeName].imagePending = True
+        raise OpenstackError('Image "' + imageName + '" for machinetype ' + machinetypeName + ' is still being uploaded')
+
+      if uploadState['status'] == 'failed':
+        vcycle.vacutils.logLine('Background upload of ' + imageName + ' failed (' + str(uploadState['error']) + '), so trying again')
 
     vcycle.vacutils.logLine('Image "' + self.machinetypes[machinetypeName].root_image + '" not found in image service, so uploading')
 
     if self.machinetypes[machinetypeName].cernvm_signing_dn:
-      cernvmDict = vac.vacutils.getCernvmImageData(self.machinetypes[machinetypeName]._imageFile)
+      cernvmDict = vcycle.vacutils.getCernvmImageData(self.machinetypes[machinetypeName]._imageFile, '/var/lib/vcycle/cernvmcache', '/var/lib/vcycle/tmp')
 
       if cernvmDict['verified'] == False:
         raise OpenstackError('Failed to verify signature/cert for ' + self.machinetypes[machinetypeName].root_image)
       elif re.search(self.machinetypes[machinetypeName].cernvm_signing_dn,  cernvmDict['dn']) is None:
         raise OpenstackError('Signing DN ' + cernvmDict['dn'] + ' does not match cernvm_signing_dn = ' + self.machinetypes[machinetypeName].cernvm_signing_dn)
       else:
-        vac.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
+        vcycle.vacutils.logLine('Verified image signed by ' + cernvmDict['dn'])
 
-    # Try to upload the image
+    # Start uploading the image in the background, unless already doing that
     try:
-      self.machinetypes[machinetypeName]._imageID = self.uploadImage(self.machinetypes[machinetypeName]._imageFile, imageName, imageLastModified)
-      return self.machinetypes[machinetypeName]._imageID
+      self._startImageUpload(self.machinetypes[machinetypeName]._imageFile, imageName, imageLastModified)
     except Exception as e:
-      raise OpenstackError('Failed to upload image file ' + imageName + ' (' + str(e) + ')')
+      raise OpenstackError('Failed to start upload of image file ' + imageName + ' (' + str(e) + ')')
+
+    self.machinetypes[machinetypeName].imagePending = True
+    raise OpenstackError('Image "' + imageName + '" for machinetype ' + machinetypeName + ' is still being uploaded')
+
+  def _addUploadedImage(self, machinetypeName, imageName, imageLastModified, imageID):
+    """ Record an image which has been uploaded by Vcycle """
+
+    # Add the new image to the index for later machinetypes and cycles
+    self._imageIndex.setdefault(imageName, []).append([ str(imageID), True, [ str(imageLastModified) ] ])
+    self._saveImageIndex()
+
+    # And to the manifest for other spaces
+    try:
+      self._addStagedImage(imageName, imageLastModified, imageID)
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed to add ' + imageName + ' to image staging manifest (' + str(e) + ')')
+
+    self._imageIDs[imageName] = str(imageID)
+    self.machinetypes[machinetypeName]._imageID = str(imageID)
+    return self.machinetypes[machinetypeName]._imageID
+
+  def _imageScope(self):
+    """ Identifies the spaces which can use the same uploaded images
+
+    Spaces using the same Glance endpoint share images if they are in the
+    same project, or if the images are visible to all projects. Glance v1
+    has no community visibility, so those images are private there.
+    """
+    if self.image_visibility == 'public' or \
+       (self.image_visibility == 'community' and self.glanceAPIVersion == '2'):
+      scope = self.imageURL + ' ' + self.image_visibility
+    else:
+      scope = self.imageURL + ' ' + self.project_name + '@' + self.domain_name
+
+    return hashlib.sha1(scope).hexdigest()
+
+  def _getStagedImage(self, imageName, imageLastModified):
+    """ Look up an image uploaded by any space with the same scope """
+
+    try:
+      manifest = json.load(open('/var/lib/vcycle/imagestaging/' + self._imageScope() + '.json', 'r'))
+    except:
+      return None
+
+    for (imageID, lastModified) in manifest.get(imageName, []):
+      if lastModified == str(imageLastModified):
+        return str(imageID)
+
+    return None
+
+  def _addStagedImage(self, imageName, imageLastModified, imageID):
+    """ Record an uploaded image in the manifest shared with other spaces """
+
+    manifestFile = '/var/lib/vcycle/imagestaging/' + self._imageScope() + '.json'
+
+    try:
+      os.makedirs('/var/lib/vcycle/imagestaging',
+                  stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+    except:
+      pass
+
+    # Lock so concurrent updates from other processes are not lost
+    lockFile = open(manifestFile + '.lock', 'w')
+    fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+
+    try:
+      try:
+        manifest = json.load(open(manifestFile, 'r'))
+      except:
+        manifest = {}
+
+      # Older versions stay listed until the garbage collector deletes them
+      entries = [ entry for entry in manifest.get(imageName, []) if entry[0] != str(imageID) ]
+      entries.append([ str(imageID), str(imageLastModified) ])
+      manifest[imageName] = entries
+
+      vcycle.vacutils.createFile(manifestFile, json.dumps(manifest),
+                                 stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH,
+                                 '/var/lib/vcycle/tmp')
+    finally:
+      lockFile.close()
+
+  def _removeStagedImages(self, imageIDs):
+    """ Remove deleted images from the manifest shared with other spaces """
+
+    manifestFile = '/var/lib/vcycle/imagestaging/' + self._imageScope() + '.json'
+
+    if not os.path.exists(manifestFile):
+      return
+
+    lockFile = open(manifestFile + '.lock', 'w')
+    fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+
+    try:
+      try:
+        manifest = json.load(open(manifestFile, 'r'))
+      except:
+        return
+
+      newManifest = {}
+
+      for imageName, entries in manifest.iteritems():
+        entries = [ entry for entry in entries if str(entry[0]) not in imageIDs ]
+
+        if entries:
+          newManifest[imageName] = entries
+
+      if newManifest != manifest:
+        vcycle.vacutils.createFile(manifestFile, json.dumps(newManifest),
+                                   stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH,
+                                   '/var/lib/vcycle/tmp')
+    finally:
+      lockFile.close()
+
+  def _imageUploadStateFile(self, imageName):
+    # Uploads are shared by all spaces with the same scope
+    return '/var/lib/vcycle/imageuploads/' + self._imageScope() + '/' + urllib.quote(imageName, '') + '.json'
+
+  def _getImageUploadState(self, imageName):
+    try:
+      return json.load(open(self._imageUploadStateFile(imageName), 'r'))
+    except:
+      return None
+
+  def _setImageUploadState(self, imageName, uploadState):
+    uploadState['updated'] = int(time.time())
+    vcycle.vacutils.createFile(self._imageUploadStateFile(imageName),
+                               json.dumps(uploadState),
+                               stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH,
+                               '/var/lib/vcycle/tmp')
+
+  def _removeImageUploadState(self, imageName):
+    try:
+      os.remove(self._imageUploadStateFile(imageName))
+    except:
+      pass
+
+  def _imageUploadRunning(self, uploadState):
+    """ Check the process doing an upload still exists and is updating its state """
+
+    # The state is saved before each attempt and before waiting to retry, and
+    # every 10 seconds while curl is sending, which gives up after 300
+    # seconds without data being sent. Retry waits are kept shorter than this
+    if uploadState['updated'] < time.time() - self.imageUploadStaleSeconds:
+      return False
+
+    if not uploadState['pid']:
+      # Not yet started by the new process
+      return True
+
+    try:
+      os.kill(uploadState['pid'], 0)
+    except:
+      return False
+
+    return True
+
+  def _startImageUpload(self, imageFile, imageName, imageLastModified):
+    """ Record an upload to be started in the background at the end of the cycle """
+
+    try:
+      os.makedirs('/var/lib/vcycle/imageuploads/' + self._imageScope(),
+                  stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+    except:
+      pass
+
+    # A Glance image created by an earlier upload process which died or gave up
+    oldState = self._getImageUploadState(imageName)
+    imageID  = None
+
+    if oldState and oldState.get('image_id'):
+      try:
+        imageStatus = self.imageAPI.getImageStatus(oldState['image_id'])
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed to check status of image ' + oldState['image_id'] + ' (' + str(e) + ')')
+        imageStatus = None
+
+      if imageStatus == 'queued' and oldState['last_modified'] == str(imageLastModified):
+        # Still waiting for its data, so the new upload can send it
+        vcycle.vacutils.logLine('Reusing queued image ' + oldState['image_id'] + ' for ' + imageName)
+        imageID = oldState['image_id']
+      elif imageStatus in ('queued', 'saving', 'killed'):
+        try:
+          self._deleteImage(oldState['image_id'])
+          vcycle.vacutils.logLine('Deleted image ' + oldState['image_id'] + ' left by failed upload of ' + imageName)
+        except Exception as e:
+          vcycle.vacutils.logLine('Failed to delete image ' + oldState['image_id'] + ' left by failed upload of ' + imageName + ' (' + str(e) + ')')
+
+    # Images from the cache are uploaded from their content file, whose
+    # digest stops it being pruned while the upload is queued or running
+    if os.path.dirname(imageFile) == '/var/lib/vcycle/imagecache/sha256':
+      imageDigest = os.path.basename(imageFile)
+    else:
+      imageDigest = None
+
+    uploadState = { 'pid'            : None,
+                    'status'         : 'uploading',
+                    'digest'         : imageDigest,
+                    'last_modified'  : str(imageLastModified),
+                    'image_id'       : imageID,
+                    'bytes_uploaded' : 0,
+                    'bytes_total'    : os.stat(imageFile).st_size,
+                    'attempts'       : 0,
+                    'error'          : None }
+
+    self._setImageUploadState(imageName, uploadState)
+    self._pendingImageUploads.append((imageFile, imageName, uploadState))
+    vcycle.vacutils.logLine('Image "' + imageName + '" not in image service, so starting background upload')
+
+  def startBackgroundTasks(self):
+    """ Fork a detached process for each upload recorded this cycle
+
+    Each process can outlive this cycle. vcycled calls this after its own
+    threads have finished, so no locks or curl handles are in use by other
+    threads when we fork.
+    """
+
+    for (imageFile, imageName, uploadState) in self._pendingImageUploads:
+
+      # Flush so buffered output is not written twice
+      vcycle.vacutils.flushLog()
+      sys.stderr.flush()
+
+      pid = os.fork()
+
+      if pid == 0:
+        # Double fork so the upload process is not a child of this cycle
+        try:
+          os.setsid()
+
+          if os.fork() == 0:
+            uploadState['pid'] = os.getpid()
+
+            # Do not share curl handles or VacMon's queue with the cycle process
+            self.curl = pycurl.Curl()
+            self._threadCurl.curl = self.curl
+            vcycle.shared.vacmonSender = vcycle.shared.VacMonSender()
+
+            self._runImageUpload(imageFile, imageName, uploadState)
+        except Exception as e:
+          vcycle.vacutils.logLine('Background upload of ' + imageName + ' fails: ' + str(e))
+
+        vcycle.vacutils.flushLog()
+        os._exit(0)
+
+      os.waitpid(pid, 0)
+
+    self._pendingImageUploads = []
+
+  def _runImageUpload(self, imageFile, imageName, uploadState):
+    """ Body of the background upload process, with retries """
+
+    lastSaved = [ time.time() ]
+
+    def progress(bytesUploaded):
+      # Save progress at most every 10 seconds
+      if time.time() > lastSaved[0] + 10:
+        uploadState['bytes_uploaded'] = bytesUploaded
+        self._setImageUploadState(imageName, uploadState)
+        lastSaved[0] = time.time()
+
+    while True:
+      uploadState['attempts'] += 1
+      self._setImageUploadState(imageName, uploadState)
+      imageAPI = None
+
+      try:
+        # Retries can be hours after the cycle's token was issued
+        self._getToken()
+
+        # A new Glance object with the new token and its own curl handle
+        if self.glanceAPIVersion == '1':
+          imageAPI = vcycle.openstack.image_api.GlanceV1(self.token, self.imageURL, self.image_visibility)
+        else:
+          imageAPI = vcycle.openstack.image_api.GlanceV2(self.token, self.imageURL, self.image_visibility)
+
+        imageID = imageAPI.uploadImage(imageFile, imageName, int(uploadState['last_modified']),
+                                       progress = progress, imageID = uploadState['image_id'])
+      except Exception as e:
+        # Upload the data to the same Glance image next time, if it was created
+        uploadState['image_id'] = getattr(imageAPI, 'lastImageID', uploadState['image_id'])
+        uploadState['error']    = str(e)
+        vcycle.vacutils.logLine('Background upload of %s fails on attempt %d (%s)' % (imageName, uploadState['attempts'], str(e)))
+
+        if uploadState['attempts'] > self.image_upload_retries:
+          uploadState['status'] = 'failed'
+          self._setImageUploadState(imageName, uploadState)
+          return
+
+        self._setImageUploadState(imageName, uploadState)
+        vcycle.vacutils.flushLog()
+
+        # Wait less than imageUploadStaleSeconds so we are not taken to have died
+        time.sleep(min(self.image_upload_retry_seconds * 2 ** (uploadState['attempts'] - 1),
+                       self.imageUploadStaleSeconds / 2))
+      else:
+        uploadState['status']         = 'active'
+        uploadState['image_id']       = str(imageID)
+        uploadState['bytes_uploaded'] = uploadState['bytes_total']
+        self._setImageUploadState(imageName, uploadState)
+        vcycle.vacutils.logLine('Background upload of ' + imageName + ' finished as image ' + str(imageID))
+        return
+
+  def prepareImages(self):
+    """ Find or start uploading the images of all machinetypes before making machines """
+
+    for machinetypeName in self.machinetypes:
+      if self.machinetypes[machinetypeName].target_share <= 0.0:
+        continue
+
+      try:
+        self.getImageID(machinetypeName)
+      except Exception as e:
+        vcycle.vacutils.logLine('Image for machinetype ' + machinetypeName + ' not ready: ' + str(e))
+
+    if self.volume_gb_per_processor:
+      try:
+        self._fillVolumePools()
+      except Exception as e:
+        vcycle.vacutils.logLine('Filling volume pools in ' + self.spaceName + ' fails: ' + str(e))
 
   def uploadImage(self, imageFile, imageName, imageLastModified,
                   verbose = False):
@@ -647,29 +1274,164 @@ class OpenstackSpace(vcycle.BaseSpace):
     self.machinetypes[machinetypeName]._keyPairName = keyName
     return self.machinetypes[machinetypeName]._keyPairName
 
-  def deleteVolumes(self):
-  
+  def _listVolumes(self):
+    """ Get the details of all volumes, following Cinder pagination """
+
+    volumes = []
+    nextURL = self.volumeURL + '/volumes/detail'
+
+    while nextURL:
+      try:
+        result = self.httpRequest(nextURL, headers = [ 'X-Auth-Token: ' + self.token ])
+      except Exception as e:
+        raise OpenstackError('Cannot connect to ' + self.volumeURL + ' (' + str(e) + ')')
+
+      volumes.extend(result['response']['volumes'])
+      nextURL = None
+
+      for link in result['response'].get('volumes_links', []):
+        if link.get('rel') == 'next':
+          nextURL = str(link['href'])
+
+    return volumes
+
+  def _deleteImage(self, imageID):
+    self.httpRequest(self.imageURL + '/v' + self.glanceAPIVersion + '/images/' + imageID,
+                     method = 'DELETE',
+                     headers = [ 'X-Auth-Token: ' + self.token ])
+
+  def _deleteVolume(self, uuidStr):
+    self.httpRequest(self.volumeURL + '/volumes/' + uuidStr,
+                     method = 'DELETE',
+                     headers = [ 'X-Auth-Token: ' + self.token ])
+
+  def _findOrphanedImages(self):
+    """ Older versions of images uploaded by Vcycle which no server uses
+
+    Only private images owned by this project are considered, as images
+    visible to other projects may be used by spaces we cannot see.
+    """
+
+    orphans = []
+
+    if not self.projectID:
+      vcycle.vacutils.logLine('Project ID of ' + self.spaceName + ' not known, so not looking for old images')
+      return orphans
+
+    # Only names whose current version was resolved this cycle are considered
+    self._getImageIndex(refresh = True)
+
+    for imageName, currentID in self._imageIDs.iteritems():
+      currentLastModified = None
+
+      for (imageID, active, lastModifieds) in self._imageIndex.get(imageName, []):
+        if imageID == currentID and lastModifieds:
+          currentLastModified = max([ int(lm) for lm in lastModifieds if lm.isdigit() ] or [ None ])
+
+      if currentLastModified is None:
+        continue
+
+      for (imageID, active, lastModifieds) in self._imageIndex.get(imageName, []):
+        # Images without last_modified were not uploaded by Vcycle
+        lastModifieds = [ int(lm) for lm in lastModifieds if lm.isdigit() ]
+
+        if imageID != currentID and \
+           imageID not in self._serverImageIDs and \
+           self._imageOwners.get(imageID) == (self.projectID, 'private') and \
+           lastModifieds and max(lastModifieds) < currentLastModified:
+          orphans.append((imageID, imageName))
+
+    return orphans
+
+  def _findOrphanedVolumes(self):
+    """ Unattached volumes made by Vcycle for machines which no longer exist """
+
+    orphans = []
+
+    for volume in self._listVolumes():
+      volumeName = str(volume.get('name'))
+
+      if not volumeName.startswith('vcycle-') or \
+         volumeName in self.machines or \
+         volume.get('attachments') or \
+         volume.get('status') not in ('available', 'error'):
+        continue
+
+      # Volumes for machines still being set up have machine directories
+      if os.path.isdir(self.machineDir(volumeName)):
+        continue
+
+      try:
+        createdTime = calendar.timegm(time.strptime(str(volume['created_at']).split('.')[0], "%Y-%m-%dT%H:%M:%S"))
+      except:
+        continue
+
+      if createdTime < time.time() - 3600:
+        orphans.append((str(volume['id']), volumeName))
+
+    return orphans
+
+  def collectGarbage(self):
+    """ Delete old images and volumes left behind by Vcycle, at most every gc_seconds """
+
+    if self.garbage_collection == 'off':
+      return
+
+    gcTimeFile = '/var/lib/vcycle/shared/spaces/' + self.spaceName + '/gc_time'
+
+    try:
+      if os.stat(gcTimeFile).st_mtime > time.time() - self.gc_seconds:
+        return
+    except:
+      pass
+
+    vcycle.vacutils.createFile(gcTimeFile, str(int(time.time())), tmpDir = '/var/lib/vcycle/tmp')
+
+    jobs     = []
+    imageIDs = {}
+
     try:
-      listResult = self.httpRequest(self.volumeURL + '/volumes',
-                                  headers = [ 'X-Auth-Token: ' + self.token ])
+      for (imageID, imageName) in self._findOrphanedImages():
+        jobs.append(('Deleting old image ' + imageID + ' (' + imageName + ')', self._deleteImage, (imageID,)))
+        imageIDs[jobs[-1][0]] = imageID
     except Exception as e:
-      raise OpenstackError('Cannot connect to ' + self.volumeURL + ' (' + str(e) + ')')
-  
-    for volume in listResult['response']['volumes']:
-    
-      uuidStr = str(volume['id'])
-   
-      print 'Try to delete ' + str(volume['name'])
-    
+      vcycle.vacutils.logLine('Failed to find old images in ' + self.spaceName + ' (' + str(e) + ')')
+
+    if self.volumeURL:
+      try:
+        for (uuidStr, volumeName) in self._findOrphanedVolumes():
+          jobs.append(('Deleting orphaned volume ' + uuidStr + ' (' + volumeName + ')', self._deleteVolume, (uuidStr,)))
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed to find orphaned volumes in ' + self.spaceName + ' (' + str(e) + ')')
+
+    if self.garbage_collection == 'dry_run':
+      for (description, function, args) in jobs:
+        vcycle.vacutils.logLine('Dry run: would be ' + description)
+
+      vcycle.vacutils.logLine('Garbage collection dry run found %d old images and volumes in %s' % (len(jobs), self.spaceName))
+      return
+
+    failedJobs = vcycle.shared.runConcurrently(jobs,
+                                               numThreads   = self.delete_threads,
+                                               perSecond    = self.delete_per_second,
+                                               retries      = self.delete_retries,
+                                               retrySeconds = self.delete_retry_seconds)
+
+    vcycle.vacutils.logLine('Garbage collection deleted %d of %d old images and volumes in %s'
+                            % (len(jobs) - len(failedJobs), len(jobs), self.spaceName))
+
+    # So this and other spaces do not try to use the deleted images
+    deletedImageIDs = [ imageIDs[description] for description in imageIDs if description not in failedJobs ]
+
+    if deletedImageIDs:
       try:
-        deleteResult = self.httpRequest(self.volumeURL + '/volumes/' + uuidStr,
-                                        method = 'DELETE',
-                                        headers = [ 'X-Auth-Token: ' + self.token ])
+        self._removeFromImageIndex(deletedImageIDs)
+        self._removeStagedImages(deletedImageIDs)
       except Exception as e:
-        print str(e)
+        vcycle.vacutils.logLine('Failed to remove deleted images from image index and manifest (' + str(e) + ')')
 
   def createVolume(self, machineName, machinetypeName, processors, zone):
-    # Create a volume synchronously
+    # Request a volume, without waiting for it to become available
     # Volume is created with the same name as its intended machine
 
     request = { 
@@ -688,34 +1450,17 @@ class OpenstackSpace(vcycle.BaseSpace):
                                 jsonRequest = request,
                                 headers = [ 'X-Auth-Token: ' + self.token ])
     except Exception as e:
+      self._forgetMissingImage(machinetypeName)
       raise OpenstackError('Cannot connect to ' + self.volumeURL + ' (' + str(e) + ')')
 
     try:
       uuidStr = str(result['response']['volume']['id'])
-    except:
+    except Exception as e:
       raise OpenstackError('Could not get volume UUID from volume creation response (' + str(e) + ')')
 
-    vcycle.vacutils.logLine('Created volume ' + machineName + ' (' + uuidStr + ') within ' + self.spaceName)
-
-    startTime = int(time.time())
-
-    # Wait for volume to become available. Not ideal since may take a while
-    # 120 is a hardcoded timeout of 120 seconds
-    while int(time.time()) < startTime + 120:
-    
-      try:
-        infoResult = self.httpRequest(self.volumeURL + '/volumes/' + uuidStr,
-                                      headers = [ 'X-Auth-Token: ' + self.token ])
-      except Exception as e:
-        raise OpenstackError('Cannot connect to ' + self.volumeURL + ' (' + str(e) + ')')
-  
-      if infoResult['response']['volume']['status'] == 'available':
-        vcycle.vacutils.logLine('Volume ' + machineName + ' (' + uuidStr + ') is now available')
-        return uuidStr
-        
-      time.sleep(10) # Hardcoded checking interval of 10 seconds
+    vcycle.vacutils.logLine('Requested volume ' + machineName + ' (' + uuidStr + ') within ' + self.spaceName)
 
-    raise OpenstackError('Volume ' + machineName + ' (' + uuidStr + ') failed to become available - timeout reached')
+    return uuidStr
 
 #    request = { "os-attach": {
 #                               "host_name" : machineName,
@@ -738,69 +1483,240 @@ class OpenstackSpace(vcycle.BaseSpace):
 #      
 #    vcycle.vacutils.logLine('Attached volume ' + machineName + ' (' + uuidStr + ')  within ' + self.spaceName)
     
-  def createMachine(self, machineName, machinetypeName, zone = None):
-    # OpenStack-specific machine creation steps
-    
+  def _getVolumeLimits(self):
+    """ Return how many more volumes and GB the project may create, or None if not known """
+
+    try:
+      result = self.httpRequest(self.volumeURL + '/limits',
+                                headers = [ 'X-Auth-Token: ' + self.token ])
+      limits = result['response']['limits']['absolute']
+      return (int(limits['maxTotalVolumes'])         - int(limits['totalVolumesUsed']),
+              int(limits['maxTotalVolumeGigabytes']) - int(limits['totalGigabytesUsed']))
+    except:
+      return (None, None)
+
+  def _fillVolumePools(self):
+    """ Keep warm pools of available boot volumes for machinetypes with volume_pool_seconds """
+
+    self._poolVolumes = []
+    deleteVolumes     = []
+    poolVolumes       = {}
+
+    for volume in self._listVolumes():
+      try:
+        if str(volume['metadata']['vcycle_space']) == self.spaceName:
+          poolVolumes.setdefault(str(volume['metadata']['vcycle_machinetype']), []).append(volume)
+      except:
+        pass
+
+    (volumesLeft, gbLeft) = self._getVolumeLimits()
+
+    for machinetypeName in set(self.machinetypes.keys() + poolVolumes.keys()):
+      volumes = poolVolumes.get(machinetypeName, [])
+
+      if machinetypeName not in self.machinetypes or \
+         self.machinetypes[machinetypeName].volume_pool_seconds <= 0 or \
+         self.machinetypes[machinetypeName].target_share <= 0.0:
+        deleteVolumes.extend(volumes)
+        continue
+
+      if self.machinetypes[machinetypeName].imagePending:
+        self._poolVolumes.extend(volumes)
+        continue
+
+      try:
+        imageID    = self.getImageID(machinetypeName)
+        processors = self.flavors[self._getMachinetypeFlavorName(machinetypeName)]['processors']
+      except Exception as e:
+        vcycle.vacutils.logLine('Cannot fill volume pool of ' + machinetypeName + ' (' + str(e) + ')')
+        continue
+
+      # Volumes of outdated images or sizes are recycled
+      readyVolumes = []
+      for volume in volumes:
+        if str(volume['metadata'].get('vcycle_image_id')) != imageID or \
+           int(volume.get('size', 0)) != self.volume_gb_per_processor * processors or \
+           volume.get('status') not in ('creating', 'downloading', 'available'):
+          deleteVolumes.append(volume)
+        else:
+          readyVolumes.append(volume)
+
+      self._poolVolumes.extend(readyVolumes)
+
+      # The pool size follows the number of machines created in the last volume_pool_seconds
+      recentCreations = len([ machine for machine in self.machines.values()
+                              if machine.machinetypeName == machinetypeName and
+                                 machine.createdTime and
+                                 machine.createdTime > time.time() - self.machinetypes[machinetypeName].volume_pool_seconds ])
+
+      numNewVolumes = min(recentCreations, self.machinetypes[machinetypeName].volume_pool_max) - len(readyVolumes)
+
+      for i in range(numNewVolumes):
+        if (volumesLeft is not None and volumesLeft <= 0) or \
+           (gbLeft is not None and gbLeft < self.volume_gb_per_processor * processors):
+          vcycle.vacutils.logLine('No volume quota left to fill volume pool of ' + machinetypeName)
+          break
+
+        volumeName = 'vcyclepool-' + ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(10))
+
+        request = { 'volume' : { 'size'     : self.volume_gb_per_processor * processors,
+                                 'imageRef' : imageID,
+                                 'name'     : volumeName,
+                                 'metadata' : { 'vcycle_space'       : self.spaceName,
+                                                'vcycle_machinetype' : machinetypeName,
+                                                'vcycle_image_id'    : imageID }
+                               }
+                  }
+
+        if self.zones:
+          request['volume']['availability_zone'] = random.choice(self.zones)
+
+        try:
+          result = self.httpRequest(self.volumeURL + '/volumes',
+                                    jsonRequest = request,
+                                    headers = [ 'X-Auth-Token: ' + self.token ])
+        except Exception as e:
+          vcycle.vacutils.logLine('Failed creating pool volume for ' + machinetypeName + ' (' + str(e) + ')')
+          break
+
+        vcycle.vacutils.logLine('Requested pool volume ' + volumeName + ' (' + str(result['response']['volume']['id']) + ') for ' + machinetypeName + ' within ' + self.spaceName)
+
+        if volumesLeft is not None:
+          volumesLeft -= 1
+
+        if gbLeft is not None:
+          gbLeft -= self.volume_gb_per_processor * processors
+
+    if deleteVolumes:
+      failedJobs = vcycle.shared.runConcurrently([ ('Deleting pool volume ' + str(volume['id']), self._deleteVolume, (str(volume['id']),))
+                                                   for volume in deleteVolumes ],
+                                                 numThreads   = self.delete_threads,
+                                                 perSecond    = self.delete_per_second,
+                                                 retries      = self.delete_retries,
+                                                 retrySeconds = self.delete_retry_seconds)
+
+      vcycle.vacutils.logLine('Recycled %d of %d pool volumes in %s' % (len(deleteVolumes) - len(failedJobs), len(deleteVolumes), self.spaceName))
+
+  def _takePoolVolume(self, machineName, machinetypeName, processors, zone):
+    """ Take an available pool volume for a new machine, returning its UUID or None """
+
+    for volume in self._poolVolumes:
+      if volume.get('status') != 'available' or \
+         str(volume['metadata'].get('vcycle_machinetype')) != machinetypeName or \
+         int(volume.get('size', 0)) != self.volume_gb_per_processor * processors or \
+         (zone and str(volume.get('availability_zone')) != zone):
+        continue
+
+      self._poolVolumes.remove(volume)
+
+      # Renaming the volume and removing its pool metadata takes it out of the pool
+      try:
+        self.httpRequest(self.volumeURL + '/volumes/' + str(volume['id']),
+                         method      = 'PUT',
+                         jsonRequest = { 'volume' : { 'name' : machineName, 'metadata' : {} } },
+                         headers     = [ 'X-Auth-Token: ' + self.token ])
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed taking pool volume ' + str(volume['id']) + ' (' + str(e) + ')')
+        continue
+
+      vcycle.vacutils.logLine('Took pool volume ' + str(volume['id']) + ' for ' + machineName)
+      return str(volume['id'])
+
+    return None
+
+  def _getMachinetypeFlavorName(self, machinetypeName):
     # Find the first flavor matching min_processors:max_processors
-    flavorName = None
     
     for fn in self.machinetypes[machinetypeName].flavor_names:
       if fn in self.flavors:
         if self.machinetypes[machinetypeName].min_processors <= self.flavors[fn]['processors'] and \
            (self.machinetypes[machinetypeName].max_processors is None or \
             self.machinetypes[machinetypeName].max_processors >= self.flavors[fn]['processors']):
-          flavorName = fn
-          break
+          return fn
     
-    if not flavorName:
-      raise OpenstackError('No flavor suitable for machinetype ' + machinetypeName)
-
-    if self.volume_gb_per_processor:
-      uuidVolume = self.createVolume(machineName, machinetypeName, self.flavors[flavorName]['processors'], zone)
-    else:
-      uuidVolume = None
-
-    try:
-      request = { 'server' :
-                  { 'user_data' : base64.b64encode(self.getFileContents(machineName, 'user_data')),
-                    'name'      : machineName,
-                    'imageRef'  : self.getImageID(machinetypeName),
-                    'flavorRef' : self.flavors[flavorName]['id'],
-                    'metadata'  : { 'cern-services'   : 'false',
-                                    'name'	      : machineName,
-                                    'machinetype'     : machinetypeName,
-                                    'machinefeatures' : 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/machinefeatures',
-                                    'jobfeatures'     : 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/jobfeatures',
-                                    'joboutputs'      : 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/joboutputs'  }
-                  }
+    raise OpenstackError('No flavor suitable for machinetype ' + machinetypeName)
+
+  def _machineMetadata(self, machineName):
+    # Per-machine metadata keys, also used by VMs to find their own MJF URLs
+
+    return { 'name'            : machineName,
+             'machinefeatures' : 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/machinefeatures',
+             'jobfeatures'     : 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/jobfeatures',
+             'joboutputs'      : 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/joboutputs' }
+
+  def _makeServerRequest(self, machineName, machinetypeName, flavorName, zone):
+    # Build the body of a POST /servers request, common to single and multi-instance creation
+
+    request = { 'server' :
+                { 'user_data' : base64.b64encode(self.getFileContents(machineName, 'user_data')),
+                  'name'      : machineName,
+                  'imageRef'  : self.getImageID(machinetypeName),
+                  'flavorRef' : self.flavors[flavorName]['id'],
+                  'metadata'  : { 'cern-services'   : 'false',
+                                  'machinetype'     : machinetypeName }
                 }
+              }
+
+    if self.network_uuid:
+      request['server']['networks'] = [{"uuid": self.network_uuid}]
+      vcycle.vacutils.logLine('Will use network %s for %s' % (self.network_uuid, machineName))
 
-      if self.network_uuid:
-        request['server']['networks'] = [{"uuid": self.network_uuid}]
-        vcycle.vacutils.logLine('Will use network %s for %s' % (self.network_uuid, machineName))
+    if zone:
+      request['server']['availability_zone'] = zone
+      vcycle.vacutils.logLine('Will request %s be created in zone %s of space %s' % (machineName, zone, self.spaceName))
+
+    if self.security_groups:
+      request['server']['security_groups'] = []
+      for security_group in self.security_groups:
+        request['server']['security_groups'].append( { "name" : security_group } )
 
-      if zone:
-        request['server']['availability_zone'] = zone
-        vcycle.vacutils.logLine('Will request %s be created in zone %s of space %s' % (machineName, zone, self.spaceName))
+      vcycle.vacutils.logLine('Will request %s be created in security groups %s of space %s' % (machineName, str(self.security_groups), self.spaceName))
 
-      if self.security_groups:
-        request['server']['security_groups'] = []
-        for security_group in self.security_groups:
-          request['server']['security_groups'].append( { "name" : security_group } )
+    if self.machinetypes[machinetypeName].root_public_key:
+      request['server']['key_name'] = self.getKeyPairName(machinetypeName)
 
-        vcycle.vacutils.logLine('Will request %s be created in security groups %s of space %s' % (machineName, str(self.security_groups), self.spaceName))
+    return request
+
+  def createMachine(self, machineName, machinetypeName, zone = None):
+    # OpenStack-specific machine creation steps
+    
+    flavorName = self._getMachinetypeFlavorName(machinetypeName)
 
-      if self.machinetypes[machinetypeName].root_public_key:
-        request['server']['key_name'] = self.getKeyPairName(machinetypeName)
+    if self.volume_gb_per_processor:
+      # A volume from the warm pool can be used immediately. Otherwise the
+      # server is requested by advanceMachines() in a later cycle, once
+      # the new boot volume is available
+      uuidVolume = self._takePoolVolume(machineName, machinetypeName, self.flavors[flavorName]['processors'], zone)
 
       if uuidVolume:
-        time.sleep(60) # UNTIL WE HAVE HANDLE THE STATE PROPERLY
-        request['server']['block_device_mapping_v2'] = [{ "source_type" : "volume",
-                                                          "uuid"        : uuidVolume,  
-                                                          "delete_on_termination" : True,
-                                                          "boot_index": 0,
-                                                          "destination_type" : "volume"
-                                                       }]
+        volumeAvailable = True
+      else:
+        volumeAvailable = False
+        uuidVolume = self.createVolume(machineName, machinetypeName, self.flavors[flavorName]['processors'], zone)
+
+      self.setFileContents(machineName, 'volume_id',    uuidVolume)
+      self.setFileContents(machineName, 'provisioning', 'volume_requested')
+
+      self.machines[machineName] = vcycle.shared.Machine(name             = machineName,
+                                                         spaceName        = self.spaceName,
+                                                         state            = vcycle.MachineState.starting,
+                                                         ip               = '0.0.0.0',
+                                                         createdTime      = int(time.time()),
+                                                         startedTime      = None,
+                                                         updatedTime      = int(time.time()),
+                                                         uuidStr          = None,
+                                                         machinetypeName  = machinetypeName,
+                                                         zone             = zone,
+                                                         processors       = self.flavors[flavorName]['processors'])
+
+      if volumeAvailable:
+        self._createVolumeServer(machineName, uuidVolume)
+
+      return
+
+    try:
+      request = self._makeServerRequest(machineName, machinetypeName, flavorName, zone)
+      request['server']['metadata'].update(self._machineMetadata(machineName))
 
 #      if self.volume_gb_per_processor:
 #        request['server']['block_device_mapping_v2'] = [{ "source_type" : "blank",
@@ -815,16 +1731,10 @@ class OpenstackSpace(vcycle.BaseSpace):
       raise OpenstackError('Failed to create new machine %s: %s' % (machineName, str(e)))
 
     try:
-      result = self.httpRequest(self.computeURL + '/servers',
-                                jsonRequest = request,
-                                headers = [ 'X-Auth-Token: ' + self.token ])
-    except Exception as e:
-      raise OpenstackError('Cannot connect to ' + self.computeURL + ' (' + str(e) + ')')
-
-    try:
-      uuidStr = str(result['response']['server']['id'])
+      uuidStr = self._requestServer(request)
     except:
-      raise OpenstackError('Could not get VM UUID from VM creation response (' + str(e) + ')')
+      self._forgetMissingImage(machinetypeName)
+      raise
 
     vcycle.vacutils.logLine('Created ' + machineName + ' (' + uuidStr + ') for ' + machinetypeName + ' within ' + self.spaceName)
 
@@ -839,8 +1749,183 @@ class OpenstackSpace(vcycle.BaseSpace):
                                                        machinetypeName  = machinetypeName,
                                                        processors       = self.flavors[flavorName]['processors'])
 
+  def _requestServer(self, request):
+    # POST a server request and return the UUID of the new server
+
+    try:
+      result = self.httpRequest(self.computeURL + '/servers',
+                                jsonRequest = request,
+                                headers = [ 'X-Auth-Token: ' + self.token ])
+    except Exception as e:
+      raise OpenstackError('Cannot connect to ' + self.computeURL + ' (' + str(e) + ')')
+
+    try:
+      return str(result['response']['server']['id'])
+    except Exception as e:
+      raise OpenstackError('Could not get VM UUID from VM creation response (' + str(e) + ')')
+
+  def _createVolumeServer(self, machineName, uuidVolume):
+    # Request the server for a machine whose boot volume is now available
+
+    machinetypeName = self.machines[machineName].machinetypeName
+    flavorName      = self._getMachinetypeFlavorName(machinetypeName)
+
+    try:
+      zone = self.getFileContents(machineName, 'zone').strip()
+    except:
+      zone = None
+
+    request = self._makeServerRequest(machineName, machinetypeName, flavorName, zone)
+    request['server']['metadata'].update(self._machineMetadata(machineName))
+    request['server']['block_device_mapping_v2'] = [{ "source_type" : "volume",
+                                                      "uuid"        : uuidVolume,  
+                                                      "delete_on_termination" : True,
+                                                      "boot_index": 0,
+                                                      "destination_type" : "volume"
+                                                   }]
+
+    uuidStr = self._requestServer(request)
+
+    self.setFileContents(machineName, 'provisioning', 'server_requested')
+    self.machines[machineName].uuidStr = uuidStr
+
+    vcycle.vacutils.logLine('Created ' + machineName + ' (' + uuidStr + ') with volume ' + uuidVolume + ' for ' + machinetypeName + ' within ' + self.spaceName)
+
+  def advanceMachines(self):
+    # Move machines waiting for their boot volumes on to the next stage.
+    # One volume listing is used for all of them, so none of them block the cycle
+
+    waitingMachineNames = [ machineName for machineName,machine in self.machines.iteritems()
+                            if machine.uuidStr is None and machine.managedHere and
+                               not os.path.exists(self.machineDir(machineName) + '/deleted') ]
+
+    if not waitingMachineNames:
+      return
+
+    volumeStatuses = {}
+    for volume in self._listVolumes():
+      volumeStatuses[str(volume['id'])] = str(volume.get('status'))
+
+    for machineName in waitingMachineNames:
+      try:
+        uuidVolume = self.getFileContents(machineName, 'volume_id').strip()
+        status     = volumeStatuses.get(uuidVolume, 'missing')
+
+        if status == 'available':
+          self._createVolumeServer(machineName, uuidVolume)
+        elif status in ('error', 'missing'):
+          vcycle.vacutils.logLine('Volume ' + machineName + ' (' + uuidVolume + ') is in state ' + status)
+          self._deleteOneMachine(machineName, '700 Failed to start')
+        else:
+          vcycle.vacutils.logLine('Volume ' + machineName + ' (' + uuidVolume + ') is in state ' + status + ', waiting')
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed advancing ' + machineName + ' in ' + self.spaceName + ' (' + str(e) + ')')
+
+  def createMachines(self, machineNames, machinetypeName, zone = None):
+    # Create several machines with one multi-instance request using min_count/max_count
+
+    if self.volume_gb_per_processor:
+      # Each machine needs its own boot volume, so fall back to separate requests
+      return vcycle.BaseSpace.createMachines(self, machineNames, machinetypeName, zone)
+
+    flavorName = self._getMachinetypeFlavorName(machinetypeName)
+
+    try:
+      # Nova names the servers NAME-1 ... NAME-N, matching the names we were given
+      request = self._makeServerRequest(machineNames[0], machinetypeName, flavorName, zone)
+      request['server']['name']                  = machineNames[0].rsplit('-', 1)[0]
+      request['server']['min_count']             = 1
+      request['server']['max_count']             = len(machineNames)
+      request['server']['return_reservation_id'] = True
+    except Exception as e:
+      raise OpenstackError('Failed to create %d new machines: %s' % (len(machineNames), str(e)))
+
+    try:
+      result = self.httpRequest(self.computeURL + '/servers',
+                                jsonRequest = request,
+                                headers = [ 'X-Auth-Token: ' + self.token ])
+    except Exception as e:
+      self._forgetMissingImage(machinetypeName)
+      raise OpenstackError('Cannot connect to ' + self.computeURL + ' (' + str(e) + ')')
+
+    try:
+      reservationID = str(result['response']['reservation_id'])
+    except Exception as e:
+      raise OpenstackError('Could not get reservation ID from multi-instance creation response (' + str(e) + ')')
+
+    vcycle.vacutils.logLine('Requested %d machines for %s within %s with reservation %s' % (len(machineNames), machinetypeName, self.spaceName, reservationID))
+
+    # Find the servers created by this reservation
+    try:
+      result = self.httpRequest(self.computeURL + '/servers/detail?reservation_id=' + reservationID,
+                                headers = [ 'X-Auth-Token: ' + self.token ])
+    except Exception as e:
+      raise OpenstackError('Cannot connect to ' + self.computeURL + ' (' + str(e) + ')')
+
+    # Map servers to our machine names, by name if Nova used our names or else in order
+    servers     = sorted(result['response']['servers'], key = lambda server: server['name'])
+    unusedNames = [ machineName for machineName in machineNames
+                    if machineName not in [ str(server['name']) for server in servers ] ]
+
+    for oneServer in servers:
+
+      if str(oneServer['name']) in machineNames:
+        machineName = str(oneServer['name'])
+      elif unusedNames:
+        machineName = unusedNames.pop(0)
+      else:
+        continue
+
+      uuidStr = str(oneServer['id'])
+      self.setFileContents(machineName, 'reservation_id', reservationID)
+
+      # Per-machine values are then looked up by each VM from its own metadata,
+      # so a machine without them cannot be used
+      try:
+        self.httpRequest(self.computeURL + '/servers/' + uuidStr + '/metadata',
+                         jsonRequest = { 'metadata' : self._machineMetadata(machineName) },
+                         headers = [ 'X-Auth-Token: ' + self.token ])
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed setting metadata of ' + machineName + ' (' + uuidStr + '): ' + str(e))
+        state = vcycle.MachineState.failed
+      else:
+        vcycle.vacutils.logLine('Created ' + machineName + ' (' + uuidStr + ') for ' + machinetypeName + ' within ' + self.spaceName)
+        state = vcycle.MachineState.starting
+
+      self.machines[machineName] = vcycle.shared.Machine(name             = machineName,
+                                                         spaceName        = self.spaceName,
+                                                         state            = state,
+                                                         ip               = '0.0.0.0',
+                                                         createdTime      = int(time.time()),
+                                                         startedTime      = None,
+                                                         updatedTime      = int(time.time()),
+                                                         uuidStr          = uuidStr,
+                                                         machinetypeName  = machinetypeName,
+                                                         processors       = self.flavors[flavorName]['processors'])
+
+      if state == vcycle.MachineState.failed:
+        try:
+          self._deleteOneMachine(machineName, '700 Failed to start')
+        except Exception as e:
+          # Still failed, so deleteMachines() will try again in a later cycle
+          vcycle.vacutils.logLine('Deleting ' + machineName + ' without metadata fails: ' + str(e))
+
   def deleteOneMachine(self, machineName):
 
+    if self.machines[machineName].uuidStr is None:
+      # Still waiting for its boot volume, so no server to delete yet
+      try:
+        uuidVolume = self.getFileContents(machineName, 'volume_id').strip()
+      except:
+        return
+
+      try:
+        self._deleteVolume(uuidVolume)
+      except Exception as e:
+        raise vcycle.shared.VcycleError('Cannot delete volume of ' + machineName + ' via ' + self.volumeURL + ' (' + str(e) + ')')
+
+      return
+
     try:
       self.httpRequest(self.computeURL + '/servers/' + self.machines[machineName].uuidStr,
                        method = 'DELETE',
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+import os
+import sys
+import glob
+import argparse
+
+import vcycle.vacutils
+
+""" Script to maintain the APEL accounting records in apel-archive
+    rebuild-counts recounts the jobs in each month for sync records
+    sync writes APEL sync records for a month to apel-outgoing
+    compact rolls finished days into compressed monthly bundles
+    list and extract show archived records by date and machinetype
+    reemit writes archived records to apel-outgoing again
+"""
+
+parser = argparse.ArgumentParser(description='Maintain APEL accounting records.')
+
+parser.add_argument('-d', '--dir', type=str, default='/var/lib/vcycle',
+    help='Directory containing apel-archive and apel-outgoing.')
+
+subparsers = parser.add_subparsers(dest='command')
+
+rebuildParser = subparsers.add_parser('rebuild-counts',
+    help='Recount the jobs in the archive for each month.')
+
+rebuildParser.add_argument('months', type=str, nargs='*', default=[],
+    help='Months to recount as YYYYMM. If none, all months in the archive.')
+
+syncParser = subparsers.add_parser('sync',
+    help='Write APEL sync records for a month to apel-outgoing.')
+
+syncParser.add_argument('month', type=str,
+    help='Month as YYYYMM.')
+
+compactParser = subparsers.add_parser('compact',
+    help='Roll days before today into compressed monthly bundles.')
+
+compactParser.add_argument('-b', '--before', type=str, default=None,
+    help='Only compact days before YYYYMMDD rather than today.')
+
+for (command, helpText) in [ ('list',    'List archived records.'),
+                             ('extract', 'Print archived records as APEL messages.'),
+                             ('reemit',  'Write archived records to apel-outgoing again.') ]:
+  recordsParser = subparsers.add_parser(command, help=helpText)
+
+  recordsParser.add_argument('-f', '--from', dest='fromDay', type=str, default=None,
+      help='First day as YYYYMMDD.')
+
+  recordsParser.add_argument('-t', '--to', dest='toDay', type=str, default=None,
+      help='Last day as YYYYMMDD.')
+
+  recordsParser.add_argument('-m', '--machinetype', type=str, default=None,
+      help='Only records of this machinetype.')
+
+args = parser.parse_args(sys.argv[1:])
+
+if args.command == 'rebuild-counts':
+
+  months = args.months
+
+  if not months:
+    months = sorted(set([ os.path.basename(path)[:6]
+                          for path in glob.glob(args.dir + '/apel-archive/[0-9]*')
+                          if os.path.basename(path)[:6].isdigit() ]))
+
+  for month in months:
+    counts = vcycle.vacutils.updateApelCounts(args.dir, month,
+                                              counts = vcycle.vacutils.countApelRecords(args.dir, month),
+                                              tmpDir = args.dir + '/tmp')
+
+    for site in sorted(counts):
+      for submitHost in sorted(counts[site]):
+        print '%s %s %s %d' % (month, site, submitHost, counts[site][submitHost])
+
+elif args.command == 'sync':
+  sys.exit(vcycle.vacutils.makeSyncRecord(args.dir, args.month, args.dir + '/tmp'))
+
+elif args.command == 'compact':
+  print 'Compacted %d days' % vcycle.vacutils.compactApelArchive(args.dir, args.dir + '/tmp', args.before)
+
+elif args.command == 'list':
+  for (entry, text) in vcycle.vacutils.iterApelRecords(args.dir, args.fromDay, args.toDay, args.machinetype):
+    print '%s %s %s %s' % (entry['file'], entry.get('machinetype'), entry.get('local_job_id'), entry.get('end_time'))
+
+elif args.command == 'extract':
+  sys.stdout.write('APEL-individual-job-message: v0.3\n')
+
+  for (entry, text) in vcycle.vacutils.iterApelRecords(args.dir, args.fromDay, args.toDay, args.machinetype):
+    sys.stdout.write(text)
+
+elif args.command == 'reemit':
+  print 'Wrote %d records to %s/apel-outgoing' % (vcycle.vacutils.reemitApelRecords(args.dir, args.dir + '/tmp', args.fromDay, args.toDay, args.machinetype), args.dir)
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+import os
+import imp
+import sys
+import time
+import shutil
+import httplib
+import tempfile
+import argparse
+import threading
+import subprocess
+import SocketServer
+import wsgiref.simple_server
+
+""" Load test of the vcycle-wsgi joboutputs receiver, comparing requests
+    per second when it is kept running as with mod_wsgi, and when a new
+    interpreter is started for each PUT as with vcycle-cgi. Uses a
+    synthetic spaces directory in a temporary directory
+"""
+
+parser = argparse.ArgumentParser(description='Load test the joboutputs receiver.')
+
+parser.add_argument('-n', '--requests', type=int, default=2000,
+    help='Number of PUT requests in each test.')
+
+parser.add_argument('-c', '--concurrency', type=int, default=10,
+    help='Number of client threads.')
+
+parser.add_argument('-m', '--machines', type=int, default=500,
+    help='Number of machine directories.')
+
+parser.add_argument('-b', '--bytes', type=int, default=200,
+    help='Size of each uploaded file.')
+
+parser.add_argument('-w', '--wsgi', type=str, default='/usr/sbin/vcycle-wsgi',
+    help='Path to vcycle-wsgi.')
+
+parser.add_argument('--cgi-requests', type=int, default=200,
+    help='Number of PUT requests in the CGI test.')
+
+args = parser.parse_args(sys.argv[1:])
+
+clientDN  = '/DC=com/DC=example/CN=loadtest'
+spaceName = 'space.example.com'
+
+vcycleWsgi = imp.load_source('vcycle_wsgi', args.wsgi)
+
+# Build a synthetic spaces directory and heartbeat index
+tmpDir    = tempfile.mkdtemp(prefix = 'joboutputs-loadtest-')
+spacesDir = tmpDir + '/spaces'
+
+os.makedirs(tmpDir + '/heartbeats')
+open(tmpDir + '/heartbeats/' + spaceName, 'w').close()
+
+for i in range(args.machines):
+  os.makedirs('%s/%s/current/vcycle-%d/joboutputs' % (spacesDir, spaceName, i))
+  open('%s/%s/current/vcycle-%d/https_x509dn' % (spacesDir, spaceName, i), 'w').write(clientDN)
+
+body = 'x' * args.bytes
+
+def runClients(numRequests, putFunction):
+  # Run numRequests PUTs spread over the client threads, returning
+  # the number which failed and the elapsed seconds
+
+  failures  = [ 0 ]
+  lock      = threading.Lock()
+  nextIndex = [ 0 ]
+
+  def client():
+    while True:
+      with lock:
+        i = nextIndex[0]
+        nextIndex[0] += 1
+
+      if i >= numRequests:
+        return
+
+      if not putFunction('/machines/%s/vcycle-%d/joboutputs/heartbeat' % (spaceName, i % args.machines)):
+        with lock:
+          failures[0] += 1
+
+  threads = [ threading.Thread(target = client) for i in range(args.concurrency) ]
+  startTime = time.time()
+
+  for thread in threads:
+    thread.start()
+
+  for thread in threads:
+    thread.join()
+
+  return (failures[0], time.time() - startTime)
+
+# Persistent: one process serving all requests, as with mod_wsgi
+
+def testApplication(environ, start_response):
+  # Add what Apache and mod_ssl would provide
+  environ['REQUEST_URI']       = environ['PATH_INFO']
+  environ['SSL_CLIENT_S_DN']   = clientDN
+  environ['VCYCLE_SPACES_DIR'] = spacesDir
+  return vcycleWsgi.application(environ, start_response)
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+  def log_message(self, *args):
+    pass
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+  daemon_threads = True
+
+server = wsgiref.simple_server.make_server('127.0.0.1', 0, testApplication,
+                                           server_class = ThreadingWSGIServer, handler_class = QuietHandler)
+serverThread = threading.Thread(target = server.serve_forever)
+serverThread.daemon = True
+serverThread.start()
+
+def httpPut(path):
+  try:
+    conn = httplib.HTTPConnection('127.0.0.1', server.server_address[1])
+    conn.request('PUT', path, body)
+    status = conn.getresponse().status
+    conn.close()
+    return status == 200
+  except:
+    return False
+
+(wsgiFailures, wsgiSeconds) = runClients(args.requests, httpPut)
+server.shutdown()
+
+# Fork per request, as with vcycle-cgi
+
+def cgiPut(path):
+  env = dict(os.environ)
+  env.update({ 'REQUEST_METHOD'    : 'PUT',
+               'REQUEST_URI'       : path,
+               'CONTENT_LENGTH'    : str(len(body)),
+               'SSL_CLIENT_S_DN'   : clientDN,
+               'VCYCLE_SPACES_DIR' : spacesDir,
+               'SERVER_NAME'       : '127.0.0.1',
+               'SERVER_PORT'       : '443',
+               'SERVER_PROTOCOL'   : 'HTTP/1.1' })
+
+  p = subprocess.Popen([sys.executable, args.wsgi], env = env,
+                       stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+  (out, err) = p.communicate(body)
+  return out.startswith('Status: 200')
+
+(cgiFailures, cgiSeconds) = runClients(args.cgi_requests, cgiPut)
+
+indexLines = len(open(tmpDir + '/heartbeats/' + spaceName, 'r').readlines())
+
+shutil.rmtree(tmpDir)
+
+print '%d machines, %d byte files, %d client threads' % (args.machines, args.bytes, args.concurrency)
+print 'Persistent WSGI: %d requests in %.2fs, %.0f requests/s, %d failed' % (args.requests, wsgiSeconds, args.requests / wsgiSeconds, wsgiFailures)
+print 'Fork per request: %d requests in %.2fs, %.0f requests/s, %d failed' % (args.cgi_requests, cgiSeconds, args.cgi_requests / cgiSeconds, cgiFailures)
+print 'Heartbeat index: %d lines' % indexLines
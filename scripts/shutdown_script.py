@@ -57,6 +57,9 @@ for spaceName, space in vcycle.shared.spaces.iteritems():
   except:
     vcycle.vacutils.logLine('Failed to scan machines for ', spaceName)
     continue
+  finally:
+    space.writeApelSpool()
+    space.sendMachineMessages()
 
   # iterate over machines
   for machineName, machine in space.machines.iteritems():
@@ -94,3 +97,4 @@ for spaceName, space in vcycle.shared.spaces.iteritems():
 
     shutdown_file.close()
 
+vcycle.shared.vacmonSender.flush()
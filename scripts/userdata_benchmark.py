@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+import vcycle.vacutils
+
+""" Microbenchmark comparing the compiled, cached user_data templates
+    of vacutils.createUserData() with the old sequential str.replace()
+    renderer, using a synthetic template in a temporary directory
+"""
+
+parser = argparse.ArgumentParser(description='Benchmark user_data template rendering.')
+
+parser.add_argument('-n', '--machines', type=int, default=200,
+    help='Number of machines to render user_data for.')
+
+parser.add_argument('-k', '--kilobytes', type=int, default=300,
+    help='Approximate size of the template in KB.')
+
+parser.add_argument('-o', '--options', type=int, default=20,
+    help='Number of user_data_option_* options.')
+
+args = parser.parse_args(sys.argv[1:])
+
+def legacyCreateUserData(machinetypePath, options, versionString, spaceName, machinetypeName, userDataPath, hostName, uuidStr):
+  # The renderer used before templates were compiled, without the HTTP(S) and proxy cases
+
+  u = open(machinetypePath + '/files/' + userDataPath, 'r')
+  userDataContents = u.read()
+  u.close()
+
+  userDataContents = userDataContents.replace('##user_data_space##',            spaceName)
+  userDataContents = userDataContents.replace('##user_data_machinetype##',      machinetypeName)
+  userDataContents = userDataContents.replace('##user_data_machine_hostname##', hostName)
+  userDataContents = userDataContents.replace('##user_data_manager_version##',  versionString)
+  userDataContents = userDataContents.replace('##user_data_manager_hostname##', os.uname()[1])
+  userDataContents = userDataContents.replace('##user_data_vmtype##',           machinetypeName)
+  userDataContents = userDataContents.replace('##user_data_vm_hostname##',      hostName)
+  userDataContents = userDataContents.replace('##user_data_vmlm_version##',     versionString)
+  userDataContents = userDataContents.replace('##user_data_vmlm_hostname##',    os.uname()[1])
+  userDataContents = userDataContents.replace('##user_data_uuid##',             uuidStr)
+
+  for oneOption, oneValue in options.iteritems():
+    if oneOption.startswith('user_data_option_'):
+      userDataContents = userDataContents.replace('##' + oneOption + '##', oneValue)
+    elif oneOption.startswith('user_data_file_'):
+      f = open(machinetypePath + '/files/' + oneValue, 'r')
+      fileContents = f.read()
+      f.close()
+      userDataContents = userDataContents.replace('##' + oneOption + '##', fileContents)
+      userDataContents = userDataContents.replace('##user_data_option_' + oneOption[15:] + '##', fileContents)
+
+  return re.sub('##user_data_[a-z,0-9,_]*##', '', userDataContents)
+
+# Build a synthetic machinetype directory
+machinetypePath = tempfile.mkdtemp(prefix = 'userdata-benchmark-')
+os.makedirs(machinetypePath + '/files')
+
+options = { 'user_data_file_script' : 'script.sh' }
+
+for i in range(args.options):
+  options['user_data_option_opt%d' % i] = 'value%d' % i
+
+f = open(machinetypePath + '/files/script.sh', 'w')
+f.write('#!/bin/sh\necho ##user_data_space##\n' * 100)
+f.close()
+
+placeholders = [ '##user_data_space##', '##user_data_machine_hostname##', '##user_data_uuid##',
+                 '##user_data_unused##', '##user_data_option_script##' ] + \
+               [ '##' + oneOption + '##' for oneOption in options if oneOption.startswith('user_data_option_') ]
+
+lines = []
+size  = 0
+i     = 0
+
+while size < args.kilobytes * 1024:
+  line = 'line %d of the template with %s in it\n' % (i, placeholders[i % len(placeholders)])
+  lines.append(line)
+  size += len(line)
+  i    += 1
+
+f = open(machinetypePath + '/files/user_data', 'w')
+f.write(''.join(lines))
+f.close()
+
+kwargs = { 'machinetypePath' : machinetypePath,
+           'options'         : options,
+           'versionString'   : 'Vcycle benchmark',
+           'spaceName'       : 'space.example.com',
+           'machinetypeName' : 'example',
+           'userDataPath'    : 'user_data' }
+
+# Check both renderers agree before timing them
+if legacyCreateUserData(hostName = 'host0', uuidStr = 'uuid0', **kwargs) != \
+   vcycle.vacutils.createUserData(shutdownTime = int(time.time()) + 86400, hostName = 'host0', uuidStr = 'uuid0', **kwargs):
+  print 'Renderers produce different user_data!'
+
+startTime = time.time()
+for i in range(args.machines):
+  legacyCreateUserData(hostName = 'host%d' % i, uuidStr = 'uuid%d' % i, **kwargs)
+legacySeconds = time.time() - startTime
+
+startTime = time.time()
+for i in range(args.machines):
+  vcycle.vacutils.createUserData(shutdownTime = int(time.time()) + 86400, hostName = 'host%d' % i, uuidStr = 'uuid%d' % i, **kwargs)
+compiledSeconds = time.time() - startTime
+
+shutil.rmtree(machinetypePath)
+
+print '%d machines, %d KB template, %d options' % (args.machines, size / 1024, args.options)
+print 'Sequential replace: %.3fs (%.2fms per machine)' % (legacySeconds, 1000.0 * legacySeconds / args.machines)
+print 'Compiled template:  %.3fs (%.2fms per machine)' % (compiledSeconds, 1000.0 * compiledSeconds / args.machines)
@@ -44,17 +44,20 @@ import stat
 import glob
 import time
 import json
+import Queue
 import socket
 import shutil
 import string
 import pycurl
 import urllib
 import random
+import threading
 import base64
 import datetime
 import StringIO
 import tempfile
 import calendar
+import hashlib
 import collections
 import ConfigParser
 import xml.etree.cElementTree
@@ -70,6 +73,147 @@ spaces              = None
 maxWallclockSeconds = 0
 curlTimeOutSeconds  = 90
 takeSeconds         = 3600	# Take machines abandoned by their manager for 1.00-1.99 hours
+pipeURLs            = []	# Remote vacuum pipes found by readConf()
+vacmonDatagramBytes = 1400	# Largest batched VacMon datagram, below the usual MTU
+staticTelemetry     = None	# Host values which do not change while running
+hostTelemetry       = None	# Host values shared by all spaces this cycle
+
+def runConcurrently(jobs, numThreads = 1, perSecond = None, retries = 0, retrySeconds = 0):
+  # Run each (description, function, args) tuple in the jobs list, in order,
+  # with up to numThreads worker threads. No more than perSecond calls per
+  # second are started if perSecond is given, and failing calls are retried
+  # up to retries times with a doubling delay starting at retrySeconds.
+  # Returns the list of descriptions of jobs which still failed.
+
+  jobsQueue  = Queue.Queue()
+  failedJobs = []
+  rateLock   = threading.Lock()
+  nextStart  = [ time.time() ]
+
+  for job in jobs:
+    jobsQueue.put(job)
+
+  def waitForTurn():
+    if not perSecond:
+      return
+
+    with rateLock:
+      timeNow      = time.time()
+      startTime    = max(timeNow, nextStart[0])
+      nextStart[0] = startTime + 1.0 / perSecond
+
+    if startTime > timeNow:
+      time.sleep(startTime - timeNow)
+
+  def worker():
+    while True:
+      try:
+        (description, function, args) = jobsQueue.get_nowait()
+      except Queue.Empty:
+        return
+
+      for attempt in range(retries + 1):
+        waitForTurn()
+
+        try:
+          function(*args)
+        except Exception as e:
+          vcycle.vacutils.logLine(description + ' fails (attempt ' + str(attempt + 1) + '/' + str(retries + 1) + '): ' + str(e))
+
+          if attempt < retries:
+            time.sleep(retrySeconds * (2 ** attempt))
+        else:
+          break
+      else:
+        failedJobs.append(description)
+
+  if numThreads <= 1 or len(jobs) <= 1:
+    # No need for threads, so keep everything in the calling thread
+    worker()
+    return failedJobs
+
+  workerThreads = []
+
+  for i in range(min(numThreads, len(jobs))):
+    workerThread = threading.Thread(target = worker)
+    workerThread.daemon = True
+    workerThread.start()
+    workerThreads.append(workerThread)
+
+  for workerThread in workerThreads:
+    workerThread.join()
+
+  return failedJobs
+
+class VacMonSender:
+  # Sends VacMon UDP datagrams from a background thread with one socket,
+  # so the cycle never waits for DNS or the network. HOST:PORT targets are
+  # resolved once and the addresses reused for resolveSeconds. As each
+  # cycle is a new process, the addresses are kept in addressesFile
+
+  def __init__(self, resolveSeconds = 300, addressesFile = None):
+    self.resolveSeconds = resolveSeconds
+    self.addressesFile  = addressesFile
+    self.addresses      = {}
+    self.queue          = Queue.Queue()
+    self.sock           = None
+    self.thread         = None
+    self.lock           = threading.Lock()
+
+  def send(self, vacmonHostPorts, datagrams):
+    # Queue datagrams to be sent to each of the HOST:PORT targets
+
+    for vacmonHostPort in vacmonHostPorts:
+      for datagram in datagrams:
+        self.queue.put((vacmonHostPort, datagram))
+
+    with self.lock:
+      if self.thread is None:
+        self.thread = threading.Thread(target = self._sender)
+        self.thread.daemon = True
+        self.thread.start()
+
+  def flush(self):
+    # Wait until everything queued so far has been sent
+    self.queue.join()
+
+  def _getAddress(self, vacmonHostPort):
+
+    (address, resolvedTime) = self.addresses.get(vacmonHostPort, (None, 0))
+
+    if address is None or resolvedTime < time.time() - self.resolveSeconds:
+      (vacmonHost, vacmonPort) = vacmonHostPort.split(':')
+      address = socket.getaddrinfo(vacmonHost, int(vacmonPort), socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+      self.addresses[vacmonHostPort] = (address, time.time())
+
+      if self.addressesFile:
+        vcycle.vacutils.createFile(self.addressesFile, json.dumps(self.addresses),
+                                   stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH,
+                                   '/var/lib/vcycle/tmp')
+
+    return address
+
+  def _sender(self):
+
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # Addresses resolved by earlier cycles, read here so it is done by this process
+    if self.addressesFile:
+      try:
+        for vacmonHostPort, (address, resolvedTime) in json.load(open(self.addressesFile, 'r')).iteritems():
+          self.addresses.setdefault(str(vacmonHostPort), ((str(address[0]), int(address[1])), resolvedTime))
+      except:
+        pass
+
+    while True:
+      (vacmonHostPort, datagram) = self.queue.get()
+
+      try:
+        self.sock.sendto(datagram, self._getAddress(vacmonHostPort))
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed sending VacMon message to ' + vacmonHostPort + ' (' + str(e) + ')')
+      finally:
+        self.queue.task_done()
 
 class MachineState:
   #
@@ -272,7 +416,8 @@ class Machine:
         self.getShutdownMessage()
 
         if self.shutdownMessage:
-          vcycle.vacutils.logLine('Machine ' + name + ' shuts down with message "' + self.shutdownMessage + '"')
+          vcycle.vacutils.logLine('Machine ' + name + ' shuts down with message "' + self.shutdownMessage + '"',
+                                  machine = name, machinetype = self.machinetypeName)
           try:
             shutdownCode = int(self.shutdownMessage.split(' ')[0])
           except:
@@ -329,18 +474,29 @@ class Machine:
     else:
       logHeartbeatTimeStr = '-'
 
-    vcycle.vacutils.logLine('= ' + name + ' in ' +
-                            str(self.spaceName) + ':' +
-                            (self.zone if self.zone else '') + ':' +
-                            str(self.machinetypeName) + ' ' +
-                            str(self.processors) + ' ' + self.ip + ' ' +
-                            self.state + ' ' +
-                            time.strftime("%b %d %H:%M:%S ", time.localtime(self.createdTime)) +
-                            logStartedTimeStr + ':' +
-                            logUpdatedTimeStr + ':' +
-                            logStoppedTimeStr + ':' +
-                            logHeartbeatTimeStr
-                           )
+    if vcycle.vacutils.logVerbosity < 1:
+      # Only log machines whose state changed since the last cycle
+      lastState = self.getFileContents('last_state')
+
+      if lastState != self.state and self.managedHere:
+        self.setFileContents('last_state', self.state)
+    else:
+      lastState = None
+
+    if lastState != self.state:
+      vcycle.vacutils.logLine('= ' + name + ' in ' +
+                              str(self.spaceName) + ':' +
+                              (self.zone if self.zone else '') + ':' +
+                              str(self.machinetypeName) + ' ' +
+                              str(self.processors) + ' ' + self.ip + ' ' +
+                              self.state + ' ' +
+                              time.strftime("%b %d %H:%M:%S ", time.localtime(self.createdTime)) +
+                              logStartedTimeStr + ':' +
+                              logUpdatedTimeStr + ':' +
+                              logStoppedTimeStr + ':' +
+                              logHeartbeatTimeStr,
+                              machine = name, machinetype = self.machinetypeName, state = self.state
+                             )
 
   def machineDir(self):
     return spaces[self.spaceName].machineDir(self.name)
@@ -362,8 +518,6 @@ class Machine:
     except:
       return
 
-    nowTime = time.localtime()
-
     userDN = ''
     for component in self.spaceName.split('.'):
       userDN = '/DC=' + component + userDN
@@ -392,8 +546,7 @@ class Machine:
     else:
       tmpGocdbSitename = '.'.join(self.spaceName.split('.')[1:]) if '.' in self.spaceName else self.spaceName
 
-    mesg = ('APEL-individual-job-message: v0.3\n' +
-            'Site: ' + tmpGocdbSitename + '\n' +
+    mesg = ('Site: ' + tmpGocdbSitename + '\n' +
             'SubmitHost: ' + self.spaceName + '/vcycle-' + os.uname()[1] + '\n' +
             'LocalJobId: ' + self.uuidStr + '\n' +
             'LocalUserId: ' + self.name + '\n' +
@@ -414,31 +567,12 @@ class Machine:
             'ServiceLevel: ' + str(self.hs06 if self.hs06 else 1.0) + '\n' +
             '%%\n')
 
-    fileName = time.strftime('%H%M%S', nowTime) + str(time.time() % 1)[2:][:8]
-
-    try:
-      os.makedirs(time.strftime('/var/lib/vcycle/apel-archive/%Y%m%d', nowTime), stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
-    except:
-      pass
-
-    try:
-      vcycle.vacutils.createFile(time.strftime('/var/lib/vcycle/apel-archive/%Y%m%d/', nowTime) + fileName, mesg, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vcycle/tmp')
-    except:
-      vcycle.vacutils.logLine('Failed creating ' + time.strftime('/var/lib/vcycle/apel-archive/%Y%m%d/', nowTime) + fileName)
-      return
-
-    if spaces[self.spaceName].gocdb_sitename:
-      # We only write to apel-outgoing if gocdb_sitename is set
-      try:
-        os.makedirs(time.strftime('/var/lib/vcycle/apel-outgoing/%Y%m%d', nowTime), stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
-      except:
-        pass
-
-      try:
-        vcycle.vacutils.createFile(time.strftime('/var/lib/vcycle/apel-outgoing/%Y%m%d/', nowTime) + fileName, mesg, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, '/var/lib/vcycle/tmp')
-      except:
-        vcycle.vacutils.logLine('Failed creating ' + time.strftime('/var/lib/vcycle/apel-outgoing/%Y%m%d/', nowTime) + fileName)
-        return
+    # Written with the other records of this cycle by writeApelSpool()
+    spaces[self.spaceName].apelSpool.append((mesg, { 'site'        : tmpGocdbSitename,
+                                                     'submit_host' : self.spaceName + '/vcycle-' + os.uname()[1],
+                                                     'machinetype' : self.machinetypeName,
+                                                     'local_job_id': self.uuidStr,
+                                                     'end_time'    : self.stoppedTime }))
 
   def sendMachineMessage(self, cookie = '0'):
     if not spaces[self.spaceName].vacmons:
@@ -501,18 +635,8 @@ class Machine:
     except:
       pass
 
-    messageJSON = json.dumps(messageDict)
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    for vacmonHostPort in spaces[self.spaceName].vacmons:
-      (vacmonHost, vacmonPort) = vacmonHostPort.split(':')
-
-      vcycle.vacutils.logLine('Sending VacMon machine finished message to %s:%s' % (vacmonHost, vacmonPort))
-
-      sock.sendto(messageJSON, (vacmonHost,int(vacmonPort)))
-
-    sock.close()
+    # Sent with the other messages of this cycle by sendMachineMessages()
+    spaces[self.spaceName].vacmonMachineMessages.append(messageDict)
 
   def getShutdownMessage(self):
 
@@ -530,10 +654,24 @@ class Machine:
        self.heartbeatTime = None
        return
 
+     heartbeatFile = spaces[self.spaceName].machinetypes[self.machinetypeName].heartbeat_file
+
+     # The heartbeat file itself must always exist
      try:
-       self.heartbeatTime = int(os.stat(self.machineDir() + '/joboutputs/' + spaces[self.spaceName].machinetypes[self.machinetypeName].heartbeat_file).st_ctime)
+       self.heartbeatTime = int(os.stat(self.machineDir() + '/joboutputs/' + heartbeatFile).st_ctime)
      except:
        self.heartbeatTime = None
+       return
+
+     # The time recorded by vcycle-wsgi or vcycle-cgi when the file was
+     # uploaded is only used if newer, as shared filesystems may cache ctime
+     try:
+       indexTime = spaces[self.spaceName].getHeartbeatIndex()[self.name][heartbeatFile]
+     except KeyError:
+       return
+
+     if indexTime > self.heartbeatTime:
+       self.heartbeatTime = indexTime
 
 class Machinetype:
 
@@ -783,6 +921,37 @@ class Machinetype:
       self.options['legacy_proxy'] = True
     else:
       self.options['legacy_proxy'] = False
+
+    if parser.has_option(machinetypeSectionName, 'bulk_create') and \
+       parser.get(machinetypeSectionName, 'bulk_create').lower() == 'true':
+      self.bulk_create = True
+    else:
+      self.bulk_create = False
+
+    try:
+      self.user_data_cache_seconds = int(parser.get(machinetypeSectionName, 'user_data_cache_seconds'))
+    except Exception as e:
+      self.user_data_cache_seconds = 600
+
+    try:
+      self.proxy_key_bits = int(parser.get(machinetypeSectionName, 'proxy_key_bits'))
+    except Exception as e:
+      self.proxy_key_bits = 1024
+
+    try:
+      self.proxy_key_pool = int(parser.get(machinetypeSectionName, 'proxy_key_pool'))
+    except Exception as e:
+      self.proxy_key_pool = 5
+
+    try:
+      self.volume_pool_seconds = int(parser.get(machinetypeSectionName, 'volume_pool_seconds'))
+    except Exception as e:
+      self.volume_pool_seconds = 0
+
+    try:
+      self.volume_pool_max = int(parser.get(machinetypeSectionName, 'volume_pool_max'))
+    except Exception as e:
+      self.volume_pool_max = 10
     
     # Just for this instance, so Total for this machinetype in one space
     self.totalMachines      = 0
@@ -793,6 +962,9 @@ class Machinetype:
     self.weightedMachines   = 0.0
     self.notPassedFizzle    = 0
 
+    # Set by the space if the machinetype's image is not yet available
+    self.imagePending       = False
+
   def setLastAbortTime(self, abortTime):
 
     if abortTime > self.lastAbortTime:
@@ -869,6 +1041,51 @@ class BaseSpace(object):
         raise VcycleError('Failed to check parse shutdown_time in ['
             + spaceSectionName + '] (' + str(e) + ')')
 
+    # Options controlling how each cycle's batch of deletions is carried out
+    try:
+      self.delete_threads = int(parser.get(spaceSectionName, 'delete_threads'))
+    except:
+      self.delete_threads = 5
+
+    try:
+      self.delete_per_second = float(parser.get(spaceSectionName, 'delete_per_second'))
+    except:
+      self.delete_per_second = None
+
+    try:
+      self.delete_retries = int(parser.get(spaceSectionName, 'delete_retries'))
+    except:
+      self.delete_retries = 2
+
+    try:
+      self.delete_retry_seconds = int(parser.get(spaceSectionName, 'delete_retry_seconds'))
+    except:
+      self.delete_retry_seconds = 5
+
+    try:
+      self.image_cache_gb = float(parser.get(spaceSectionName, 'image_cache_gb'))
+    except:
+      self.image_cache_gb = 50.0
+
+    try:
+      self.image_download_segments = int(parser.get(spaceSectionName, 'image_download_segments'))
+    except:
+      self.image_download_segments = 4
+
+    try:
+      self.apel_records_per_file = int(parser.get(spaceSectionName, 'apel_records_per_file'))
+    except:
+      self.apel_records_per_file = 100
+
+    # APEL records of machines which finished this cycle, for writeApelSpool()
+    self.apelSpool = []
+
+    # VacMon messages of machines which finished this cycle, for sendMachineMessages()
+    self.vacmonMachineMessages = []
+
+    # Upload times from the joboutputs receiver, read once per cycle by getHeartbeatIndex()
+    self.heartbeatIndex = None
+
     # First go through the vacuum_pipe sections for this space, creating
     # machinetype sections in the configuration on the fly
     for vacuumPipeSectionName in parser.sections():
@@ -916,6 +1133,11 @@ class BaseSpace(object):
     self.curl  = pycurl.Curl()
     self.token = None
 
+    # Curl handles cannot be shared between threads, so any worker threads
+    # get their own handle in httpRequest() while the main thread uses self.curl
+    self._threadCurl      = threading.local()
+    self._threadCurl.curl = self.curl
+
     # Dictionary of all the Vcycle-created VMs in this space: None in case failed to connect and do scan successfully
     self.machines = None
     
@@ -925,6 +1147,75 @@ class BaseSpace(object):
   def _expandVacuumPipe(self, parser, vacuumPipeSectionName, machinetypeNamePrefix, updatePipes):
     """ Read configuration settings from a vacuum pipe """
 
+    try:
+      vacuumPipeURL = parser.get(vacuumPipeSectionName, 'vacuum_pipe_url')
+    except:
+      raise VcycleError('Section vacuum_pipe ' + machinetypeNamePrefix + ' in space ' + spaceName + ' has no vacuum_pipe_url option!')
+
+    # This is the total in the local configuation, for this pipe and its machinetypes
+    try:
+      totalTargetShare = float(parser.get(vacuumPipeSectionName, 'target_share').strip())
+    except:
+      totalTargetShare = 0.0
+
+    try:
+      vacuumPipe = vcycle.vacutils.readPipe('/var/lib/vcycle/pipescache',
+                                            vacuumPipeURL,
+                                            'vcycle ' + vcycleVersion,
+                                            updatePipes = updatePipes)
+    except Exception as e:
+      raise VcycleError(vacuumPipeURL + ' given but failed reading/updating the pipe: ' + str(e))
+
+    # Options from the vacuum_pipe section are copied to all its machinetypes,
+    # except vacuum_pipe_url and target_share
+    localOptions = {}
+    for n,v in parser.items(vacuumPipeSectionName):
+      if n != 'vacuum_pipe_url' and n != 'target_share':
+        localOptions[n] = v
+
+    # The expanded machinetypes only change if the pipe or the local
+    # options change, so they are saved and reused by later cycles
+    expandedKey  = hashlib.sha1(json.dumps([ vcycleVersion, vacuumPipe, localOptions, totalTargetShare, self.spaceName, machinetypeNamePrefix ],
+                                           sort_keys = True)).hexdigest()
+    expandedFile = '/var/lib/vcycle/pipescache/' + urllib.quote(vacuumPipeURL, '') + '.' + self.spaceName + '.' + machinetypeNamePrefix + '.expanded'
+
+    try:
+      expanded = json.load(open(expandedFile, 'r'))
+      if expanded['key'] != expandedKey:
+        raise VcycleError('Out of date')
+    except:
+      expanded = { 'key'          : expandedKey,
+                   'machinetypes' : self._makePipeMachinetypes(vacuumPipe, vacuumPipeURL, totalTargetShare, localOptions) }
+
+      vcycle.vacutils.createFile(expandedFile, json.dumps(expanded),
+                                 stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH,
+                                 '/var/lib/vcycle/tmp')
+
+    machinetypePath = '/var/lib/vcycle/spaces/' + self.spaceName + '/machinetypes/' +  machinetypeNamePrefix
+
+    # Add the options to the machinetype sections unless they have already been
+    # given, since configuration file sections take precedence
+    for suffix, options in expanded['machinetypes'].iteritems():
+      sectionName = str('machinetype ' + self.spaceName + ' ' + machinetypeNamePrefix + '-' + suffix)
+
+      try:
+        parser.add_section(sectionName)
+      except:
+        # Ok if it already exists
+        pass
+
+      givenOptions = dict(parser.items(sectionName))
+      
+      for option, value in options.iteritems():
+        if str(option) not in givenOptions:
+          parser.set(sectionName, str(option), str(value))
+
+      # Record path to machinetype used to find the files on local disk
+      parser.set(sectionName, 'machinetype_path', machinetypePath)
+
+  def _makePipeMachinetypes(self, vacuumPipe, vacuumPipeURL, totalTargetShare, localOptions):
+    """ Return { suffix : { option : value } } for the valid machinetypes and options of a vacuum pipe """
+
     acceptedOptions = [
         'accounting_fqan',
         'backoff_seconds',
@@ -949,24 +1240,7 @@ class BaseSpace(object):
         'user_data_proxy'
         ]
 
-    try:
-      vacuumPipeURL = parser.get(vacuumPipeSectionName, 'vacuum_pipe_url')
-    except:
-      raise VcycleError('Section vacuum_pipe ' + machinetypeNamePrefix + ' in space ' + spaceName + ' has no vacuum_pipe_url option!')
-
-    # This is the total in the local configuation, for this pipe and its machinetypes
-    try:
-      totalTargetShare = float(parser.get(vacuumPipeSectionName, 'target_share').strip())
-    except:
-      totalTargetShare = 0.0
-
-    try:
-      vacuumPipe = vcycle.vacutils.readPipe('/var/lib/vcycle/pipescache',
-                                            vacuumPipeURL,
-                                            'vcycle ' + vcycleVersion,
-                                            updatePipes = updatePipes)
-    except Exception as e:
-      raise VcycleError(vacuumPipeURL + ' given but failed reading/updating the pipe: ' + str(e))
+    machinetypes = {}
 
     # This is the total in the remote pipe file, for the machinetypes it defines
     totalPipeTargetShare = 0.0
@@ -978,7 +1252,7 @@ class BaseSpace(object):
       except:
         pass
 
-    # Second pass to add options to the relevant machinetype sections
+    # Second pass to collect the options of each machinetype
     for pipeMachinetype in vacuumPipe['machinetypes']:
     
       if 'machine_model' in pipeMachinetype and str(pipeMachinetype['machine_model']) not in ['cernvm3','vm-raw']:
@@ -990,32 +1264,17 @@ class BaseSpace(object):
       except:
         vcycle.vacutils.logLine("suffix is missing from one machinetype within " + vacuumPipeURL + " - skipping!")
         continue
-                
-      try:
-        parser.add_section('machinetype ' + self.spaceName + ' ' + machinetypeNamePrefix + '-' + suffix)
-      except:
-        # Ok if it already exists
-        pass
 
-      # Copy almost all options from vacuum_pipe section to this new machinetype
-      # unless they have already been given. Skip vacuum_pipe_url and target_share                  
-      for n,v in parser.items(vacuumPipeSectionName):
-        if n != 'vacuum_pipe_url' and n != 'target_share' and \
-           not parser.has_option('machinetype ' + self.spaceName + ' ' + machinetypeNamePrefix + '-' + suffix, n):
-          parser.set('machinetype ' + self.spaceName + ' ' + machinetypeNamePrefix + '-' + suffix, n, v)
+      # Options from the vacuum_pipe section take precedence over the pipe
+      options = machinetypes.setdefault(suffix, {})
+      options.update(localOptions)
 
-      # Record path to machinetype used to find the files on local disk
-      parser.set('machinetype ' + self.spaceName + ' ' + machinetypeNamePrefix + '-' + suffix,
-                 'machinetype_path', '/var/lib/vcycle/spaces/' + self.spaceName + '/machinetypes/' +  machinetypeNamePrefix)      
-
-      # Go through vacuumPipe adding options if not already present from configuration files
+      # Go through vacuumPipe adding options if not already present
       for optionRaw in pipeMachinetype:
         option = str(optionRaw)
         value  = str(pipeMachinetype[optionRaw])
 
-        # Skip if option already exists for this machinetype - configuration 
-        # file sections take precedence
-        if parser.has_option('machinetype ' + self.spaceName + ' ' + machinetypeNamePrefix + '-' + suffix, option):
+        if option in options:
           continue
         
         # Deal with subdividing the total target share for this vacuum pipe here
@@ -1023,12 +1282,10 @@ class BaseSpace(object):
         # We do the normalisation of the pipe target_shares here
         if option == 'target_share':
           try:
-            targetShare = totalTargetShare * (float(value) / totalPipeTargetShare)
+            options['target_share'] = str(totalTargetShare * (float(value) / totalPipeTargetShare))
           except:
-            targetShare = 0.0
+            options['target_share'] = str(0.0)
 
-          parser.set('machinetype ' + self.spaceName + ' ' + machinetypeNamePrefix + '-' + suffix, 
-                     'target_share', str(targetShare))
           continue
 
         # Silently skip some options processed already
@@ -1068,9 +1325,10 @@ class BaseSpace(object):
              % (option, vacuumPipeURL))
           continue
           
-        # if all OK, then can set value as if from configuration files
-        parser.set('machinetype ' + self.spaceName + ' ' + machinetypeNamePrefix + '-' + suffix, 
-                   option, value)
+        # if all OK, then can use value as if from configuration files
+        options[option] = value
+
+    return machinetypes
 
   def findMachinesWithFile(self, fileName):
     # Return a list of machine names that have the given fileName (only used by EC2 plugin currently)
@@ -1137,6 +1395,14 @@ class BaseSpace(object):
     # - Attributes of the tag appear as key @attributename
     return self._xmlToDictRecursor(xml.etree.cElementTree.XML(xmlString))
 
+  def _getCurl(self):
+    # Return the curl handle for the current thread, creating one if necessary
+    try:
+      return self._threadCurl.curl
+    except AttributeError:
+      self._threadCurl.curl = pycurl.Curl()
+      return self._threadCurl.curl
+
   def httpRequest(self,
                   url, 			# HTTP(S) URL to contact
                   request = None, 	# = jsonRequest for compatibility
@@ -1144,51 +1410,56 @@ class BaseSpace(object):
                   formRequest = None,   # dictionary to be converted into HTML Form body, or body itself
                   headers = None, 	# request headers
                   verbose = False, 	# turn on Curl logging messages
-                  method = None, 	# DELETE, otherwise always GET/POST
+                  method = None, 	# DELETE or PUT, otherwise always GET/POST
                   anyStatus = False	# accept any HTTP status without exception, not just 2xx
                  ):
 
     # Returns dictionary:  { 'headers' : HEADERS, 'response' : DICTIONARY, 'raw' : string, 'status' : CURL RESPONSE CODE }
 
-    self.curl.unsetopt(pycurl.CUSTOMREQUEST)
-    self.curl.setopt(pycurl.URL, str(url))
-    self.curl.setopt(pycurl.USERAGENT, 'Vcycle ' + vcycleVersion)
+    curl = self._getCurl()
+
+    curl.unsetopt(pycurl.CUSTOMREQUEST)
+    curl.setopt(pycurl.URL, str(url))
+    curl.setopt(pycurl.USERAGENT, 'Vcycle ' + vcycleVersion)
 
     # backwards compatible
     if request:
       jsonRequest = request
 
     if method and method.upper() == 'DELETE':
-      self.curl.setopt(pycurl.CUSTOMREQUEST, 'DELETE')
+      curl.setopt(pycurl.CUSTOMREQUEST, 'DELETE')
     elif jsonRequest:
       try:
-        self.curl.setopt(pycurl.POSTFIELDS, json.dumps(jsonRequest))
+        curl.setopt(pycurl.POSTFIELDS, json.dumps(jsonRequest))
       except Exception as e:
         raise VcycleError('JSON encoding of "' + str(jsonRequest) + '" fails (' + str(e) + ')')
+
+      if method and method.upper() == 'PUT':
+        curl.setopt(pycurl.CUSTOMREQUEST, 'PUT')
     elif formRequest:
 
       if isinstance(formRequest, dict):
         # if formRequest is a dictionary then encode it
         try:
-          self.curl.setopt(pycurl.POSTFIELDS, urllib.urlencode(formRequest))
+          curl.setopt(pycurl.POSTFIELDS, urllib.urlencode(formRequest))
         except Exception as e:
           raise VcycleError('Form encoding of "' + str(formRequest) + '" fails (' + str(e) + ')')
       else:
         # otherwise assume formRequest is already formatted
         try:
-          self.curl.setopt(pycurl.POSTFIELDS, formRequest)
+          curl.setopt(pycurl.POSTFIELDS, formRequest)
         except Exception as e:
           raise VcycleError('Form encoding of "' + str(formRequest) + '" fails (' + str(e) + ')')
 
     else :
       # No body, just GET and headers
-      self.curl.setopt(pycurl.HTTPGET, True)
+      curl.setopt(pycurl.HTTPGET, True)
 
     outputBuffer = StringIO.StringIO()
-    self.curl.setopt(pycurl.WRITEFUNCTION, outputBuffer.write)
+    curl.setopt(pycurl.WRITEFUNCTION, outputBuffer.write)
 
     headersBuffer = StringIO.StringIO()
-    self.curl.setopt(pycurl.HEADERFUNCTION, headersBuffer.write)
+    curl.setopt(pycurl.HEADERFUNCTION, headersBuffer.write)
 
     # Set up the list of headers to send in the request
     allHeaders = []
@@ -1202,35 +1473,35 @@ class BaseSpace(object):
     if headers:
       allHeaders.extend(headers)
 
-    self.curl.setopt(pycurl.HTTPHEADER, allHeaders)
+    curl.setopt(pycurl.HTTPHEADER, allHeaders)
 
     if verbose:
-      self.curl.setopt(pycurl.VERBOSE, 2)
+      curl.setopt(pycurl.VERBOSE, 2)
     else:
-      self.curl.setopt(pycurl.VERBOSE, 0)
+      curl.setopt(pycurl.VERBOSE, 0)
 
-    self.curl.setopt(pycurl.TIMEOUT,        curlTimeOutSeconds)
-    self.curl.setopt(pycurl.FOLLOWLOCATION, False)
-    self.curl.setopt(pycurl.SSL_VERIFYPEER, 1)
-    self.curl.setopt(pycurl.SSL_VERIFYHOST, 2)
-    self.curl.setopt(pycurl.SSLVERSION,     pycurl.SSLVERSION_TLSv1)
+    curl.setopt(pycurl.TIMEOUT,        curlTimeOutSeconds)
+    curl.setopt(pycurl.FOLLOWLOCATION, False)
+    curl.setopt(pycurl.SSL_VERIFYPEER, 1)
+    curl.setopt(pycurl.SSL_VERIFYHOST, 2)
+    curl.setopt(pycurl.SSLVERSION,     pycurl.SSLVERSION_TLSv1)
 
     if hasattr(self, 'usercert') and hasattr(self, 'userkey') and self.usercert and self.userkey:
       if self.usercert[0] == '/':
-        self.curl.setopt(pycurl.SSLCERT, self.usercert)
+        curl.setopt(pycurl.SSLCERT, self.usercert)
       else :
-        self.curl.setopt(pycurl.SSLCERT, '/var/lib/vcycle/spaces/' + self.spaceName + '/' + self.usercert)
+        curl.setopt(pycurl.SSLCERT, '/var/lib/vcycle/spaces/' + self.spaceName + '/' + self.usercert)
 
       if self.userkey[0] == '/':
-        self.curl.setopt(pycurl.SSLKEY, self.userkey)
+        curl.setopt(pycurl.SSLKEY, self.userkey)
       else :
-        self.curl.setopt(pycurl.SSLKEY, '/var/lib/vcycle/spaces/' + self.spaceName + '/' + self.userkey)
+        curl.setopt(pycurl.SSLKEY, '/var/lib/vcycle/spaces/' + self.spaceName + '/' + self.userkey)
 
     if os.path.isdir('/etc/grid-security/certificates'):
-      self.curl.setopt(pycurl.CAPATH, '/etc/grid-security/certificates')
+      curl.setopt(pycurl.CAPATH, '/etc/grid-security/certificates')
 
     try:
-      self.curl.perform()
+      curl.perform()
     except Exception as e:
       raise VcycleError('Failed to read ' + url + ' (' + str(e) + ')')
 
@@ -1282,15 +1553,15 @@ class BaseSpace(object):
       response = None
 
     # If not a 2xx code then raise an exception unless anyStatus option given
-    if not anyStatus and self.curl.getinfo(pycurl.RESPONSE_CODE) / 100 != 2:
+    if not anyStatus and curl.getinfo(pycurl.RESPONSE_CODE) / 100 != 2:
       try:
         vcycle.vacutils.logLine('Query raw response: ' + str(outputBuffer.getvalue()))
       except:
         pass
 
-      raise VcycleError('Query of ' + url + ' returns HTTP code ' + str(self.curl.getinfo(pycurl.RESPONSE_CODE)))
+      raise VcycleError('Query of ' + url + ' returns HTTP code ' + str(curl.getinfo(pycurl.RESPONSE_CODE)))
 
-    return { 'headers' : outputHeaders, 'response' : response, 'raw' : str(outputBuffer.getvalue()), 'status' : self.curl.getinfo(pycurl.RESPONSE_CODE) }
+    return { 'headers' : outputHeaders, 'response' : response, 'raw' : str(outputBuffer.getvalue()), 'status' : curl.getinfo(pycurl.RESPONSE_CODE) }
 
   def _deleteOneMachine(self, machineName, shutdownMessage = None):
 
@@ -1311,6 +1582,11 @@ class BaseSpace(object):
 
   def deleteMachines(self):
     # Delete machines in this space. We do not update totals here: next cycle is good enough.
+    # Machines to delete are collected into a batch of (priority, machineName, shutdownMessage)
+    # and then deleted concurrently, with lower priority values going first: stuck starting
+    # machines, then expired machines, then routine cleanups of machines already stopped.
+
+    deletions = []
 
     for machineName,machine in self.machines.iteritems():
 
@@ -1328,20 +1604,20 @@ class BaseSpace(object):
           (self.maxStartingSeconds and
            machine.createdTime < int(time.time()) - self.maxStartingSeconds)):
         # We try to delete failed-to-start machines after maxStartingSeconds (default 3600)
-        self._deleteOneMachine(machineName, '700 Failed to start')
+        deletions.append((0, machineName, '700 Failed to start'))
 
       elif machine.state == MachineState.failed or \
            machine.state == MachineState.shutdown or \
            machine.state == MachineState.deleting:
         # Delete non-starting, non-running machines
-        self._deleteOneMachine(machineName)
+        deletions.append((4, machineName, None))
 
       elif machine.state == MachineState.running and \
            machine.machinetypeName in self.machinetypes and \
            machine.startedTime and \
            (int(time.time()) > (machine.startedTime + self.machinetypes[machine.machinetypeName].max_wallclock_seconds)):
         vcycle.vacutils.logLine(machineName + ' exceeded max_wallclock_seconds')
-        self._deleteOneMachine(machineName, '700 Exceeded max_wallclock_seconds')
+        deletions.append((1, machineName, '700 Exceeded max_wallclock_seconds'))
 
       elif machine.state == MachineState.running and \
            machine.machinetypeName in self.machinetypes and \
@@ -1360,7 +1636,7 @@ class BaseSpace(object):
                                 ', < ' + 
                                 str(int(time.time()) - self.machinetypes[machine.machinetypeName].heartbeat_seconds) + 
                                 ')')
-        self._deleteOneMachine(machineName, '700 Heartbeat file not updated')
+        deletions.append((2, machineName, '700 Heartbeat file not updated'))
 
       # Check shutdown times
       elif machine.state == MachineState.running and \
@@ -1376,7 +1652,24 @@ class BaseSpace(object):
             vcycle.vacutils.logLine(
                 'shutdown time ({}) for machine {} has passed'
                 .format(shutdowntime, machineName))
-          self._deleteOneMachine(machineName, '700 Passed shutdowntime')
+          deletions.append((3, machineName, '700 Passed shutdowntime'))
+
+    if not deletions:
+      return
+
+    deletions.sort(key = lambda deletion: deletion[0])
+
+    vcycle.vacutils.logLine('Deleting %d machine(s) in %s with up to %d thread(s)' % (len(deletions), self.spaceName, self.delete_threads))
+
+    failedDeletions = runConcurrently([ ('Deleting ' + machineName, self._deleteOneMachine, (machineName, shutdownMessage))
+                                        for (priority, machineName, shutdownMessage) in deletions ],
+                                      numThreads   = self.delete_threads,
+                                      perSecond    = self.delete_per_second,
+                                      retries      = self.delete_retries,
+                                      retrySeconds = self.delete_retry_seconds)
+
+    if failedDeletions:
+      vcycle.vacutils.logLine('%d deletion(s) in %s failed this cycle' % (len(failedDeletions), self.spaceName))
 
   def moveMachineDirectories(self):
     """ Go through /var/lib/vcycle/shared/spaces/SPACENAME/current/, moving directory trees
@@ -1454,6 +1747,17 @@ class BaseSpace(object):
           machine.setFileContents('manager_heartbeat', str(int(time.time())))
           vcycle.vacutils.logLine('Have taken ' + machineName + ' in ' + self.spaceName + ' from manager ' + str(machine.manager))
           
+  def getHeartbeatIndex(self):
+    # Read the heartbeat index of this space once per cycle
+    if self.heartbeatIndex is None:
+      try:
+        self.heartbeatIndex = vcycle.vacutils.readHeartbeatIndex('/var/lib/vcycle/shared/heartbeats/' + self.spaceName)
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed to read heartbeat index for ' + self.spaceName + ' (' + str(e) + ')')
+        self.heartbeatIndex = {}
+
+    return self.heartbeatIndex
+
   def createHeartbeatMachines(self):
     # Create a list of machines in each machinetype, to be populated
     # with machine names of machines with a current heartbeat
@@ -1489,37 +1793,30 @@ class BaseSpace(object):
         fileContents.append('%d %s %s\n' 
                         % (self.machines[machineName].heartbeatTime, machineName, self.machines[machineName].ip))
 
-      # Sort the list by heartbeat time, newest first, then write as a file
+      # Sort the list by heartbeat time, newest first
       fileContents.sort(reverse=True)
-      vcycle.vacutils.createFile('/var/lib/vcycle/shared/spaces/' + self.spaceName + '/heartbeatlists/' + machinetypeName, ''.join(fileContents), 0664, '/var/lib/vcycle/shared/tmp')
-      
-  def makeFactoryMessage(self, cookie = '0'):
-    factoryHeartbeatTime = int(time.time())
-
-    try:
-      mjfHeartbeatTime = int(os.stat('/var/log/httpd/https-vcycle.log').st_ctime)
-      metadataHeartbeatTime = mjfHeartbeatTime
-    except:
-      mjfHeartbeatTime = 0
-      metadataHeartbeatTime = 0
 
-    try:
-      bootTime = int(time.time() - float(open('/proc/uptime','r').readline().split()[0]))
-    except:
-      bootTime = 0
+      # Only write the file if the machines or their order have changed,
+      # or the times in it are more than heartbeat_seconds out of date
+      heartbeatListPath = '/var/lib/vcycle/shared/spaces/' + self.spaceName + '/heartbeatlists/' + machinetypeName
 
-    daemonDiskStatFS  = os.statvfs('/var/lib/vcycle')
-    rootDiskStatFS = os.statvfs('/tmp')
-
-    memory = vcycle.vacutils.memInfo()
-
-    try:
-      osIssue = open('/etc/issue.vac','r').readline().strip()
-    except:
       try:
-        osIssue = open('/etc/issue','r').readline().strip()
+        oldContents = open(heartbeatListPath, 'r').readlines()
+        listAge     = int(time.time() - os.stat(heartbeatListPath).st_mtime)
       except:
-        osIssue = os.uname()[2]
+        pass
+      else:
+        if [ line.split()[1:] for line in oldContents ] == [ line.split()[1:] for line in fileContents ] and \
+           (not fileContents or listAge < self.machinetypes[machinetypeName].heartbeat_seconds):
+          continue
+
+      vcycle.vacutils.createFile(heartbeatListPath, ''.join(fileContents), 0664, '/var/lib/vcycle/shared/tmp')
+      
+  def makeFactoryMessage(self, cookie = '0'):
+    factoryHeartbeatTime = int(time.time())
+
+    telemetry = getHostTelemetry()
+    memory    = telemetry['memory']
 
     if spaces[self.spaceName].gocdb_sitename:
       tmpGocdbSitename = spaces[self.spaceName].gocdb_sitename
@@ -1533,7 +1830,7 @@ class BaseSpace(object):
                 'cookie'                   : cookie,
                 'space'                    : self.spaceName,
                 'site'                     : tmpGocdbSitename,
-                'factory'                  : os.uname()[1],
+                'factory'                  : telemetry['factory'],
                 'time_sent'                : int(time.time()),
 
                 'running_processors'       : self.runningProcessors,
@@ -1542,25 +1839,33 @@ class BaseSpace(object):
                 'max_processors'           : self.processors_limit,
                 'max_machines'             : self.processors_limit,
 
-                'root_disk_avail_kb'       : (rootDiskStatFS.f_bavail * rootDiskStatFS.f_frsize) / 1024,
-                'root_disk_avail_inodes'   : rootDiskStatFS.f_favail,
+                'root_disk_avail_kb'       : telemetry['root_disk_avail_kb'],
+                'root_disk_avail_inodes'   : telemetry['root_disk_avail_inodes'],
 
-                'daemon_disk_avail_kb'      : (daemonDiskStatFS.f_bavail *  daemonDiskStatFS.f_frsize) / 1024,
-                'daemon_disk_avail_inodes'  : daemonDiskStatFS.f_favail,
+                'daemon_disk_avail_kb'      : telemetry['daemon_disk_avail_kb'],
+                'daemon_disk_avail_inodes'  : telemetry['daemon_disk_avail_inodes'],
 
-                'load_average'             : vcycle.vacutils.loadAvg(2),
-                'kernel_version'           : os.uname()[2],
-                'os_issue'                 : osIssue,
-                'boot_time'                : bootTime,
+                'load_average'             : telemetry['load_average'],
+                'kernel_version'           : telemetry['kernel_version'],
+                'os_issue'                 : telemetry['os_issue'],
+                'boot_time'                : telemetry['boot_time'],
                 'factory_heartbeat_time'   : factoryHeartbeatTime,
-                'mjf_heartbeat_time'       : mjfHeartbeatTime,
-                'metadata_heartbeat_time'  : metadataHeartbeatTime,
+                'mjf_heartbeat_time'       : telemetry['mjf_heartbeat_time'],
+                'metadata_heartbeat_time'  : telemetry['mjf_heartbeat_time'],
                 'swap_used_kb'             : memory['SwapTotal'] - memory['SwapFree'],
                 'swap_free_kb'             : memory['SwapFree'],
                 'mem_used_kb'              : memory['MemTotal'] - memory['MemFree'],
                 'mem_total_kb'             : memory['MemTotal']
                   }
 
+    for name in ['iowait_percent', 'shared_fs_latency_ms']:
+      if name in telemetry:
+        messageDict[name] = telemetry[name]
+
+    for name in telemetry:
+      if name.startswith('pressure_'):
+        messageDict[name] = telemetry[name]
+
     if self.runningHS06 is not None:
       messageDict['max_hs06']     = self.runningHS06
       messageDict['running_hs06'] = self.runningHS06
@@ -1639,22 +1944,64 @@ class BaseSpace(object):
     if not self.vacmons:
       return
 
-    factoryMessage      = self.makeFactoryMessage()
-    machinetypeMessages = self.makeMachinetypeMessages()
+    vcycle.vacutils.logLine('Sending VacMon status messages to ' + ' '.join(self.vacmons))
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    vacmonSender.send(self.vacmons, [ self.makeFactoryMessage() ] + self.makeMachinetypeMessages())
 
-    for vacmonHostPort in self.vacmons:
-      (vacmonHost, vacmonPort) = vacmonHostPort.split(':')
+  def sendMachineMessages(self):
+    # Send the VacMon messages of machines which finished this cycle. With
+    # vacmon_batch_machines, messages are combined into datagrams of up to
+    # vacmonDatagramBytes, giving the fields common to all the machines once
+    # and the rest in a list of machines, with num_machines set to its length
+
+    if not self.vacmons or not self.vacmonMachineMessages:
+      self.vacmonMachineMessages = []
+      return
 
-      vcycle.vacutils.logLine('Sending VacMon status messages to %s:%s' % (vacmonHost, vacmonPort))
+    if not self.vacmon_batch_machines:
+      datagrams = [ json.dumps(messageDict) for messageDict in self.vacmonMachineMessages ]
+    else:
+      commonKeys = [ 'message_type', 'daemon_version', 'vacquery_version', 'cookie',
+                     'space', 'site', 'factory', 'time_sent' ]
+      datagrams  = []
+      batch      = None
+
+      for messageDict in self.vacmonMachineMessages:
+        machineDict = dict([ (key, value) for (key, value) in messageDict.iteritems()
+                             if key not in commonKeys and key != 'num_machines' ])
+
+        if batch is not None:
+          batch['machines'].append(machineDict)
+          batch['num_machines'] += 1
+
+          if len(json.dumps(batch)) <= vacmonDatagramBytes:
+            continue
+
+          # Too big with this machine, so send the batch without it
+          batch['machines'].pop()
+          batch['num_machines'] -= 1
+          datagrams.append(json.dumps(batch))
+
+        batch = dict([ (key, messageDict[key]) for key in commonKeys if key in messageDict ])
+        batch['num_machines'] = 1
+        batch['machines']     = [ machineDict ]
+
+      datagrams.append(json.dumps(batch))
+
+    vcycle.vacutils.logLine('Sending %d VacMon machine finished messages in %d datagrams to %s'
+                            % (len(self.vacmonMachineMessages), len(datagrams), ' '.join(self.vacmons)))
 
-      sock.sendto(factoryMessage, (vacmonHost,int(vacmonPort)))
+    vacmonSender.send(self.vacmons, datagrams)
+    self.vacmonMachineMessages = []
 
-      for machinetypeMessage in machinetypeMessages:
-        sock.sendto(machinetypeMessage, (vacmonHost,int(vacmonPort)))
+  def _logSkip(self, skipsLogged, machinetypeName, text):
+    # Log why a machinetype was skipped in a makeMachines() pass. With
+    # log_verbosity 0, only the first reason each cycle is logged
+    if vcycle.vacutils.logVerbosity < 1 and machinetypeName in skipsLogged:
+      return
 
-    sock.close()
+    skipsLogged.add(machinetypeName)
+    vcycle.vacutils.logLine(text, machinetype = machinetypeName)
 
   def makeMachines(self):
 
@@ -1682,20 +2029,27 @@ class BaseSpace(object):
                               ' running processors out of ' + str(machinetype.totalProcessors) +
                               ' found in any state. ' + str(machinetype.notPassedFizzle) +
                               ' not passed fizzle_seconds(' + str(machinetype.fizzle_seconds) +
-                              '). ')
+                              '). ', machinetype = machinetypeName)
 
     creationsPerCycle  = int(0.9999999 + self.processors_limit * 0.1)
     creationsThisCycle = 0
 
+    # Machines of bulk_create machinetypes are counted during the passes
+    # and then requested together for each machinetype afterwards
+    bulkCreations = {}
+
+    # Machinetypes skipped in a pass so far, for _logSkip()
+    skipsLogged = set()
+
     # Keep making passes through the machinetypes until limits exhausted
     while True:
       if self.processors_limit is not None and self.totalProcessors >= self.processors_limit:
         vcycle.vacutils.logLine('Reached limit (%d) on number of processors to allocate for space %s' % (self.processors_limit, self.spaceName))
-        return
+        break
 
       if creationsThisCycle >= creationsPerCycle:
         vcycle.vacutils.logLine('Already reached limit of %d processor allocations this cycle' % creationsThisCycle )
-        return
+        break
 
       # For each pass, machinetypes are visited in a random order
       machinetypeNames = self.machinetypes.keys()
@@ -1708,46 +2062,57 @@ class BaseSpace(object):
         if self.machinetypes[machinetypeName].target_share <= 0.0:
           continue
 
+        if self.machinetypes[machinetypeName].imagePending:
+          self._logSkip(skipsLogged, machinetypeName, 'Image for machinetype ' + machinetypeName + ' is pending, so not creating machines')
+          continue
+
         if self.machinetypes[machinetypeName].processors_limit is not None and self.machinetypes[machinetypeName].totalProcessors >= self.machinetypes[machinetypeName].processors_limit:
-          vcycle.vacutils.logLine('Reached limit (' + str(self.machinetypes[machinetypeName].processors_limit) + ') on number of processors to allocate for machinetype ' + machinetypeName)
+          self._logSkip(skipsLogged, machinetypeName, 'Reached limit (' + str(self.machinetypes[machinetypeName].processors_limit) + ') on number of processors to allocate for machinetype ' + machinetypeName)
           continue
 
         if self.machinetypes[machinetypeName].max_starting_processors is not None and self.machinetypes[machinetypeName].startingProcessors >= self.machinetypes[machinetypeName].max_starting_processors:
-          vcycle.vacutils.logLine('Reached limit (%d) on processors that can be in starting state for machinetype %s' % (self.machinetypes[machinetypeName].max_starting_processors, machinetypeName))
+          self._logSkip(skipsLogged, machinetypeName, 'Reached limit (%d) on processors that can be in starting state for machinetype %s' % (self.machinetypes[machinetypeName].max_starting_processors, machinetypeName))
           continue
 
         if int(time.time()) < (self.machinetypes[machinetypeName].lastAbortTime + self.machinetypes[machinetypeName].backoff_seconds):
-          vcycle.vacutils.logLine('Free capacity found for %s ... but only %d seconds after last abort'
-                                  % (machinetypeName, int(time.time()) - self.machinetypes[machinetypeName].lastAbortTime) )
+          self._logSkip(skipsLogged, machinetypeName, 'Free capacity found for %s ... but only %d seconds after last abort'
+                                                      % (machinetypeName, int(time.time()) - self.machinetypes[machinetypeName].lastAbortTime) )
           continue
 
         if (int(time.time()) < (self.machinetypes[machinetypeName].lastAbortTime +
                                 self.machinetypes[machinetypeName].backoff_seconds +
                                 self.machinetypes[machinetypeName].fizzle_seconds)) and \
            (self.machinetypes[machinetypeName].notPassedFizzle > 0):
-          vcycle.vacutils.logLine('Free capacity found for ' +
-                                  machinetypeName +
-                                  ' ... but still within fizzle_seconds+backoff_seconds(' +
-                                  str(int(self.machinetypes[machinetypeName].backoff_seconds + self.machinetypes[machinetypeName].fizzle_seconds)) +
-                                  ') of last abort (' +
-                                  str(int(time.time()) - self.machinetypes[machinetypeName].lastAbortTime) +
-                                  's ago) and ' +
-                                  str(self.machinetypes[machinetypeName].notPassedFizzle) +
-                                  ' starting/running but not yet passed fizzle_seconds (' +
-                                  str(self.machinetypes[machinetypeName].fizzle_seconds) + ')')
+          self._logSkip(skipsLogged, machinetypeName, 'Free capacity found for ' +
+                                                      machinetypeName +
+                                                      ' ... but still within fizzle_seconds+backoff_seconds(' +
+                                                      str(int(self.machinetypes[machinetypeName].backoff_seconds + self.machinetypes[machinetypeName].fizzle_seconds)) +
+                                                      ') of last abort (' +
+                                                      str(int(time.time()) - self.machinetypes[machinetypeName].lastAbortTime) +
+                                                      's ago) and ' +
+                                                      str(self.machinetypes[machinetypeName].notPassedFizzle) +
+                                                      ' starting/running but not yet passed fizzle_seconds (' +
+                                                      str(self.machinetypes[machinetypeName].fizzle_seconds) + ')')
           continue
 
         if (not bestMachinetypeName) or (self.machinetypes[machinetypeName].weightedMachines < self.machinetypes[bestMachinetypeName].weightedMachines):
           bestMachinetypeName = machinetypeName
 
       if bestMachinetypeName:
-        vcycle.vacutils.logLine('Free capacity found for ' + bestMachinetypeName + ' within ' + self.spaceName + ' ... creating')
+        vcycle.vacutils.logLine('Free capacity found for ' + bestMachinetypeName + ' within ' + self.spaceName + ' ... creating',
+                                machinetype = bestMachinetypeName)
 
         # This tracks creation attempts, whether successful or not
         creationsThisCycle += self.machinetypes[bestMachinetypeName].min_processors
         self.machinetypes[bestMachinetypeName].startingProcessors += self.machinetypes[bestMachinetypeName].min_processors
         self.machinetypes[bestMachinetypeName].notPassedFizzle += 1
 
+        if self.machinetypes[bestMachinetypeName].bulk_create:
+          # Count it now so the limits apply, but create it after the passes
+          self._reserveMachines(bestMachinetypeName, 1)
+          bulkCreations[bestMachinetypeName] = bulkCreations.get(bestMachinetypeName, 0) + 1
+          continue
+
         try:
           self._createMachine(bestMachinetypeName)
         except Exception as e:
@@ -1755,16 +2120,213 @@ class BaseSpace(object):
 
       else:
         vcycle.vacutils.logLine('No more free capacity and/or suitable machinetype found within ' + self.spaceName)
-        return
+        break
+
+    for machinetypeName,numMachines in bulkCreations.iteritems():
+      # The new Machine objects will count themselves when they are created
+      self._reserveMachines(machinetypeName, -numMachines)
+
+      try:
+        self._createMachines(machinetypeName, numMachines)
+      except Exception as e:
+        vcycle.vacutils.logLine('Failed creating %d machines with machinetype %s in %s (%s)' % (numMachines, machinetypeName, self.spaceName, str(e)))
+
+  def _reserveMachines(self, machinetypeName, numMachines):
+    # Add (or remove if negative) numMachines of the given machinetype to the totals
+    # used for limits and target shares, as if they had already been created
+
+    processors = numMachines * self.machinetypes[machinetypeName].min_processors
+
+    self.totalMachines   += numMachines
+    self.totalProcessors += processors
+
+    self.machinetypes[machinetypeName].totalMachines   += numMachines
+    self.machinetypes[machinetypeName].totalProcessors += processors
+
+    if self.machinetypes[machinetypeName].target_share > 0.0:
+      self.machinetypes[machinetypeName].weightedMachines += (float(processors) / self.machinetypes[machinetypeName].target_share)
 
   def _createMachine(self, machinetypeName):
     """Generic machine creation"""
 
-    try:
-      machineName = self.machinetypes[machinetypeName].makeMachineName()
+    if self.zones:
+      zone = random.choice(self.zones)
+    else:
+      zone = None
+
+    try:
+      machineName = self.machinetypes[machinetypeName].makeMachineName()
     except Exception as e:
       vcycle.vacutils.logLine('Failed constructing new machine name (' + str(e) + ')')
 
+    self._prepareMachine(machineName, machinetypeName, zone)
+
+    # Call the API-specific method to actually create the machine
+    try:
+      self.createMachine(machineName, machinetypeName, zone)
+    except Exception as e:
+      vcycle.vacutils.logLine('Creation of machine %s fails with: %s' % (machineName, str(e)))
+
+    self._finishMachine(machineName, machinetypeName)
+
+  def _createMachines(self, machinetypeName, numMachines):
+    """Generic creation of several machines of one machinetype with a single request"""
+
+    if self.zones:
+      zone = random.choice(self.zones)
+    else:
+      zone = None
+
+    # Multi-instance APIs name the instances BASENAME-1 ... BASENAME-N by default
+    baseName     = self.machinetypes[machinetypeName].makeMachineName()
+    machineNames = [ baseName + '-' + str(i + 1) for i in range(numMachines) ]
+
+    userDataContents = self._prepareMachine(machineNames[0], machinetypeName, zone)
+
+    if numMachines == 1 or \
+       self._userDataPerMachine(machinetypeName) or \
+       machineNames[0] in userDataContents:
+      # All the machines are given the same user_data, so if it contains values
+      # specific to the first machine we fall back to creating them one by one
+      if numMachines > 1:
+        vcycle.vacutils.logLine('user_data for ' + machinetypeName + ' contains per-machine values so not using bulk creation')
+
+      try:
+        self.createMachine(machineNames[0], machinetypeName, zone)
+      except Exception as e:
+        vcycle.vacutils.logLine('Creation of machine %s fails with: %s' % (machineNames[0], str(e)))
+
+      self._finishMachine(machineNames[0], machinetypeName)
+
+      for i in range(numMachines - 1):
+        try:
+          self._createMachine(machinetypeName)
+        except Exception as e:
+          vcycle.vacutils.logLine('Failed creating machine with machinetype ' + machinetypeName + ' in ' + self.spaceName + ' (' + str(e) + ')')
+
+      return
+
+    for machineName in machineNames[1:]:
+      self._prepareMachine(machineName, machinetypeName, zone, userDataContents)
+
+    # Call the API-specific method to create all the machines at once
+    try:
+      self.createMachines(machineNames, machinetypeName, zone)
+    except Exception as e:
+      vcycle.vacutils.logLine('Creation of %d machines %s-* fails with: %s' % (numMachines, baseName, str(e)))
+
+    for machineName in machineNames:
+      # Machines the API did not create are tidied up by moveMachineDirectories() next cycle
+      if machineName in self.machines:
+        self._finishMachine(machineName, machinetypeName)
+
+  def _userDataPerMachine(self, machinetypeName):
+    """True if each machine of this machinetype needs its own user_data"""
+
+    # Each machine must get its own proxy, even if the template does not use it yet
+    if self.machinetypes[machinetypeName].options['user_data_proxy']:
+      return True
+
+    # Already compiled and cached by _makeUserData()
+    template = vcycle.vacutils.getUserDataTemplate(self.machinetypes[machinetypeName].user_data,
+                                                   self.machinetypes[machinetypeName].machinetype_path,
+                                                   'Vcycle ' + vcycleVersion,
+                                                   '/var/lib/vcycle/userdatacache',
+                                                   self.machinetypes[machinetypeName].user_data_cache_seconds,
+                                                   '/var/lib/vcycle/tmp')
+
+    return bool(template.placeholders & vcycle.vacutils.perMachineUserDataPlaceholders)
+
+  def writeApelSpool(self):
+    # Write the APEL records collected this cycle as multi-record files
+
+    if not self.apelSpool:
+      return
+
+    try:
+      numRecords = vcycle.vacutils.writeApelRecords('/var/lib/vcycle',
+                                                    self.apelSpool,
+                                                    self.apel_records_per_file,
+                                                    bool(self.gocdb_sitename),
+                                                    '/var/lib/vcycle/tmp')
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed writing APEL records for ' + self.spaceName + ' (' + str(e) + ')')
+    else:
+      vcycle.vacutils.logLine('Wrote %d of %d APEL records for %s' % (numRecords, len(self.apelSpool), self.spaceName))
+
+    self.apelSpool = []
+
+  def advanceMachines(self):
+    # Called after deleteMachines(). APIs which create machines in several
+    # stages over more than one cycle can move them on to the next stage here
+    pass
+
+  def scanOneMachine(self, machineName):
+    # Find just one machine and add it to self.machines, for recycleMachines().
+    # APIs which can look up a single machine cheaply should override this
+    raise VcycleError('Checking single machines is not supported by ' + self.api)
+
+  def recycleMachines(self, machineNames):
+    # Check just the given machines, which have written shutdown messages,
+    # without scanning the whole space, and delete any which have stopped
+    # so their capacity can be reused by the next cycle. Accounting records
+    # are made as usual when their Machine objects find them stopped.
+    # Returns the number of machines deleted
+
+    self.machines = {}
+
+    try:
+      for machineName in machineNames:
+        self.scanOneMachine(machineName)
+    finally:
+      self.writeApelSpool()
+
+      try:
+        self.sendMachineMessages()
+      except Exception as e:
+        vcycle.vacutils.logLine('Sending VacMon machine messages fails: ' + str(e))
+
+    numDeleted = 0
+
+    for machineName,machine in self.machines.iteritems():
+      if machine.managedHere and \
+         not machine.deletedTime and \
+         machine.state in (MachineState.shutdown, MachineState.failed):
+        try:
+          self._deleteOneMachine(machineName)
+          numDeleted += 1
+        except Exception as e:
+          vcycle.vacutils.logLine('Deleting ' + machineName + ' fails: ' + str(e))
+
+    return numDeleted
+
+  def collectGarbage(self):
+    # Called near the end of each cycle. APIs can remove resources such
+    # as old images or volumes left behind by Vcycle here
+    pass
+
+  def prepareImages(self):
+    # Called before makeMachines(). APIs which upload images can start
+    # uploads here and set imagePending on machinetypes still waiting
+    pass
+
+  def startBackgroundTasks(self):
+    # Called by vcycled at the end of the cycle, once its other threads have
+    # finished. APIs can fork processes which outlive the cycle here, such as
+    # image uploads, as forking while other threads are running is unsafe
+    pass
+
+  def createMachines(self, machineNames, machinetypeName, zone = None):
+    # Default for APIs without multi-instance creation: request each machine separately
+    for machineName in machineNames:
+      try:
+        self.createMachine(machineName, machinetypeName, zone)
+      except Exception as e:
+        vcycle.vacutils.logLine('Creation of machine %s fails with: %s' % (machineName, str(e)))
+
+  def _prepareMachine(self, machineName, machinetypeName, zone, userDataContents = None):
+    """Create the directory and files of a new machine before it is requested, returning its user_data"""
+
     try:
       shutil.rmtree(self.machineDir(machineName))
       vcycle.vacutils.logLine('Found and deleted left over ' + self.machineDir(machineName))
@@ -1788,11 +2350,33 @@ class BaseSpace(object):
     if self.machinetypes[machinetypeName].https_x509dn:
       self.setFileContents(machineName, 'https_x509dn', self.machinetypes[machinetypeName].https_x509dn, mode=0644)
     
-    if self.zones:
-      zone = random.choice(self.zones)
+    if zone:
       self.setFileContents(machineName, 'zone', zone)
+
+    if userDataContents is None:
+      userDataContents = self._makeUserData(machineName, machinetypeName)
+
+    try:
+      self.setFileContents(machineName, 'user_data', userDataContents)
+    except:
+      raise VcycleError('Failed to writing ' + machineName + '/user_data')
+
+    # Create MJF shutdowntime values as these are used in deleting failed machines
+
+    # check for existence of shutdownTime and whether wallclock limit is closer anyway
+    if (self.shutdownTime is None or
+        int(time.time()) + self.machinetypes[machinetypeName].maxWallclockSeconds < self.shutdownTime):
+      self.setFileContents(machineName,'machinefeatures/shutdowntime',
+                                str(int(time.time()) + self.machinetypes[machinetypeName].max_wallclock_seconds), mode = 0644)
+
     else:
-      zone = None
+      self.setFileContents(machineName,'machinefeatures/shutdowntime', str(self.shutdownTime), mode = 0644)
+      self.setFileContents(machineName,'jobfeatures/shutdowntime_job', str(self.shutdownTime), mode = 0644)
+
+    return userDataContents
+
+  def _makeUserData(self, machineName, machinetypeName):
+    """Make the user_data contents for a new machine"""
 
     if self.machinetypes[machinetypeName].root_image and (self.machinetypes[machinetypeName].root_image.startswith('http://') or self.machinetypes[machinetypeName].root_image.startswith('https://')):
       rootImageURL = self.machinetypes[machinetypeName].root_image
@@ -1842,35 +2426,20 @@ class BaseSpace(object):
                                                         jobfeaturesURL       = 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/jobfeatures',
                                                         joboutputsURL        = 'https://' + self.https_host + ':' + str(self.https_port) + '/machines/' + self.spaceName + '/' + machineName + '/joboutputs',
                                                         heartbeatMachinesURL = 'https://' + self.https_host + ':' + str(self.https_port) + '/heartbeatlists/' + self.spaceName,
-                                                        gocdbSitename        =  spaces[self.spaceName].gocdb_sitename
+                                                        gocdbSitename        =  spaces[self.spaceName].gocdb_sitename,
+                                                        userDataCache        = '/var/lib/vcycle/userdatacache',
+                                                        cacheSeconds         = self.machinetypes[machinetypeName].user_data_cache_seconds,
+                                                        tmpDir               = '/var/lib/vcycle/tmp',
+                                                        keyPoolDir           = '/var/lib/vcycle/keypool' if self.machinetypes[machinetypeName].proxy_key_pool else None,
+                                                        keyBits              = self.machinetypes[machinetypeName].proxy_key_bits
                                                        )
     except Exception as e:
       raise VcycleError('Failed getting user_data file (' + str(e) + ')')
 
-    try:
-      self.setFileContents(machineName, 'user_data', userDataContents)
-    except:
-      raise VcycleError('Failed to writing ' + machineName + '/user_data')
+    return userDataContents
 
-    # Create MJF shutdowntime values as these are used in deleting failed machines
-
-    # check for existence of shutdownTime and whether wallclock limit is closer anyway
-    if (self.shutdownTime is None or
-        int(time.time()) + self.machinetypes[machinetypeName].maxWallclockSeconds < self.shutdownTime):
-      self.setFileContents(machineName,'machinefeatures/shutdowntime',
-                                str(int(time.time()) + self.machinetypes[machinetypeName].max_wallclock_seconds), mode = 0644)
-
-    else:
-      self.setFileContents(machineName,'machinefeatures/shutdowntime', str(self.shutdownTime), mode = 0644)
-      self.setFileContents(machineName,'jobfeatures/shutdowntime_job', str(self.shutdownTime), mode = 0644)
-
-    # Call the API-specific method to actually create the machine
-    try:
-      self.createMachine(machineName, machinetypeName, zone)
-    except Exception as e:
-      vcycle.vacutils.logLine('Creation of machine %s fails with: %s' % (machineName, str(e)))
-
-    # Rest of MJF. Some values may be set by self.createMachine() from the API!
+  def _finishMachine(self, machineName, machinetypeName):
+    """Rest of MJF. Some values may be set by self.createMachine() from the API!"""
 
     # $MACHINEFEATURES first
 
@@ -1930,6 +2499,14 @@ class BaseSpace(object):
     except Exception as e:
       vcycle.vacutils.logLine('Giving up on ' + self.spaceName + ' this cycle: ' + str(e))
       return
+    finally:
+      # Records and messages of machines found stopped by scanMachines()
+      self.writeApelSpool()
+
+      try:
+        self.sendMachineMessages()
+      except Exception as e:
+        vcycle.vacutils.logLine('Sending VacMon machine messages fails: ' + str(e))
 
     try:
       self.sendVacMon()
@@ -1942,6 +2519,12 @@ class BaseSpace(object):
       vcycle.vacutils.logLine('Deleting old machines in ' + self.spaceName + ' fails: ' + str(e))
       # We carry on because this isn't fatal
       
+    try:
+      self.advanceMachines()
+    except Exception as e:
+      vcycle.vacutils.logLine('Advancing machines being provisioned in ' + self.spaceName + ' fails: ' + str(e))
+      # We carry on because this isn't fatal
+
     try:
       self.moveMachineDirectories()
     except Exception as e:
@@ -1953,6 +2536,11 @@ class BaseSpace(object):
     except Exception as e:
       vcycle.vacutils.logLine('Creating heartbeat machine lists for ' + self.spaceName + ' fails: ' + str(e))
       
+    try:
+      self.prepareImages()
+    except Exception as e:
+      vcycle.vacutils.logLine('Preparing images for ' + self.spaceName + ' fails: ' + str(e))
+
     try:
       self.makeMachines()
     except Exception as e:
@@ -1963,6 +2551,12 @@ class BaseSpace(object):
     except Exception as e:
       vcycle.vacutils.logLine('Cleanup of deleted directories in ' + self.spaceName + ' fails: ' + str(e))
       # We carry on because this isn't fatal
+
+    try:
+      self.collectGarbage()
+    except Exception as e:
+      vcycle.vacutils.logLine('Garbage collection in ' + self.spaceName + ' fails: ' + str(e))
+      # We carry on because this isn't fatal
       
     # This must be done last in the cycle to avoid race conditions between manager instances
     try:
@@ -1970,18 +2564,182 @@ class BaseSpace(object):
     except Exception as e:
       vcycle.vacutils.logLine('Take abandoned machines ' + self.spaceName + ' fails: ' + str(e))
       
-def readConf(printConf = False, updatePipes = True):
+def fillProxyKeyPool():
+  # Generate keys for the proxies of user_data_proxy machinetypes, to be
+  # used in this or later cycles. vcycled runs this in a background thread
+  # so key generation is mostly done before and between machine creations
+
+  poolDepths = {}
+
+  for spaceName, space in spaces.iteritems():
+    for machinetypeName, machinetype in space.machinetypes.iteritems():
+      if machinetype.options['user_data_proxy'] and machinetype.proxy_key_pool:
+        poolDepths[machinetype.proxy_key_bits] = max(machinetype.proxy_key_pool,
+                                                     poolDepths.get(machinetype.proxy_key_bits, 0))
 
-  global vcycleVersion, spaces
+  if not poolDepths:
+    return
 
   try:
-    f = open('/var/lib/vcycle/VERSION', 'r')
-    vcycleVersion = f.readline().split('=',1)[1].strip()
-    f.close()
+    os.makedirs('/var/lib/vcycle/keypool', stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR)
   except:
-    vcycleVersion = '0.0.0'
+    pass
 
-  spaces = {}
+  for keyBits, poolDepth in poolDepths.iteritems():
+    try:
+      numKeys = vcycle.vacutils.fillX509KeyPool('/var/lib/vcycle/keypool', poolDepth, keyBits)
+    except Exception as e:
+      vcycle.vacutils.logLine('Failed filling proxy key pool with %d bit keys (%s)' % (keyBits, str(e)))
+    else:
+      if numKeys > 0:
+        vcycle.vacutils.logLine('Added %d %d bit keys to proxy key pool' % (numKeys, keyBits))
+
+def getStaticTelemetry():
+  # Kernel, OS issue and boot time are read once for the process lifetime.
+  # vcycled calls this before forking so each cycle inherits the values
+
+  global staticTelemetry
+
+  if staticTelemetry is None:
+    try:
+      bootTime = int(time.time() - float(open('/proc/uptime','r').readline().split()[0]))
+    except:
+      bootTime = 0
+
+    try:
+      osIssue = open('/etc/issue.vac','r').readline().strip()
+    except:
+      try:
+        osIssue = open('/etc/issue','r').readline().strip()
+      except:
+        osIssue = os.uname()[2]
+
+    staticTelemetry = { 'factory'        : os.uname()[1],
+                        'kernel_version' : os.uname()[2],
+                        'os_issue'       : osIssue,
+                        'boot_time'      : bootTime }
+
+  return staticTelemetry
+
+def getHostTelemetry():
+  # One snapshot of the host per cycle, shared by all the spaces. As well
+  # as the VacMon factory values, this includes pressure stall information,
+  # the iowait fraction since the last cycle, and the time taken to write,
+  # stat and remove a file on /var/lib/vcycle/shared, to help explain slow
+  # cycles. readConf() clears the snapshot
+
+  global hostTelemetry
+
+  if hostTelemetry is not None:
+    return hostTelemetry
+
+  telemetry = dict(getStaticTelemetry())
+
+  try:
+    telemetry['mjf_heartbeat_time'] = int(os.stat('/var/log/httpd/https-vcycle.log').st_ctime)
+  except:
+    telemetry['mjf_heartbeat_time'] = 0
+
+  daemonDiskStatFS = os.statvfs('/var/lib/vcycle')
+  rootDiskStatFS   = os.statvfs('/tmp')
+
+  telemetry['root_disk_avail_kb']       = (rootDiskStatFS.f_bavail * rootDiskStatFS.f_frsize) / 1024
+  telemetry['root_disk_avail_inodes']   = rootDiskStatFS.f_favail
+  telemetry['daemon_disk_avail_kb']     = (daemonDiskStatFS.f_bavail * daemonDiskStatFS.f_frsize) / 1024
+  telemetry['daemon_disk_avail_inodes'] = daemonDiskStatFS.f_favail
+
+  telemetry['load_average'] = vcycle.vacutils.loadAvg(2)
+  telemetry['memory']       = vcycle.vacutils.memInfo()
+
+  for (name, value) in vcycle.vacutils.pressureInfo().iteritems():
+    telemetry['pressure_' + name] = value
+
+  # iowait since the counters saved by the previous cycle
+  cpuTimes = vcycle.vacutils.cpuTimes()
+
+  if cpuTimes:
+    try:
+      lastCpuTimes = json.load(open('/var/lib/vcycle/cpu_times', 'r'))
+
+      if cpuTimes['total'] > lastCpuTimes['total']:
+        telemetry['iowait_percent'] = round(100.0 * (cpuTimes['iowait'] - lastCpuTimes['iowait'])
+                                                  / (cpuTimes['total']  - lastCpuTimes['total']), 2)
+    except:
+      pass
+
+    try:
+      vcycle.vacutils.createFile('/var/lib/vcycle/cpu_times', json.dumps(cpuTimes),
+                                 stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH,
+                                 '/var/lib/vcycle/tmp')
+    except:
+      pass
+
+  try:
+    startTime = time.time()
+    (fd, probePath) = tempfile.mkstemp(prefix = 'latency-', dir = '/var/lib/vcycle/shared/tmp')
+    os.write(fd, str(startTime))
+    os.close(fd)
+    os.stat(probePath)
+    os.remove(probePath)
+    telemetry['shared_fs_latency_ms'] = round(1000.0 * (time.time() - startTime), 1)
+  except Exception as e:
+    vcycle.vacutils.logLine('Failed to measure /var/lib/vcycle/shared latency (' + str(e) + ')')
+
+  vcycle.vacutils.logLine('Host telemetry: load %s, iowait %s%%, shared fs latency %sms, pressure %s'
+                          % (telemetry['load_average'],
+                             telemetry.get('iowait_percent', '-'),
+                             telemetry.get('shared_fs_latency_ms', '-'),
+                             ' '.join([ '%s=%.2f' % (name[9:], telemetry[name])
+                                        for name in sorted(telemetry) if name.startswith('pressure_') ]) or '-'))
+
+  hostTelemetry = telemetry
+  return hostTelemetry
+
+# One sender for all spaces, flushed by vcycled at the end of each cycle
+vacmonSender = VacMonSender(addressesFile = '/var/lib/vcycle/vacmon_addresses')
+
+def makeApelSyncRecords():
+  # Write APEL sync records to apel-outgoing once a day for the sites of
+  # spaces with gocdb_sitename, using the running job counts kept in
+  # apel-archive. On the first day of a month, the final counts for the
+  # previous month are sent too
+
+  sites = set([ space.gocdb_sitename for space in spaces.values() if space.gocdb_sitename ])
+
+  if not sites:
+    return
+
+  today = time.strftime('%Y%m%d')
+
+  try:
+    lastDay = open('/var/lib/vcycle/apel-archive/sync_day', 'r').read().strip()
+  except:
+    lastDay = None
+
+  if lastDay == today:
+    return
+
+  months = [ today[:6] ]
+
+  if lastDay and lastDay[:6] != today[:6]:
+    months.insert(0, lastDay[:6])
+
+  for month in months:
+    if vcycle.vacutils.makeSyncRecord('/var/lib/vcycle', month, '/var/lib/vcycle/tmp', sites = sites) != 0:
+      vcycle.vacutils.logLine('Failed making APEL sync records for ' + month)
+      return
+
+  vcycle.vacutils.createFile('/var/lib/vcycle/apel-archive/sync_day', today, tmpDir = '/var/lib/vcycle/tmp')
+
+def refreshPipes():
+  # Fetch the expired vacuum pipes found by readConf() concurrently, to be
+  # used from next cycle. vcycled runs this in a background thread so the
+  # cycle carries on with the cached copies in the meantime
+
+  vcycle.vacutils.refreshPipes('/var/lib/vcycle/pipescache', pipeURLs, 'vcycle ' + vcycleVersion)
+
+def readConfFiles():
+  # Return a parser loaded with all the configuration files
 
   parser = ConfigParser.RawConfigParser()
 
@@ -2003,9 +2761,180 @@ def readConf(printConf = False, updatePipes = True):
   # Standalone configuration file, read last in case of manual overrides
   parser.read('/etc/vcycle.conf')
 
+  return parser
+
+def recycleMachines(machineNames):
+  # Run in a subprocess of vcycled between cycles. machineNames is a list of
+  # (spaceName, machineName) with new shutdown messages. Returns 0 if
+  # nothing was done, or 10 if the next cycle should be started now
+
+  exitCode = 0
+
+  try:
+    readConf(updatePipes = False)
+  except Exception as e:
+    vcycle.vacutils.logLine('readConf() fails with "' + str(e) + '", not checking machines')
+    return exitCode
+
+  for spaceName in sorted(set([ spaceName for (spaceName, machineName) in machineNames ])):
+    if spaceName not in spaces:
+      continue
+
+    spaceMachineNames = sorted([ machineName for (oneSpaceName, machineName) in machineNames if oneSpaceName == spaceName ])
+
+    vcycle.vacutils.logLine('Checking ' + ' '.join(spaceMachineNames) + ' in ' + spaceName + ' after shutdown messages')
+
+    try:
+      spaces[spaceName].connect()
+
+      if spaces[spaceName].recycleMachines(spaceMachineNames):
+        exitCode = 10
+    except Exception as e:
+      # Let the next full cycle deal with them
+      vcycle.vacutils.logLine('Checking machines in ' + spaceName + ' fails: ' + str(e))
+      exitCode = 10
+
+  vacmonSender.flush()
+  return exitCode
+
+def watchJoboutputs(waitSeconds, settleSeconds = 2, retrySeconds = 15, maxRetries = 8):
+  # Used by vcycled instead of sleeping between cycles if watch_joboutputs
+  # is set. Watches current/*/joboutputs of each space for new shutdown
+  # messages, and forks recycleMachines() for those machines, waiting
+  # settleSeconds to collect others written at the same time. Machines
+  # which have not stopped yet are checked again every retrySeconds.
+  # Returns early if machines were deleted, so the next cycle can create
+  # new ones straight away
+
+  endTime = time.time() + waitSeconds
+
+  try:
+    inotify = vcycle.vacutils.Inotify()
+  except Exception as e:
+    vcycle.vacutils.logLine('Cannot watch joboutputs directories (' + str(e) + ')')
+    time.sleep(max(endTime - time.time(), 0))
+    return
+
+  # Machines whose directories cannot be watched, perhaps as they have just
+  # been removed or max_user_watches is reached, are left for the next cycle
+  for joboutputsDir in glob.glob('/var/lib/vcycle/shared/spaces/*/current/*/joboutputs'):
+    try:
+      inotify.addWatch(joboutputsDir, vcycle.vacutils.Inotify.IN_CLOSE_WRITE | vcycle.vacutils.Inotify.IN_MOVED_TO)
+    except Exception as e:
+      vcycle.vacutils.logLine('Not watching one joboutputs directory: ' + str(e))
+
+  # (spaceName, machineName) : [ time to check, number of checks so far ]
+  pending = {}
+
+  try:
+    while time.time() < endTime:
+      timeout = endTime - time.time()
+
+      if pending:
+        timeout = min(timeout, min([ checkTime for (checkTime, numChecks) in pending.itervalues() ]) - time.time())
+
+      for (joboutputsDir, fileName, mask) in inotify.readEvents(timeout):
+        if fileName == 'shutdown_message':
+          # joboutputsDir is /var/lib/vcycle/shared/spaces/SPACE/current/MACHINE/joboutputs
+          pathParts = joboutputsDir.split('/')
+          pending.setdefault((pathParts[-4], pathParts[-2]), [ time.time() + settleSeconds, 0 ])
+
+      dueMachines = [ machine for machine in pending if pending[machine][0] <= time.time() ]
+
+      if not dueMachines:
+        continue
+
+      pid = os.fork()
+
+      if pid == 0:
+        exitCode = 1
+
+        try:
+          exitCode = recycleMachines(dueMachines)
+        except Exception as e:
+          vcycle.vacutils.logLine('Checking machines fails: ' + str(e))
+        finally:
+          vcycle.vacutils.flushLog()
+          os._exit(exitCode)
+
+      exitCode = os.waitpid(pid, 0)[1] >> 8
+
+      if exitCode == 10:
+        return
+
+      for machine in dueMachines:
+        if os.path.exists('/var/lib/vcycle/shared/spaces/' + machine[0] + '/current/' + machine[1] + '/deleted') or \
+           pending[machine][1] + 1 >= maxRetries:
+          del pending[machine]
+        else:
+          pending[machine] = [ time.time() + retrySeconds, pending[machine][1] + 1 ]
+
+  finally:
+    inotify.close()
+
+def readConf(printConf = False, updatePipes = True, backgroundPipes = False):
+  # If backgroundPipes is True, expired vacuum pipes are not fetched here
+  # but left for refreshPipes(). Pipes with no cached copy are still fetched
+
+  global vcycleVersion, spaces, pipeURLs, hostTelemetry
+
+  try:
+    f = open('/var/lib/vcycle/VERSION', 'r')
+    vcycleVersion = f.readline().split('=',1)[1].strip()
+    f.close()
+  except:
+    vcycleVersion = '0.0.0'
+
+  spaces = {}
+  hostTelemetry = None
+
+  parser = readConfFiles()
+
+  # Fetch the remote vacuum pipes of all spaces together
+  pipeURLs = []
+  for vacuumPipeSectionName in parser.sections():
+    if vacuumPipeSectionName.lower().startswith('vacuum_pipe ') and \
+       parser.has_option(vacuumPipeSectionName, 'vacuum_pipe_url'):
+      pipeURLs.append(parser.get(vacuumPipeSectionName, 'vacuum_pipe_url').strip())
+
+  if updatePipes:
+    if backgroundPipes:
+      vcycle.vacutils.refreshPipes('/var/lib/vcycle/pipescache',
+                                   [ pipeURL for pipeURL in pipeURLs
+                                     if not os.path.isfile('/var/lib/vcycle/pipescache/' + urllib.quote(pipeURL, '')) ],
+                                   'vcycle ' + vcycleVersion)
+    else:
+      vcycle.vacutils.refreshPipes('/var/lib/vcycle/pipescache', pipeURLs, 'vcycle ' + vcycleVersion)
+
+  # Pipes have been refreshed as needed, so spaces just read the cached copies
+  updatePipes = False
+
+  # Daemon-wide options from [settings]
+  try:
+    logBufferLines = int(parser.get('settings', 'log_buffer_lines').strip())
+  except:
+    logBufferLines = 0
+
+  try:
+    logJSON = (parser.get('settings', 'log_format').strip().lower() == 'json')
+  except:
+    logJSON = False
+
+  try:
+    logVerbosity = int(parser.get('settings', 'log_verbosity').strip())
+  except:
+    logVerbosity = 1
+
+  # watch_joboutputs is read by vcycled itself, using readConfFiles()
+
+  vcycle.vacutils.setLogging(logBufferLines, logJSON, logVerbosity)
+
   # Find the space sections
   for spaceSectionName in parser.sections():
 
+    if spaceSectionName.lower() == 'settings':
+      continue
+
     try:
       (sectionType, spaceName) = spaceSectionName.lower().split(None,1)
     except Exception as e:
@@ -2061,6 +2990,12 @@ def readConf(printConf = False, updatePipes = True):
       else:
         spaces[spaceName].vacmons = []
 
+      if parser.has_option(spaceSectionName, 'vacmon_batch_machines') and \
+         parser.get(spaceSectionName, 'vacmon_batch_machines').strip().lower() == 'true':
+        spaces[spaceName].vacmon_batch_machines = True
+      else:
+        spaces[spaceName].vacmon_batch_machines = False
+
       if parser.has_option(spaceSectionName, 'https_host'):
         spaces[spaceName].https_host = parser.get(spaceSectionName,'https_host').strip().lower()
 
@@ -42,12 +42,20 @@ import sys
 import stat
 import time
 import glob
+import grp
+import gzip
+import shutil
 import json
+import fcntl
 import ctypes
+import errno
+import select
+import struct
 import string
 import urllib
 import StringIO
 import tempfile
+import threading
 import calendar
 import hashlib
 import xml.etree.cElementTree
@@ -57,6 +65,14 @@ import M2Crypto
 
 logStream = sys.stdout
 
+logBufferLines     = 0	# Lines written between flushes, 0 to flush every line
+logBufferSeconds   = 10	# Flush buffered lines at least this often
+logJSON            = False	# Write JSON lines rather than text
+logVerbosity       = 1	# 0 only logs per-machine = lines when the state changes
+logFields          = {}	# Fields added to every JSON line, such as the current space
+logUnflushedLines  = 0
+logLastFlushTime   = 0
+
 class VacutilsError(Exception):
    pass
 
@@ -64,9 +80,50 @@ def logToStderr():
    global logStream
    logStream = sys.stderr
 
-def logLine(text):
-   logStream.write(time.strftime('%b %d %H:%M:%S [') + str(os.getpid()) + ']: ' + text + '\n')
-   logStream.flush()
+def setLogging(bufferLines = 0, jsonLines = False, verbosity = 1):
+   global logBufferLines, logJSON, logVerbosity
+
+   flushLog()
+
+   logBufferLines = bufferLines
+   logJSON        = jsonLines
+   logVerbosity   = verbosity
+
+def logLine(text, **fields):
+   # Extra fields such as space, machinetype and machine are only
+   # written in JSON lines mode. Lines go through logStream, as print
+   # does, so they stay in order with printed lines even when buffered
+
+   global logUnflushedLines
+
+   if logJSON:
+     lineDict = dict(logFields)
+     lineDict.update(fields)
+     lineDict['time']    = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+     lineDict['pid']     = os.getpid()
+     lineDict['message'] = text
+
+     logStream.write(json.dumps(lineDict, sort_keys = True) + '\n')
+   else:
+     logStream.write(time.strftime('%b %d %H:%M:%S [') + str(os.getpid()) + ']: ' + text + '\n')
+
+   logUnflushedLines += 1
+
+   if logUnflushedLines > logBufferLines or time.time() > logLastFlushTime + logBufferSeconds:
+     flushLog()
+
+def flushLog():
+   # Called at the end of each cycle and when errors are caught, as well as
+   # by logLine() when enough lines or time have built up
+   global logUnflushedLines, logLastFlushTime
+
+   logUnflushedLines = 0
+   logLastFlushTime  = time.time()
+
+   try:
+     logStream.flush()
+   except:
+     pass
 
 def createFile(targetname, contents, mode=stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP, tmpDir = None):
    # Create a temporary text file containing contents then move
@@ -117,210 +174,447 @@ def secondsToString(timeStamp):
    else:
      return '%dd' % (seconds / 86400)
 
+def pipeExpired(pipesCache, pipeURL):
+   # True if there is no cached copy of the pipe or it is older than
+   # the pipe's own cache_seconds (default 3600)
+
+   pipeFile = pipesCache + '/' + urllib.quote(pipeURL, '')
+
+   try:
+     pipeDict = json.load(open(pipeFile, 'r'))
+     cacheSeconds = int(pipeDict.get('cache_seconds', 3600))
+     return int(os.stat(pipeFile).st_mtime) <= time.time() - cacheSeconds
+   except:
+     return True
+
+def fetchPipe(pipesCache, pipeURL, versionString):
+   # Fetch a remote vacuum pipe into pipesCache, revalidating any cached
+   # copy with the ETag and Last-Modified headers saved alongside it. The
+   # cached copy is kept as it is if the fetch fails
+
+   pipeFile    = pipesCache + '/' + urllib.quote(pipeURL, '')
+   headersFile = pipeFile + '.headers'
+
+   try:
+     cachedHeaders = json.load(open(headersFile, 'r'))
+   except:
+     cachedHeaders = {}
+
+   if not os.path.isfile(pipeFile):
+     cachedHeaders = {}
+
+   buffer  = StringIO.StringIO()
+   headers = {}
+
+   def headerFunction(line):
+     if ':' in line:
+       headers[line.split(':', 1)[0].strip().lower()] = line.split(':', 1)[1].strip()
+
+   c = pycurl.Curl()
+   c.setopt(c.URL, pipeURL)
+   c.setopt(c.WRITEFUNCTION, buffer.write)
+   c.setopt(c.HEADERFUNCTION, headerFunction)
+   c.setopt(c.USERAGENT, versionString)
+   c.setopt(c.TIMEOUT, 30)
+   c.setopt(c.FOLLOWLOCATION, True)
+   c.setopt(c.SSL_VERIFYPEER, 1)
+   c.setopt(c.SSL_VERIFYHOST, 2)
+
+   conditionalHeaders = []
+
+   if cachedHeaders.get('etag'):
+     conditionalHeaders.append('If-None-Match: ' + str(cachedHeaders['etag']))
+
+   if cachedHeaders.get('last-modified'):
+     conditionalHeaders.append('If-Modified-Since: ' + str(cachedHeaders['last-modified']))
+
+   if conditionalHeaders:
+     c.setopt(c.HTTPHEADER, conditionalHeaders)
+
+   if os.path.isdir('/etc/grid-security/certificates'):
+     c.setopt(c.CAPATH, '/etc/grid-security/certificates')
+   else:
+     logLine('/etc/grid-security/certificates directory does not exist - relying on curl bundle of commercial CAs')
+
+   logLine('Fetching ' + pipeURL)
+
+   try:
+     c.perform()
+     responseCode = c.getinfo(c.RESPONSE_CODE)
+   except Exception as e:
+     raise VacutilsError('Failed to read ' + pipeURL + ' (' + str(e) + ')')
+   finally:
+     c.close()
+
+   if responseCode == 304:
+     # Unchanged, so the cached copy is good for another cache_seconds
+     os.utime(pipeFile, None)
+     logLine(pipeURL + ' not modified')
+     return
+
+   if responseCode != 200:
+     raise VacutilsError('Failed to read ' + pipeURL + ' (HTTP code ' + str(responseCode) + ')')
+
+   try:
+     pipeDict = json.loads(buffer.getvalue())
+   except:
+     raise VacutilsError('Failed to load vacuum pipe file from ' + pipeURL)
+
+   if not createFile(pipeFile, json.dumps(pipeDict), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH):
+     raise VacutilsError('Unable to write vacuum pipe file ' + pipeFile)
+
+   createFile(headersFile,
+              json.dumps({ 'etag'          : headers.get('etag'),
+                           'last-modified' : headers.get('last-modified') }),
+              stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH)
+
+   logLine('Saved ' + pipeURL + ' as ' + pipeFile)
+
+def refreshPipes(pipesCache, pipeURLs, versionString, numThreads = 8):
+   # Fetch all the expired remote pipes in pipeURLs concurrently. Failures
+   # are logged and the stale cached copies are used until the next attempt
+
+   expiredURLs = [ pipeURL for pipeURL in set(pipeURLs)
+                   if ((pipeURL[0:7] == 'http://') or (pipeURL[0:8] == 'https://')) and
+                      pipeExpired(pipesCache, pipeURL) ]
+
+   def worker():
+     while True:
+       try:
+         pipeURL = expiredURLs.pop()
+       except IndexError:
+         return
+
+       try:
+         fetchPipe(pipesCache, pipeURL, versionString)
+       except Exception as e:
+         logLine(str(e))
+
+   threads = []
+   for i in range(min(numThreads, len(expiredURLs))):
+     thread = threading.Thread(target = worker)
+     thread.daemon = True
+     thread.start()
+     threads.append(thread)
+
+   for thread in threads:
+     thread.join()
+
 def readPipe(pipesCache, pipeURL, versionString, updatePipes = False):
+   # Return the vacuum pipe dictionary from the copy in pipesCache. If
+   # updatePipes is True, the pipe is fetched first if it has expired
 
-   # Default value in case not given in file
-   cacheSeconds = 3600
+   if updatePipes and \
+      ((pipeURL[0:7] == 'http://') or (pipeURL[0:8] == 'https://')) and \
+      pipeExpired(pipesCache, pipeURL):
+     try:
+       fetchPipe(pipesCache, pipeURL, versionString)
+     except Exception as e:
+       if not os.path.isfile(pipesCache + '/' + urllib.quote(pipeURL, '')):
+         raise
+       
+       # Stale copy is better than nothing
+       logLine(str(e) + ' - using cached copy')
 
    pipeFile = pipesCache + '/' + urllib.quote(pipeURL, '')
 
    try:
      pipeDict = json.load(open(pipeFile, 'r'))
    except:
-     # No pipe file found, so create a placeholder file
      logLine('Unable to read and parse vacuum pipe file ' + pipeFile)
-     pipeDict = { 'cache_seconds' : cacheSeconds, 'machinetypes' : [] }
+     return { 'cache_seconds' : 3600, 'machinetypes' : [] }
+
+   if 'cache_seconds' not in pipeDict:
+     pipeDict['cache_seconds'] = 3600
+
+   return pipeDict
+
+def getRemoteFile(url, versionString, cacheDir = None, cacheSeconds = 0, tmpDir = None):
+   # Return the contents of an HTTP(S) URL, using an on-disk cache in
+   # cacheDir shared by everything which fetches the same URL. Cached
+   # copies younger than cacheSeconds are used without contacting the
+   # server. Older ones are revalidated with a conditional GET using
+   # the saved ETag and Last-Modified headers, and used as they are if
+   # the server cannot be reached (stale-if-error). Each cache file is
+   # a line of JSON with those headers, then the contents.
+
+   cachedHeaders  = None
+   cachedContents = None
+
+   if cacheDir:
+     cacheFile = cacheDir + '/' + urllib.quote(url, '')
 
-     if not updatePipes:
-       # if not updating then nothing further we can do
-       return pipeDict
-     
      try:
-       f = open(pipeFile, 'w')
+       (headerLine, cachedContents) = open(cacheFile, 'r').read().split('\n', 1)
+       cachedHeaders = json.loads(headerLine)
+       cacheTime     = os.stat(cacheFile).st_mtime
      except:
-       raise VacutilsError('Unable to write vacuum pipe file ' + pipeFile)
+       cachedHeaders  = None
+       cachedContents = None
      else:
-       json.dump(pipeDict, f)
-       f.close()
+       if cacheTime > time.time() - cacheSeconds:
+         return cachedContents
+
+   buffer  = StringIO.StringIO()
+   headers = {}
 
-     # but still force an attempt to fetch remote file
-     cacheSeconds = 0
+   def headerFunction(line):
+     if ':' in line:
+       headers[line.split(':', 1)[0].strip().lower()] = line.split(':', 1)[1].strip()
 
+   c = pycurl.Curl()
+   c.setopt(c.URL, url)
+   c.setopt(c.WRITEFUNCTION, buffer.write)
+   c.setopt(c.HEADERFUNCTION, headerFunction)
+   c.setopt(c.USERAGENT, versionString)
+   c.setopt(c.TIMEOUT, 30)
+   c.setopt(c.FOLLOWLOCATION, True)
+   c.setopt(c.SSL_VERIFYPEER, 1)
+   c.setopt(c.SSL_VERIFYHOST, 2)
+
+   if cachedHeaders:
+     conditionalHeaders = []
+
+     if cachedHeaders.get('etag'):
+       conditionalHeaders.append('If-None-Match: ' + str(cachedHeaders['etag']))
+
+     if cachedHeaders.get('last-modified'):
+       conditionalHeaders.append('If-Modified-Since: ' + str(cachedHeaders['last-modified']))
+
+     c.setopt(c.HTTPHEADER, conditionalHeaders)
+
+   if os.path.isdir('/etc/grid-security/certificates'):
+     c.setopt(c.CAPATH, '/etc/grid-security/certificates')
+   else:
+     logLine('/etc/grid-security/certificates directory does not exist - relying on curl bundle of commercial CAs')
+
+   try:
+     c.perform()
+     responseCode = c.getinfo(c.RESPONSE_CODE)
+   except Exception as e:
+     responseCode = None
+     errorString  = str(e)
    else:
+     errorString  = 'HTTP response code ' + str(responseCode)
+
+   c.close()
+
+   if responseCode == 304 and cachedHeaders:
+     # Unchanged, so the cached copy is fresh again
      try:
-       cacheSeconds = int(pipeDict['cache_seconds'])
+       os.utime(cacheFile, None)
      except:
-       pipeDict['cache_seconds'] = cacheSeconds
+       pass
 
-   # Check if cache seconds has expired
-   if updatePipes and \
-      (cacheSeconds == 0 or 
-       int(os.stat(pipeFile).st_mtime) <= time.time() - cacheSeconds) and \
-      ((pipeURL[0:7] == 'http://') or (pipeURL[0:8] == 'https://')):
-     buffer = StringIO.StringIO()
-     c = pycurl.Curl()
-     c.setopt(c.URL, pipeURL)
-     c.setopt(c.WRITEFUNCTION, buffer.write)
-     c.setopt(c.USERAGENT, versionString)
-     c.setopt(c.TIMEOUT, 30)
-     c.setopt(c.FOLLOWLOCATION, True)
-     c.setopt(c.SSL_VERIFYPEER, 1)
-     c.setopt(c.SSL_VERIFYHOST, 2)
-
-     if os.path.isdir('/etc/grid-security/certificates'):
-       c.setopt(c.CAPATH, '/etc/grid-security/certificates')
-     else:
-       logLine('/etc/grid-security/certificates directory does not exist - relying on curl bundle of commercial CAs')
+     return cachedContents
 
-     logLine('Fetching ' + pipeURL)
+   if responseCode is None or responseCode >= 400:
+     if cachedHeaders:
+       logLine('Failed to read ' + url + ' (' + errorString + ') - using cached copy')
+       return cachedContents
 
-     try:
-       c.perform()
-     except Exception as e:
-       raise VacutilsError('Failed to read ' + pipeURL + ' (' + str(e) + ')')
+     raise VacutilsError('Failed to read ' + url + ' (' + errorString + ')')
 
-     c.close()
+   if cacheDir:
+     createFile(cacheFile,
+                json.dumps({ 'etag'          : headers.get('etag'),
+                             'last-modified' : headers.get('last-modified') }) + '\n' + buffer.getvalue(),
+                stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH,
+                tmpDir)
 
-     try:
-       pipeDict = json.loads(buffer.getvalue())
-     except:
-       raise VacutilsError('Failed to load vacuum pipe file from ' + pipeURL)
-     else:
-       try:
-         f = open(pipeFile, 'w')
-       except:
-         logLine('Unable to write vacuum pipe file ' + pipeFile)
-         return pipeDict
-       else:
-         json.dump(pipeDict, f)
-         f.close()
-         logLine('Saved ' + pipeURL + ' as ' + pipeFile)
+   return buffer.getvalue()
 
-     createFile(pipeFile, json.dumps(pipeDict), stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH)
+# Compiled user_data templates and user_data_file_* contents, keyed by
+# path or URL. These live as long as the process, so a burst of machine
+# creations only reads and parses each template once.
+userDataTemplates = {}
+userDataFiles     = {}
 
-   return pipeDict
+# Placeholders createUserData() fills with values specific to one machine,
+# such as its name or its own X.509 proxy
+perMachineUserDataPlaceholders = set([ 'user_data_machine_hostname',
+                                       'user_data_vm_hostname',
+                                       'user_data_machinefeatures_url',
+                                       'user_data_jobfeatures_url',
+                                       'user_data_joboutputs_url',
+                                       'user_data_uuid',
+                                       'user_data_option_x509_proxy' ])
 
-def createUserData(shutdownTime, machinetypePath, options, versionString, spaceName, machinetypeName, userDataPath, hostName, uuidStr,
-                   machinefeaturesURL = None, jobfeaturesURL = None, joboutputsURL = None, rootImageURL = None, heartbeatMachinesURL = None,
-                   gocdbSitename = None):
+class UserDataTemplate:
+   """user_data template split once into literal text and ##user_data_...## placeholders"""
+
+   def __init__(self, contents, cacheKey = None):
+      self.cacheKey = cacheKey
+
+      # Splitting with a capturing group gives literal, placeholder, literal, ...
+      self.parts        = re.split('(##user_data_[a-z,0-9,_]*##)', contents)
+      self.placeholders = set([ part[2:-2] for part in self.parts[1::2] ])
+
+   def render(self, values):
+      """Substitute all placeholders in a single pass. Unknown placeholders are removed"""
+
+      parts = self.parts[:]
 
-   # Get raw user_data template file, either from network ...
+      for i in xrange(1, len(parts), 2):
+        parts[i] = values.get(parts[i][2:-2], '')
+
+      return ''.join(parts)
+
+def getUserDataTemplate(userDataPath, machinetypePath, versionString, userDataCache = None, cacheSeconds = 0, tmpDir = None):
+   # Get compiled user_data template, either from network ...
    if (userDataPath[0:7] == 'http://') or (userDataPath[0:8] == 'https://'):
-     buffer = StringIO.StringIO()
-     c = pycurl.Curl()
-     c.setopt(c.URL, userDataPath)
-     c.setopt(c.WRITEFUNCTION, buffer.write)
-     c.setopt(c.USERAGENT, versionString)
-     c.setopt(c.TIMEOUT, 30)
-     c.setopt(c.FOLLOWLOCATION, True)
-     c.setopt(c.SSL_VERIFYPEER, 1)
-     c.setopt(c.SSL_VERIFYHOST, 2)
-
-     if os.path.isdir('/etc/grid-security/certificates'):
-       c.setopt(c.CAPATH, '/etc/grid-security/certificates')
-     else:
-       logLine('/etc/grid-security/certificates directory does not exist - relying on curl bundle of commercial CAs')
+     userDataContents = getRemoteFile(userDataPath, versionString, userDataCache, cacheSeconds, tmpDir)
+     contentsHash     = hashlib.sha1(userDataContents).hexdigest()
+     cachedTemplate   = userDataTemplates.get(userDataPath)
 
-     try:
-       c.perform()
-     except Exception as e:
-       raise VacutilsError('Failed to read ' + userDataPath + ' (' + str(e) + ')')
+     if cachedTemplate and cachedTemplate.cacheKey == contentsHash:
+       return cachedTemplate
 
-     c.close()
+     template = UserDataTemplate(userDataContents, contentsHash)
+     userDataTemplates[userDataPath] = template
 
-     # We only do this substitution if it was an HTTP(S) URL
-     userDataContents = buffer.getvalue().replace('##user_data_url##', userDataPath)
+     return template
 
    # ... or from filesystem
+   if userDataPath[0] == '/':
+     userDataFile = userDataPath
    else:
-     if userDataPath[0] == '/':
-       userDataFile = userDataPath
-     else:
-       userDataFile = machinetypePath + '/files/' + userDataPath
+     userDataFile = machinetypePath + '/files/' + userDataPath
 
-     try:
-       u = open(userDataFile, 'r')
-       userDataContents = u.read()
-       u.close()
-     except:
-       raise VacutilsError('Failed to read ' + userDataFile)
+   try:
+     fileStat = os.stat(userDataFile)
+   except:
+     raise VacutilsError('Failed to read ' + userDataFile)
 
-   # Default substitutions (plus ##user_data_url## possibly done already)
-   if gocdbSitename:
-     userDataContents = userDataContents.replace('##user_data_site##', gocdbSitename)
-   
-   userDataContents = userDataContents.replace('##user_data_space##',            spaceName)
-   userDataContents = userDataContents.replace('##user_data_machinetype##',      machinetypeName)
-   userDataContents = userDataContents.replace('##user_data_machine_hostname##', hostName)
-   userDataContents = userDataContents.replace('##user_data_manager_version##',  versionString)
-   userDataContents = userDataContents.replace('##user_data_manager_hostname##', os.uname()[1])
+   cachedTemplate = userDataTemplates.get(userDataFile)
 
-   if machinefeaturesURL:
-     userDataContents = userDataContents.replace('##user_data_machinefeatures_url##', machinefeaturesURL)
+   if cachedTemplate and cachedTemplate.cacheKey == (fileStat.st_mtime, fileStat.st_size):
+     return cachedTemplate
 
-   if jobfeaturesURL:
-     userDataContents = userDataContents.replace('##user_data_jobfeatures_url##', jobfeaturesURL)
+   try:
+     u = open(userDataFile, 'r')
+     userDataContents = u.read()
+     u.close()
+   except:
+     raise VacutilsError('Failed to read ' + userDataFile)
 
-   if joboutputsURL:
-     userDataContents = userDataContents.replace('##user_data_joboutputs_url##', joboutputsURL)
+   template = UserDataTemplate(userDataContents, (fileStat.st_mtime, fileStat.st_size))
+   userDataTemplates[userDataFile] = template
 
-   if rootImageURL:
-     userDataContents = userDataContents.replace('##user_data_root_image_url##', rootImageURL)
+   return template
 
-   if heartbeatMachinesURL:
-     userDataContents = userDataContents.replace('##user_data_heartbeat_machines_url##', heartbeatMachinesURL)
+def readUserDataFile(path, versionString, userDataCache = None, cacheSeconds = 0, tmpDir = None):
+   # Return the contents of a user_data_file_*, reusing them if the file is unchanged
+   if (path[0:7] == 'http://') or (path[0:8] == 'https://'):
+     return getRemoteFile(path, versionString, userDataCache, cacheSeconds, tmpDir)
 
-   # Deprecated vmtype/VM/VMLM terminology
-   userDataContents = userDataContents.replace('##user_data_vmtype##',           machinetypeName)
-   userDataContents = userDataContents.replace('##user_data_vm_hostname##',      hostName)
-   userDataContents = userDataContents.replace('##user_data_vmlm_version##',     versionString)
-   userDataContents = userDataContents.replace('##user_data_vmlm_hostname##',    os.uname()[1])
+   fileStat = os.stat(path)
 
-   if uuidStr:
-     userDataContents = userDataContents.replace('##user_data_uuid##', uuidStr)
+   try:
+     (cacheKey, fileContents) = userDataFiles[path]
+   except KeyError:
+     pass
+   else:
+     if cacheKey == (fileStat.st_mtime, fileStat.st_size):
+       return fileContents
+
+   f = open(path, 'r')
+   fileContents = f.read()
+   f.close()
+
+   userDataFiles[path] = ((fileStat.st_mtime, fileStat.st_size), fileContents)
+   return fileContents
+
+def createUserData(shutdownTime, machinetypePath, options, versionString, spaceName, machinetypeName, userDataPath, hostName, uuidStr,
+                   machinefeaturesURL = None, jobfeaturesURL = None, joboutputsURL = None, rootImageURL = None, heartbeatMachinesURL = None,
+                   gocdbSitename = None, userDataCache = None, cacheSeconds = 0, tmpDir = None,
+                   keyPoolDir = None, keyBits = 1024):
+
+   template = getUserDataTemplate(userDataPath, machinetypePath, versionString, userDataCache, cacheSeconds, tmpDir)
+   values   = {}
+
+   # Site configurable substitutions for this machinetype
+   for oneOption, oneValue in options.iteritems():
+      if oneOption.startswith('user_data_file_'):
+        try:
+           if (oneValue[0] == '/') or (oneValue[0:7] == 'http://') or (oneValue[0:8] == 'https://'):
+             fileContents = readUserDataFile(oneValue, versionString, userDataCache, cacheSeconds, tmpDir)
+           else:
+             fileContents = readUserDataFile(machinetypePath + '/files/' + oneValue, versionString)
+        except:
+           raise VacutilsError('Failed to read ' + oneValue + ' for ' + oneOption)
+
+        # deprecated: replace ##user_data_file_xxxx## with value
+        values[oneOption] = fileContents
 
-   # Insert a proxy created from user_data_proxy_cert / user_data_proxy_key
-   if 'user_data_proxy' in options and options['user_data_proxy'] == True:
+        # new behaviour: replace ##user_data_option_xxxx## with value from user_data_file_xxxx
+        values.setdefault('user_data_option_' + oneOption[15:], fileContents)
+
+   for oneOption, oneValue in options.iteritems():
+      if oneOption.startswith('user_data_option_'):
+        values[oneOption] = oneValue
+
+   # Insert a proxy created from user_data_proxy_cert / user_data_proxy_key,
+   # but only if the template will actually use it
+   if 'user_data_proxy' in options and options['user_data_proxy'] == True \
+      and 'user_data_option_x509_proxy' in template.placeholders:
      certPath = machinetypePath + '/x509cert.pem'
      keyPath  = machinetypePath + '/x509key.pem'
 
      try:
        if ('legacy_proxy' in options) and options['legacy_proxy']:
-         userDataContents = userDataContents.replace('##user_data_option_x509_proxy##',
-                              makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=True))
+         values['user_data_option_x509_proxy'] = makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=True,
+                                                                keyPoolDir=keyPoolDir, keyBits=keyBits)
        else:
-         userDataContents = userDataContents.replace('##user_data_option_x509_proxy##',
-                              makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=False, cn=machinetypeName))
+         values['user_data_option_x509_proxy'] = makeX509Proxy(certPath, keyPath, shutdownTime, isLegacyProxy=False, cn=machinetypeName,
+                                                                keyPoolDir=keyPoolDir, keyBits=keyBits)
      except Exception as e:
        raise VacutilsError('Faled to make proxy (' + str(e) + ')')
 
-   # Site configurable substitutions for this machinetype
-   for oneOption, oneValue in options.iteritems():
-      if oneOption.startswith('user_data_option_'):
-        userDataContents = userDataContents.replace('##' + oneOption + '##', oneValue)
-      elif oneOption.startswith('user_data_file_'):
-        try:
-           if oneValue[0] == '/':
-             f = open(oneValue, 'r')
-           else:
-             f = open(machinetypePath + '/files/' + oneValue, 'r')
+   # Default substitutions take precedence over the site configurable ones
+   if (userDataPath[0:7] == 'http://') or (userDataPath[0:8] == 'https://'):
+     # We only do this substitution if it was an HTTP(S) URL
+     values['user_data_url'] = userDataPath
 
-           fileContents = f.read()
-           f.close()
+   if gocdbSitename:
+     values['user_data_site'] = gocdbSitename
 
-           # deprecated: replace ##user_data_file_xxxx## with value
-           userDataContents = userDataContents.replace('##' + oneOption + '##', fileContents)
+   values['user_data_space']            = spaceName
+   values['user_data_machinetype']      = machinetypeName
+   values['user_data_machine_hostname'] = hostName
+   values['user_data_manager_version']  = versionString
+   values['user_data_manager_hostname'] = os.uname()[1]
 
-           # new behaviour: replace ##user_data_option_xxxx## with value from user_data_file_xxxx
-           userDataContents = userDataContents.replace('##user_data_option_' + oneOption[15:] + '##', fileContents)
+   if machinefeaturesURL:
+     values['user_data_machinefeatures_url'] = machinefeaturesURL
 
-        except:
-           raise VacutilsError('Failed to read ' + oneValue + ' for ' + oneOption)
+   if jobfeaturesURL:
+     values['user_data_jobfeatures_url'] = jobfeaturesURL
 
-   # Remove any unused patterns from the template
-   userDataContents = re.sub('##user_data_[a-z,0-9,_]*##', '', userDataContents)
+   if joboutputsURL:
+     values['user_data_joboutputs_url'] = joboutputsURL
+
+   if rootImageURL:
+     values['user_data_root_image_url'] = rootImageURL
+
+   if heartbeatMachinesURL:
+     values['user_data_heartbeat_machines_url'] = heartbeatMachinesURL
+
+   # Deprecated vmtype/VM/VMLM terminology
+   values['user_data_vmtype']       = machinetypeName
+   values['user_data_vm_hostname']  = hostName
+   values['user_data_vmlm_version'] = versionString
+   values['user_data_vmlm_hostname'] = os.uname()[1]
+
+   if uuidStr:
+     values['user_data_uuid'] = uuidStr
+
+   # Inserted values never contain unused patterns, as with the old sequential substitutions
+   for oneName in values:
+     if '##user_data_' in values[oneName]:
+       values[oneName] = re.sub('##user_data_[a-z,0-9,_]*##', '', values[oneName])
 
-   return userDataContents
+   return template.render(values)
 
 def emptyCallback1(p1):
    return
@@ -328,10 +622,23 @@ def emptyCallback1(p1):
 def emptyCallback2(p1, p2):
    return
 
-def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=None):
-   # Return a PEM-encoded limited proxy as a string in either Globus Legacy
-   # or RFC 3820 format. Checks that the existing cert/proxy expires after
-   # the given expirationTime, but no other checks are done.
+# Parsed signer keys and certificate chains for makeX509Proxy(), keyed
+# by (certPath, keyPath) and reused while the files' mtimes are unchanged
+x509Signers = {}
+
+# Counts of proxy keys taken from the pool (hits) or generated on demand (misses)
+x509ProxyKeyStats = { 'hits' : 0, 'misses' : 0 }
+
+def getX509Signer(certPath, keyPath):
+   # Return (private key as EVP.PKey, list of certificate PEM strings)
+
+   try:
+     cacheKey = (os.stat(certPath).st_mtime, os.stat(keyPath).st_mtime)
+   except Exception as e:
+     raise VacutilsError('Failed to stat ' + certPath + ' or ' + keyPath + ' (' + str(e) + ')')
+
+   if (certPath, keyPath) in x509Signers and x509Signers[(certPath, keyPath)][0] == cacheKey:
+     return x509Signers[(certPath, keyPath)][1:]
 
    # First get the existing priviate key
 
@@ -340,6 +647,9 @@ def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=Non
    except Exception as e:
      raise VacutilsError('Failed to get private key from ' + keyPath + ' (' + str(e) + ')')
 
+   oldKeyEVP = M2Crypto.EVP.PKey()
+   oldKeyEVP.assign_rsa(oldKey)
+
    # Get the chain of certificates (just one if a usercert or hostcert file)
 
    try:
@@ -347,39 +657,107 @@ def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=Non
    except Exception as e:
      raise VacutilsError('Failed to open certificate file ' + certPath + ' (' + str(e) + ')')
 
-   oldCerts = []
+   oldCertPEMs = []
 
    while True:
      try:
-       oldCerts.append(M2Crypto.X509.load_cert_bio(certBIO))
+       oldCertPEMs.append(M2Crypto.X509.load_cert_bio(certBIO).as_pem())
      except:
        certBIO.close()
        break
 
-   if len(oldCerts) == 0:
+   if len(oldCertPEMs) == 0:
      raise VacutilsError('Failed get certificate from ' + certPath)
 
+   x509Signers[(certPath, keyPath)] = (cacheKey, oldKeyEVP, oldCertPEMs)
+   return (oldKeyEVP, oldCertPEMs)
+
+def fillX509KeyPool(poolDir, poolDepth, keyBits = 1024):
+   # Generate RSA keys for makeX509Proxy() until poolDir holds poolDepth
+   # keys of keyBits bits. Keys are written as unencrypted PEM files only
+   # readable by the owner, which is no less secure than the user_data
+   # files which will contain them as part of proxies. Returns the number
+   # of keys added, stopping at the first key which cannot be written.
+
+   numKeys  = len(glob.glob(poolDir + '/' + str(keyBits) + '-*.pem'))
+   numAdded = 0
+
+   for i in range(numKeys, poolDepth):
+     newKey = M2Crypto.RSA.gen_key(keyBits, 65537, emptyCallback2)
+
+     # createFile() logs why it fails
+     if not createFile(poolDir + '/%d-%d-%d-%d.pem' % (keyBits, int(time.time()), os.getpid(), i),
+                       newKey.as_pem(cipher = None),
+                       stat.S_IRUSR | stat.S_IWUSR,
+                       poolDir):
+       break
+
+     numAdded += 1
+
+   return numAdded
+
+def getX509ProxyKey(poolDir = None, keyBits = 1024):
+   # Return a new RSA key for a proxy, taking one from poolDir if possible
+
+   if poolDir:
+     for keyFile in glob.glob(poolDir + '/' + str(keyBits) + '-*.pem'):
+       # Rename to claim this key, which fails if another process got it first
+       claimedFile = poolDir + '/claimed-' + str(os.getpid()) + '-' + os.path.basename(keyFile)
+
+       try:
+         os.rename(keyFile, claimedFile)
+       except:
+         continue
+
+       try:
+         newKey = M2Crypto.RSA.load_key(claimedFile, emptyCallback1)
+       except Exception as e:
+         logLine('Failed to load pooled proxy key ' + claimedFile + ' (' + str(e) + ')')
+         newKey = None
+
+       try:
+         os.remove(claimedFile)
+       except:
+         pass
+
+       if newKey:
+         x509ProxyKeyStats['hits'] += 1
+         return newKey
+
+   x509ProxyKeyStats['misses'] += 1
+   return M2Crypto.RSA.gen_key(keyBits, 65537, emptyCallback2)
+
+def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=None, keyPoolDir=None, keyBits=1024):
+   # Return a PEM-encoded limited proxy as a string in either Globus Legacy
+   # or RFC 3820 format. Checks that the existing cert/proxy expires after
+   # the given expirationTime, but no other checks are done.
+
+   (oldKeyEVP, oldCertPEMs) = getX509Signer(certPath, keyPath)
+
+   # A fresh copy of the signer's certificate, since we modify its subject below
+   oldCert = M2Crypto.X509.load_cert_string(oldCertPEMs[0])
+
    # Check the expirationTime
 
-   if int(calendar.timegm(time.strptime(str(oldCerts[0].get_not_after()), "%b %d %H:%M:%S %Y %Z"))) < expirationTime:
+   if int(calendar.timegm(time.strptime(str(oldCert.get_not_after()), "%b %d %H:%M:%S %Y %Z"))) < expirationTime:
      raise VacutilsError('Cert/proxy ' + certPath + ' expires before given expiration time ' + str(expirationTime))
 
    # Create the public/private keypair for the new proxy
 
    newKey = M2Crypto.EVP.PKey()
-   newKey.assign_rsa(M2Crypto.RSA.gen_key(1024, 65537, emptyCallback2))
+   newKey.assign_rsa(getX509ProxyKey(keyPoolDir, keyBits))
 
    # Start filling in the new certificate object
 
    newCert = M2Crypto.X509.X509()
    newCert.set_pubkey(newKey)
    newCert.set_serial_number(int(time.time() * 100))
-   newCert.set_issuer_name(oldCerts[0].get_subject())
+   newCert.set_issuer_name(oldCert.get_subject())
    newCert.set_version(2) # "2" is X.509 for "v3" ...
 
    # Construct the legacy or RFC style subject
 
-   newSubject = oldCerts[0].get_subject()
+   newSubject = oldCert.get_subject()
 
    if isLegacyProxy:
      # Globus legacy proxy
@@ -426,50 +804,135 @@ def makeX509Proxy(certPath, keyPath, expirationTime, isLegacyProxy=False, cn=Non
      newCert.add_ext(M2Crypto.X509.new_extension("proxyCertInfo", "critical, language:1.3.6.1.4.1.3536.1.1.1.9", 1, 0))
 
    # Sign the certificate with the old private key
-   oldKeyEVP = M2Crypto.EVP.PKey()
-   oldKeyEVP.assign_rsa(oldKey)
    newCert.sign(oldKeyEVP, 'sha256')
 
    # Return proxy as a string of PEM blocks
 
-   proxyString = newCert.as_pem() + newKey.as_pem(cipher = None)
+   return newCert.as_pem() + newKey.as_pem(cipher = None) + ''.join(oldCertPEMs)
 
-   for oneOldCert in oldCerts:
-     proxyString += oneOldCert.as_pem()
+# Verified CernVM image digests and certificates, also saved in cacheDir
+# if given, so unchanged images are only hashed once
+cernvmDigests      = {}
+cernvmCertificates = {}
 
-   return proxyString
+def getCernvmImageDigest(fileName, length, cacheDir = None, tmpDir = None):
+   # SHA-256 digest of the image up to the Signature Block, cached using
+   # the image's path, size, mtime, and inode number as the key
 
-def getCernvmImageData(fileName):
+   fileStat = os.stat(fileName)
+   cacheKey = [ fileName, fileStat.st_size, int(fileStat.st_mtime), fileStat.st_ino ]
 
-   data = { 'verified' : False, 'dn' : None }
+   if fileName in cernvmDigests and cernvmDigests[fileName][0] == cacheKey:
+     return cernvmDigests[fileName][1]
 
-   try:
-     length = os.stat(fileName).st_size
-   except Exception as e:
-     logLine('Failed to get CernVM image size (' + str(e) + ')')
-     return data
+   if cacheDir:
+     cacheFile = cacheDir + '/' + urllib.quote(fileName, '') + '.json'
 
-   if length <= 65536:
-     logLine('CernVM image only ' + str(length) + ' bytes long: must be more than 65536')
-     return data
+     try:
+       cacheDict = json.load(open(cacheFile, 'r'))
+       if cacheDict['key'] == cacheKey:
+         cernvmDigests[fileName] = (cacheKey, base64.b64decode(cacheDict['sha256']))
+         return cernvmDigests[fileName][1]
+     except:
+       pass
 
-   try:
-     f = open(fileName, 'r')
-   except Exception as e:
-     logLine('Failed to open CernVM image (' + str(e) + ')')
-     return data
+   # Hash in fixed size chunks rather than reading the whole image into memory
+   hash = hashlib.sha256()
+   f = open(fileName, 'rb')
+   bytesLeft = length - 32 * 1024
 
-   try:
-     f.seek(-64 * 1024, os.SEEK_END)
-     metadataBlock = f.read(32 * 1024).rstrip("\x00")
-     # Quick hack until the metadata section is fixed in the CernVM images (extra comma)
-     metadataBlock = metadataBlock.replace('HEAD",\n', 'HEAD"\n')
-     metadataDict  = json.loads(metadataBlock)
+   while bytesLeft > 0:
+     chunk = f.read(min(bytesLeft, 1048576))
+     if not chunk:
+       break
 
-     if 'ucernvm-version' in metadataDict:
-       data['version'] = metadataDict['ucernvm-version']
-   except Exception as e:
-     logLine('Failed to load Metadata Block JSON from CernVM image (' + str(e) + ')')
+     hash.update(chunk)
+     bytesLeft -= len(chunk)
+
+   f.close()
+   digest = hash.digest()
+
+   cernvmDigests[fileName] = (cacheKey, digest)
+
+   if cacheDir:
+     createFile(cacheFile,
+                json.dumps({ 'key' : cacheKey, 'sha256' : base64.b64encode(digest) }),
+                stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH,
+                tmpDir)
+
+   return digest
+
+def verifyCernvmCertificate(certificate, cacheDir = None, tmpDir = None, cacheSeconds = 86400):
+   # Check the certificate chain with openssl verify. Results are cached
+   # for cacheSeconds, or until the CA certificates directory changes
+
+   try:
+     caTime = int(os.stat('/etc/grid-security/certificates').st_mtime)
+   except:
+     caTime = 0
+
+   certHash = hashlib.sha1(certificate).hexdigest()
+
+   if certHash in cernvmCertificates:
+     return cernvmCertificates[certHash]
+
+   if cacheDir:
+     cacheFile = cacheDir + '/certificate-' + certHash + '.json'
+
+     try:
+       cacheDict = json.load(open(cacheFile, 'r'))
+       if cacheDict['ca_time'] == caTime and cacheDict['checked'] > time.time() - cacheSeconds:
+         cernvmCertificates[certHash] = cacheDict['verified']
+         return cacheDict['verified']
+     except:
+       pass
+
+   # This isn't provided by M2Crypto, so we use openssl command
+   p = os.popen('/usr/bin/openssl verify -CApath /etc/grid-security/certificates >/dev/null', 'w')
+   p.write(certificate)
+   verified = (p.close() is None)
+
+   cernvmCertificates[certHash] = verified
+
+   if cacheDir:
+     createFile(cacheFile,
+                json.dumps({ 'ca_time' : caTime, 'checked' : int(time.time()), 'verified' : verified }),
+                stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH,
+                tmpDir)
+
+   return verified
+
+def getCernvmImageData(fileName, cacheDir = None, tmpDir = None):
+
+   data = { 'verified' : False, 'dn' : None }
+
+   try:
+     length = os.stat(fileName).st_size
+   except Exception as e:
+     logLine('Failed to get CernVM image size (' + str(e) + ')')
+     return data
+
+   if length <= 65536:
+     logLine('CernVM image only ' + str(length) + ' bytes long: must be more than 65536')
+     return data
+
+   try:
+     f = open(fileName, 'r')
+   except Exception as e:
+     logLine('Failed to open CernVM image (' + str(e) + ')')
+     return data
+
+   try:
+     f.seek(-64 * 1024, os.SEEK_END)
+     metadataBlock = f.read(32 * 1024).rstrip("\x00")
+     # Quick hack until the metadata section is fixed in the CernVM images (extra comma)
+     metadataBlock = metadataBlock.replace('HEAD",\n', 'HEAD"\n')
+     metadataDict  = json.loads(metadataBlock)
+
+     if 'ucernvm-version' in metadataDict:
+       data['version'] = metadataDict['ucernvm-version']
+   except Exception as e:
+     logLine('Failed to load Metadata Block JSON from CernVM image (' + str(e) + ')')
 
    try:
      f.seek(-32 * 1024, os.SEEK_END)
@@ -480,12 +943,11 @@ def getCernvmImageData(fileName):
    except Exception as e:
      logLine('Failed to load Signature Block JSON from CernVM image (' + str(e) + ')')
      return data
+   finally:
+     f.close()
 
    try:
-     f.seek(0, os.SEEK_SET)
-     digestableImage = f.read(length - 32 * 1024)
-     hash = hashlib.sha256(digestableImage)
-     digest = hash.digest()
+     digest = getCernvmImageDigest(fileName, length, cacheDir, tmpDir)
    except Exception as e:
      logLine('Failed to make digest of CernVM image (' + str(e) + ')')
      return data
@@ -509,11 +971,7 @@ def getCernvmImageData(fileName):
      return data
 
    try:
-     # This isn't provided by M2Crypto, so we use openssl command
-     p = os.popen('/usr/bin/openssl verify -CApath /etc/grid-security/certificates >/dev/null', 'w')
-     p.write(certificate)
-
-     if p.close() is None:
+     if verifyCernvmCertificate(certificate, cacheDir, tmpDir):
        try:
          dn = str(x509.get_subject())
        except Exception as e:
@@ -529,87 +987,631 @@ def getCernvmImageData(fileName):
 
    return data
 
-def getRemoteRootImage(url, imageCache, tmpDir, versionString):
+def hashFile(fileName):
+   # Hex SHA-256 digest of a file, read in fixed size chunks
+   hash = hashlib.sha256()
+   f = open(fileName, 'rb')
+
+   while True:
+     chunk = f.read(1048576)
+     if not chunk:
+       break
+
+     hash.update(chunk)
+
+   f.close()
+   return hash.hexdigest()
+
+def addToImageCache(imageCache, fileName, urlEncoded, digest, tmpDir, lastModified = None):
+   # Put a file into the content-addressed store imageCache/sha256/DIGEST
+   # and make imageCache/urlEncoded a hardlink to it. If the store already
+   # has that content, the existing copy is used and fileName is removed.
+   # lastModified is the Last-Modified: time of this URL, or the mtime of
+   # fileName if not given.
+
+   if lastModified is None:
+     lastModified = os.stat(fileName).st_mtime
 
    try:
-     f, tempName = tempfile.mkstemp(prefix = 'getRemoteRootImage-', dir = tmpDir)
-   except Exception as e:
-     VacutilsError('Failed to create temporary image file in ' + tmpDir)
+     os.makedirs(imageCache + '/sha256', stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+   except:
+     pass
 
-   ff = os.fdopen(f, 'wb')
+   contentName = imageCache + '/sha256/' + digest
 
-   c = pycurl.Curl()
-   c.setopt(c.USERAGENT, versionString)
-   c.setopt(c.URL, url)
-   c.setopt(c.WRITEDATA, ff)
+   if os.path.exists(contentName):
+     # Same content already cached, perhaps from another URL
+     if os.stat(fileName).st_ino != os.stat(contentName).st_ino:
+       os.remove(fileName)
+       logLine('Image for ' + urlEncoded + ' is the same as existing ' + contentName)
+   else:
+     os.link(fileName, contentName)
+
+   # Replace imageCache/urlEncoded atomically with a hardlink to the content,
+   # made with a name no other process or earlier link can be using
+   for i in range(100):
+     linkName = '%s/addToImageCache-%d-%d' % (tmpDir, os.getpid(), i)
+
+     try:
+       os.link(contentName, linkName)
+     except OSError as e:
+       if e.errno != errno.EEXIST:
+         raise
+     else:
+       break
+   else:
+     raise VacutilsError('Cannot make a temporary link to ' + contentName + ' in ' + tmpDir)
 
-   urlEncoded = urllib.quote(url,'')
+   os.rename(linkName, imageCache + '/' + urlEncoded)
+
+   # rename() does nothing if both names were already links to the same file
+   for oneName in (linkName, fileName):
+     if oneName != imageCache + '/' + urlEncoded and os.path.exists(oneName):
+       os.remove(oneName)
+
+   createFile(imageCache + '/' + urlEncoded + '.sha256', digest,
+              stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, tmpDir)
+
+   # Hardlinks share one mtime, so each URL's Last-Modified: is kept separately
+   createFile(imageCache + '/' + urlEncoded + '.last_modified', str(int(lastModified)),
+              stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, tmpDir)
+
+def getImageLastModified(imageFile):
+   # Return the Last-Modified: time of an image returned by getRemoteRootImage(),
+   # to be used as its version. For other files, this is their mtime
 
    try:
-     # For existing files, we get the mtime and only fetch the image itself if newer.
-     # We check mtime not ctime since we will set it to remote Last-Modified: once downloaded
-     c.setopt(c.TIMEVALUE, int(os.stat(imageCache + '/' + urlEncoded).st_mtime))
-     c.setopt(c.TIMECONDITION, c.TIMECONDITION_IFMODSINCE)
+     return int(open(imageFile + '.last_modified', 'r').read().strip())
+   except:
+     return int(os.stat(imageFile).st_mtime)
+
+def getImageContentFile(imageFile):
+   # Return the content store file imageCache/sha256/DIGEST of an image
+   # returned by getRemoteRootImage(). Unlike the URL name, this never
+   # changes to a newer version. Other files are returned as they are
+
+   try:
+     contentFile = os.path.dirname(imageFile) + '/sha256/' + open(imageFile + '.sha256', 'r').read().strip()
+
+     if os.path.exists(contentFile):
+       return contentFile
    except:
      pass
 
-   c.setopt(c.TIMEOUT, 120)
+   return imageFile
+
+def getUploadingDigests(uploadsDir, maxAgeSeconds = 600):
+   # Return the digests of cached images in the upload state files
+   # uploadsDir/*/*.json of uploads which are queued or still running
+
+   digests = []
+
+   for stateFile in glob.glob(uploadsDir + '/*/*.json'):
+     try:
+       uploadState = json.load(open(stateFile, 'r'))
+
+       if uploadState['status'] == 'uploading' and \
+          uploadState.get('digest') and \
+          uploadState['updated'] > time.time() - maxAgeSeconds:
+         digests.append(str(uploadState['digest']))
+     except:
+       pass
+
+   return digests
+
+def touchImageCache(imageCache, urlEncoded, tmpDir):
+   # Record that the cached image for urlEncoded has just been used, and
+   # return its digest. Images cached before the content store existed
+   # are added to it here.
+
+   try:
+     digest = open(imageCache + '/' + urlEncoded + '.sha256', 'r').read().strip()
+     if not os.path.exists(imageCache + '/sha256/' + digest):
+       raise Exception('Missing content file')
+   except:
+     digest = hashFile(imageCache + '/' + urlEncoded)
+     addToImageCache(imageCache, imageCache + '/' + urlEncoded, urlEncoded, digest, tmpDir,
+                     getImageLastModified(imageCache + '/' + urlEncoded))
+
+   usedName = imageCache + '/sha256/' + digest + '.used'
+
+   try:
+     os.utime(usedName, None)
+   except:
+     open(usedName, 'w').close()
+
+   return digest
+
+def pruneImageCache(imageCache, maxBytes, keepDigests = []):
+   # Remove the least recently used images until the content store is no
+   # bigger than maxBytes. Returns the number of bytes removed.
+
+   images = []
+   totalBytes = 0
+
+   for contentName in glob.glob(imageCache + '/sha256/*'):
+     if contentName.endswith('.used'):
+       continue
+
+     try:
+       contentStat = os.stat(contentName)
+     except:
+       continue
+
+     try:
+       lastUsed = os.stat(contentName + '.used').st_mtime
+     except:
+       lastUsed = 0
+
+     images.append((lastUsed, contentName, contentStat))
+     totalBytes += contentStat.st_size
+
+   images.sort()
+   removedBytes = 0
+
+   for (lastUsed, contentName, contentStat) in images:
+     if totalBytes - removedBytes <= maxBytes:
+       break
+
+     if os.path.basename(contentName) in keepDigests:
+       continue
+
+     # Remove every URL name which is a hardlink to this content
+     for urlName in glob.glob(imageCache + '/*'):
+       try:
+         if os.path.isfile(urlName) and os.stat(urlName).st_ino == contentStat.st_ino:
+           os.remove(urlName)
+           for suffix in ('.sha256', '.last_modified'):
+             try:
+               os.remove(urlName + suffix)
+             except:
+               pass
+       except:
+         pass
+
+     for oneName in (contentName, contentName + '.used'):
+       try:
+         os.remove(oneName)
+       except:
+         pass
+
+     removedBytes += contentStat.st_size
+     logLine('Removed least recently used image ' + contentName + ' from ' + imageCache)
+
+   return removedBytes
+
+# Totals for getRemoteRootImage() downloads in this process, for logging each cycle
+imageDownloadStats = { 'downloads' : 0, 'bytes' : 0, 'bytes_resumed' : 0, 'seconds' : 0.0 }
+
+# Longest time one attempt at downloading an image or a segment of it may
+# take. Ranged downloads are resumed next cycle if this is reached
+imageFetchSeconds  = 900
+
+def makeImageCurl(url, versionString, timeoutSeconds = 120):
+   # Curl object for fetching images, with a time limit on each attempt
+   # and a limit on stalled transfers
+   c = pycurl.Curl()
+   c.setopt(c.USERAGENT, versionString)
+   c.setopt(c.URL, url)
+   c.setopt(c.TIMEOUT, timeoutSeconds)
 
    # You will thank me for following redirects one day :)
    c.setopt(c.FOLLOWLOCATION, 1)
    c.setopt(c.OPT_FILETIME,   1)
    c.setopt(c.SSL_VERIFYPEER, 1)
    c.setopt(c.SSL_VERIFYHOST, 2)
+   c.setopt(c.CONNECTTIMEOUT, 30)
+   c.setopt(c.LOW_SPEED_LIMIT, 1024)
+   c.setopt(c.LOW_SPEED_TIME, 300)
 
    if os.path.isdir('/etc/grid-security/certificates'):
      c.setopt(c.CAPATH, '/etc/grid-security/certificates')
    else:
      logLine('/etc/grid-security/certificates directory does not exist - relying on curl bundle of commercial CAs')
 
-   logLine('Checking if an updated ' + url + ' needs to be fetched')
+   return c
+
+def fetchImageSegment(url, versionString, segmentName, start, end, lastModified, hash = None):
+   # Fetch bytes start to end (inclusive) of url into segmentName, resuming
+   # from the bytes already in that file. If the image has changed since
+   # lastModified the server sends 200 rather than 206 and we fail.
+   # Returns (bytes fetched now, bytes already present)
+
+   try:
+     existingBytes = os.stat(segmentName).st_size
+   except:
+     existingBytes = 0
+
+   if existingBytes > end - start + 1:
+     # Not a valid partial segment, so start again
+     existingBytes = 0
+
+   ff = open(segmentName, 'r+b' if existingBytes else 'wb')
+   ff.seek(existingBytes)
+   ff.truncate()
+
+   if hash and existingBytes:
+     # Include the bytes we already have in the digest
+     ff.seek(0)
+     bytesLeft = existingBytes
+
+     while bytesLeft > 0:
+       chunk = ff.read(min(bytesLeft, 1048576))
+       hash.update(chunk)
+       bytesLeft -= len(chunk)
+
+     ff.seek(existingBytes)
+
+   if start + existingBytes > end:
+     ff.close()
+     return (0, existingBytes)
+
+   # Status of the last response, as redirects give more than one
+   status = [ None ]
+
+   def headerFunction(line):
+     if line.startswith('HTTP/'):
+       try:
+         status[0] = int(line.split()[1])
+       except:
+         status[0] = None
+
+   def writeFunction(data):
+     if status[0] != 206:
+       # The server is sending the whole image (If-Range failed or was
+       # ignored), so stop rather than fetch it again for every segment
+       return 0
+
+     ff.write(data)
+     if hash:
+       hash.update(data)
+
+   c = makeImageCurl(url, versionString, imageFetchSeconds)
+   c.setopt(c.HEADERFUNCTION, headerFunction)
+   c.setopt(c.WRITEFUNCTION, writeFunction)
+   c.setopt(c.RANGE, '%d-%d' % (start + existingBytes, end))
+   c.setopt(c.HTTPHEADER, [ 'If-Range: ' + time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(lastModified)) ])
 
    try:
      c.perform()
+   except Exception as e:
+     if status[0] != 200:
+       # Failed to connect, timed out, or interrupted, so keep what we have for next time
+       raise VacutilsError('Range request for ' + url + ' fails (' + str(e) + ')')
+   finally:
      ff.close()
+
+   fetchedBytes = int(c.getinfo(c.SIZE_DOWNLOAD))
+   c.close()
+
+   if status[0] != 206:
+     os.remove(segmentName)
+     raise VacutilsError('Range request for ' + url + ' returns HTTP code ' + str(status[0]))
+
+   return (fetchedBytes, existingBytes)
+
+def getRemoteRootImage(url, imageCache, tmpDir, versionString, maxCacheBytes = None,
+                       segments = 1, segmentMinBytes = 268435456, keepDigests = []):
+   # Fetch url into imageCache if it is newer than the copy we have. Partial
+   # downloads are kept in tmpDir and resumed using HTTP Range requests,
+   # and large images are fetched as up to segments parallel ranges.
+   # Images in keepDigests, such as those still being uploaded, are not
+   # removed when the cache is pruned. Returns imageCache/urlEncoded
+
+   return _fetchRemoteRootImage(url, imageCache, tmpDir, versionString, maxCacheBytes,
+                                segments, segmentMinBytes, keepDigests, False)
+
+def getRemoteRootImageContent(url, imageCache, tmpDir, versionString, maxCacheBytes = None,
+                              segments = 1, segmentMinBytes = 268435456, keepDigests = []):
+   # Like getRemoteRootImage(), but returns (contentFile, lastModified)
+   # read while no other process can change this URL, so they always belong
+   # to the same version. Unlike imageCache/urlEncoded, the content file
+   # imageCache/sha256/DIGEST is never replaced by a newer version
+
+   return _fetchRemoteRootImage(url, imageCache, tmpDir, versionString, maxCacheBytes,
+                                segments, segmentMinBytes, keepDigests, True)
+
+def _fetchRemoteRootImage(url, imageCache, tmpDir, versionString, maxCacheBytes,
+                          segments, segmentMinBytes, keepDigests, returnContent):
+
+   urlEncoded  = urllib.quote(url,'')
+   partialName = tmpDir + '/getRemoteRootImage-' + hashlib.sha1(url).hexdigest()
+
+   # Only one process at a time may work on the partial files for this URL
+   lockFile = open(partialName + '.lock', 'w')
+
+   try:
+     fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+   except:
+     lockFile.close()
+     raise VacutilsError(url + ' is already being fetched by another process')
+
+   try:
+     imageFile = _getRemoteRootImage(url, imageCache, tmpDir, versionString, maxCacheBytes,
+                                     segments, segmentMinBytes, urlEncoded, partialName, keepDigests)
+
+     if not returnContent:
+       return imageFile
+
+     return (getImageContentFile(imageFile), getImageLastModified(imageFile))
+   finally:
+     lockFile.close()
+
+def _getRemoteRootImage(url, imageCache, tmpDir, versionString, maxCacheBytes,
+                        segments, segmentMinBytes, urlEncoded, partialName, keepDigests):
+
+   # First ask for just the headers, to see if there is a newer version
+   headers = {}
+
+   def headerFunction(line):
+     if ':' in line:
+       headers[line.split(':', 1)[0].strip().lower()] = line.split(':', 1)[1].strip()
+
+   c = makeImageCurl(url, versionString)
+   c.setopt(c.NOBODY, 1)
+   c.setopt(c.HEADERFUNCTION, headerFunction)
+
+   try:
+     # For existing files, we only fetch the image itself if newer than the
+     # remote Last-Modified: recorded when it was downloaded
+     c.setopt(c.TIMEVALUE, getImageLastModified(imageCache + '/' + urlEncoded))
+     c.setopt(c.TIMECONDITION, c.TIMECONDITION_IFMODSINCE)
+   except:
+     pass
+
+   logLine('Checking if an updated ' + url + ' needs to be fetched')
+
+   try:
+     c.perform()
    except Exception as e:
-     os.remove(tempName)
-     raise VacutilsError('Failed to fetch ' + url + ' (' + str(e) + ')')
+     headError    = str(e)
+     responseCode = None
+   else:
+     headError    = None
+     responseCode = c.getinfo(c.RESPONSE_CODE)
 
-   if c.getinfo(c.RESPONSE_CODE) == 200:
-     try:
-       lastModified = float(c.getinfo(c.INFO_FILETIME))
-     except:
-       os.remove(tempName)
-       # We fail rather than use a server that doesn't give Last-Modified:
-       raise VacutilsError('Failed to get last modified time for ' + url)
+   try:
+     lastModified = float(c.getinfo(c.INFO_FILETIME))
+   except:
+     lastModified = -1.0
+
+   try:
+     length = int(c.getinfo(c.CONTENT_LENGTH_DOWNLOAD))
+   except:
+     length = -1
+
+   c.close()
+
+   if responseCode != 200 and responseCode != 304:
+     # Some servers, such as presigned object store URLs, allow GET but not HEAD
+     logLine('HEAD request for ' + url + ' fails (' + (headError or 'HTTP code ' + str(responseCode)) +
+             '), trying a conditional GET instead')
+     _getRemoteRootImageByGet(url, imageCache, tmpDir, versionString, urlEncoded, partialName)
 
+   elif responseCode == 200:
      if lastModified < 0.0:
-       os.remove(tempName)
        # We fail rather than use a server that doesn't give Last-Modified:
        raise VacutilsError('Failed to get last modified time for ' + url)
-     else:
-       # We set mtime to Last-Modified: in case our system clock is very wrong, to prevent
-       # continually downloading the image based on our faulty filesystem timestamps
-       os.utime(tempName, (time.time(), lastModified))
+
+     # Partial files are only resumed if they are for the same version
+     partialDict = { 'last_modified' : lastModified, 'length' : length }
 
      try:
-       os.rename(tempName, imageCache + '/' + urlEncoded)
+       if json.load(open(partialName + '.json', 'r')) != partialDict:
+         raise Exception('Different version')
      except:
+       for oldName in glob.glob(partialName + '.*'):
+         if not oldName.endswith('.lock'):
+           os.remove(oldName)
+
+       createFile(partialName + '.json', json.dumps(partialDict), tmpDir = tmpDir)
+
+     # Only use ranges if the server supports them and gives the length
+     if headers.get('accept-ranges', '').lower() == 'bytes' and length > 0:
+       numSegments = max(1, min(segments, length / segmentMinBytes))
+     else:
+       numSegments = 0
+
+     startTime    = time.time()
+     hash         = hashlib.sha256()
+     segmentNames = []
+     results      = {}
+
+     if numSegments == 0:
+       # Simple download without resuming
+       segmentNames = [ partialName + '.0' ]
+       ff = open(segmentNames[0], 'wb')
+
+       def writeFunction(data):
+         ff.write(data)
+         hash.update(data)
+
+       c = makeImageCurl(url, versionString, imageFetchSeconds)
+       c.setopt(c.WRITEFUNCTION, writeFunction)
+
+       try:
+         c.perform()
+
+         if c.getinfo(c.RESPONSE_CODE) != 200:
+           raise VacutilsError('HTTP code ' + str(c.getinfo(c.RESPONSE_CODE)))
+
+         results[0] = (int(c.getinfo(c.SIZE_DOWNLOAD)), 0)
+       except Exception as e:
+         results[0] = e
+
+       ff.close()
+       c.close()
+
+     else:
+       segmentBytes = length / numSegments
+
+       def fetchOneSegment(i):
+         start = i * segmentBytes
+
+         if i == numSegments - 1:
+           end = length - 1
+         else:
+           end = start + segmentBytes - 1
+
+         try:
+           # With one segment we can hash as we go, otherwise when joining the segments
+           results[i] = fetchImageSegment(url, versionString, segmentNames[i], start, end,
+                                          lastModified, hash if numSegments == 1 else None)
+         except Exception as e:
+           results[i] = e
+
+       segmentNames = [ partialName + '.' + str(i) for i in range(numSegments) ]
+       threads      = []
+
+       for i in range(numSegments):
+         threads.append(threading.Thread(target = fetchOneSegment, args = (i,)))
+         threads[-1].start()
+
+       for thread in threads:
+         thread.join()
+
+     # Record what was transferred, even if some segments failed
+     for result in results.values():
+       if not isinstance(result, Exception):
+         imageDownloadStats['bytes']         += result[0]
+         imageDownloadStats['bytes_resumed'] += result[1]
+
+     imageDownloadStats['seconds'] += time.time() - startTime
+
+     for result in results.values():
+       if isinstance(result, Exception):
+         # Partial files are left to be resumed next time
+         raise VacutilsError('Failed to fetch ' + url + ' (' + str(result) + ')')
+
+     imageDownloadStats['downloads'] += 1
+
+     if len(segmentNames) == 1:
+       tempName = segmentNames[0]
+     else:
+       # Join the segments, hashing them as we go
+       tempName = partialName + '.joined'
+       ff = open(tempName, 'wb')
+
+       for segmentName in segmentNames:
+         fs = open(segmentName, 'rb')
+
+         while True:
+           chunk = fs.read(1048576)
+           if not chunk:
+             break
+
+           ff.write(chunk)
+           hash.update(chunk)
+
+         fs.close()
+         os.remove(segmentName)
+
+       ff.close()
+
+     if length > 0 and os.stat(tempName).st_size != length:
+       os.remove(tempName)
+       raise VacutilsError('Fetched ' + url + ' has the wrong length')
+
+     # We record Last-Modified: rather than using our own clock, in case it is very wrong,
+     # to prevent continually downloading the image based on our faulty timestamps
+     try:
+       addToImageCache(imageCache, tempName, urlEncoded, hash.hexdigest(), tmpDir, lastModified)
+     except Exception as e:
        try:
          os.remove(tempName)
        except:
          pass
 
-       raise VacutilsError('Failed renaming new image ' + imageCache + '/' + urlEncoded)
+       raise VacutilsError('Failed adding new image ' + imageCache + '/' + urlEncoded + ' (' + str(e) + ')')
 
+     os.remove(partialName + '.json')
      logLine('New ' + url + ' put in ' + imageCache)
 
-   else:
+   elif os.path.exists(imageCache + '/' + urlEncoded):
      logLine('No new version of ' + url + ' found and existing copy not replaced')
+
+   else:
+     raise VacutilsError('Failed to fetch ' + url + ' (HTTP code ' + str(responseCode) + ')')
+
+   digest = touchImageCache(imageCache, urlEncoded, tmpDir)
+
+   if maxCacheBytes is not None:
+     pruneImageCache(imageCache, maxCacheBytes, [ digest ] + list(keepDigests))
+
+   return imageCache + '/' + urlEncoded
+
+def _getRemoteRootImageByGet(url, imageCache, tmpDir, versionString, urlEncoded, partialName):
+   # Fetch url with a single conditional GET, as before HEAD requests and
+   # resuming were used, for servers which do not allow HEAD
+
+   tempName = partialName + '.get'
+   hash     = hashlib.sha256()
+   ff       = open(tempName, 'wb')
+
+   def writeFunction(data):
+     ff.write(data)
+     hash.update(data)
+
+   c = makeImageCurl(url, versionString, imageFetchSeconds)
+   c.setopt(c.WRITEFUNCTION, writeFunction)
+
+   try:
+     c.setopt(c.TIMEVALUE, getImageLastModified(imageCache + '/' + urlEncoded))
+     c.setopt(c.TIMECONDITION, c.TIMECONDITION_IFMODSINCE)
+   except:
+     pass
+
+   startTime = time.time()
+
+   try:
+     c.perform()
+   except Exception as e:
+     ff.close()
+     c.close()
      os.remove(tempName)
+     raise VacutilsError('Failed to fetch ' + url + ' (' + str(e) + ')')
+
+   ff.close()
+
+   responseCode = c.getinfo(c.RESPONSE_CODE)
+   fetchedBytes = int(c.getinfo(c.SIZE_DOWNLOAD))
+
+   try:
+     lastModified = float(c.getinfo(c.INFO_FILETIME))
+   except:
+     lastModified = -1.0
 
    c.close()
-   return imageCache + '/' + urlEncoded
+
+   if responseCode != 200:
+     os.remove(tempName)
+
+     if responseCode == 304 and os.path.exists(imageCache + '/' + urlEncoded):
+       logLine('No new version of ' + url + ' found and existing copy not replaced')
+       return
+
+     raise VacutilsError('Failed to fetch ' + url + ' (HTTP code ' + str(responseCode) + ')')
+
+   if lastModified < 0.0:
+     # We fail rather than use a server that doesn't give Last-Modified:
+     os.remove(tempName)
+     raise VacutilsError('Failed to get last modified time for ' + url)
+
+   imageDownloadStats['downloads'] += 1
+   imageDownloadStats['bytes']     += fetchedBytes
+   imageDownloadStats['seconds']   += time.time() - startTime
+
+   try:
+     addToImageCache(imageCache, tempName, urlEncoded, hash.hexdigest(), tmpDir, lastModified)
+   except Exception as e:
+     try:
+       os.remove(tempName)
+     except:
+       pass
+
+     raise VacutilsError('Failed adding new image ' + imageCache + '/' + urlEncoded + ' (' + str(e) + ')')
+
+   logLine('New ' + url + ' put in ' + imageCache)
 
 def splitCommaHeaders(inputList):
 
@@ -625,6 +1627,53 @@ def splitCommaHeaders(inputList):
 
    return outputList
 
+class Inotify:
+   # Minimal inotify(7) wrapper using ctypes, as Python 2 has no binding
+
+   IN_CLOSE_WRITE = 0x00000008
+   IN_MOVED_TO    = 0x00000080
+   IN_CLOEXEC     = 0x00080000
+
+   def __init__(self):
+     self.libc = ctypes.CDLL('libc.so.6', use_errno = True)
+     self.fd   = self.libc.inotify_init1(self.IN_CLOEXEC)
+     self.wds  = {}
+
+     if self.fd < 0:
+       raise VacutilsError('inotify_init1 fails (' + os.strerror(ctypes.get_errno()) + ')')
+
+   def addWatch(self, path, mask):
+     wd = self.libc.inotify_add_watch(self.fd, path, mask)
+
+     if wd < 0:
+       raise VacutilsError('inotify_add_watch on ' + path + ' fails (' + os.strerror(ctypes.get_errno()) + ')')
+
+     self.wds[wd] = path
+
+   def readEvents(self, timeoutSeconds):
+     # Return a list of (directory, fileName, mask) events, waiting for up
+     # to timeoutSeconds if there are none yet
+     events = []
+
+     if not select.select([self.fd], [], [], max(timeoutSeconds, 0))[0]:
+       return events
+
+     buffer = os.read(self.fd, 65536)
+     offset = 0
+
+     while offset + 16 <= len(buffer):
+       (wd, mask, cookie, nameLength) = struct.unpack_from('iIII', buffer, offset)
+       fileName = buffer[offset + 16 : offset + 16 + nameLength].rstrip('\0')
+       offset  += 16 + nameLength
+
+       if wd in self.wds:
+         events.append((self.wds[wd], fileName, mask))
+
+     return events
+
+   def close(self):
+     os.close(self.fd)
+
 def setProcessName(processName):
 
    try:
@@ -678,25 +1727,97 @@ def setProcessName(processName):
      logLine('Failed setting process name in argv[] to ' + processName)
      return
 
-def makeSyncRecord(dirPrefix, targetYearMonth, tmpDir):
+def writeApelRecords(dirPrefix, records, recordsPerFile, outgoing, tmpDir):
+   # Write APEL individual job records as multi-record message files in
+   # dirPrefix/apel-archive/YYYYMMDD and, if outgoing is True, in
+   # dirPrefix/apel-outgoing/YYYYMMDD too. Each record is a (text, info)
+   # tuple, where text is the fields of one job ending with %%, and info
+   # is a dictionary saved with the file name and offset of the record as
+   # one JSON line in apel-archive/YYYYMMDD.index. Returns the number of
+   # records written
 
-   try:
-      targetMonth = int(targetYearMonth[4:6])
-      targetYear  = int(targetYearMonth[0:4])
-   except:
-      print 'Cannot parse as YYYYMM: ' + targetYearMonth
-      return 1
+   nowTime = time.localtime()
+   dayDir  = time.strftime('%Y%m%d', nowTime)
+
+   for subDir in ['apel-archive', 'apel-outgoing']:
+     try:
+       os.makedirs(dirPrefix + '/' + subDir + '/' + dayDir, stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+     except:
+       pass
+
+   baseName   = time.strftime('%H%M%S', nowTime) + (str(time.time() % 1) + '00000000')[2:10]
+   indexLines = []
 
-   numberJobs = 0
-   site       = None
-   submitHost = None
+   for fileNumber,first in enumerate(range(0, len(records), max(recordsPerFile, 1))):
+     fileName    = baseName + '-' + str(fileNumber)
+     mesg        = 'APEL-individual-job-message: v0.3\n'
+     fileEntries = []
 
-   recordsList = glob.glob(dirPrefix + '/apel-archive/' + targetYearMonth + '*/*')
-   # We go backwards in time, assuming that site and SubmitHost for
-   # the most recent record are correct
-   recordsList.sort(reverse=True)
+     for (text, info) in records[first:first + max(recordsPerFile, 1)]:
+       entry = dict(info)
+       entry['file']   = dayDir + '/' + fileName
+       entry['offset'] = len(mesg)
+       entry['length'] = len(text)
+       fileEntries.append(json.dumps(entry) + '\n')
+       mesg += text
+
+     if not createFile(dirPrefix + '/apel-archive/' + dayDir + '/' + fileName, mesg, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, tmpDir):
+       logLine('Failed creating ' + dirPrefix + '/apel-archive/' + dayDir + '/' + fileName)
+       continue
+
+     indexLines.extend(fileEntries)
+
+     if outgoing and not createFile(dirPrefix + '/apel-outgoing/' + dayDir + '/' + fileName, mesg, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, tmpDir):
+       logLine('Failed creating ' + dirPrefix + '/apel-outgoing/' + dayDir + '/' + fileName)
+
+   if indexLines:
+     # Appended with one write so a reader never sees part of a line
+     fd = os.open(dirPrefix + '/apel-archive/' + dayDir + '.index', os.O_WRONLY | os.O_APPEND | os.O_CREAT, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH)
+     try:
+       os.write(fd, ''.join(indexLines))
+     finally:
+       os.close(fd)
+
+     # Keep the running job counts used for sync records up to date
+     increments = {}
+     for line in indexLines:
+       entry = json.loads(line)
+       increments.setdefault(entry['site'], {}).setdefault(entry['submit_host'], 0)
+       increments[entry['site']][entry['submit_host']] += 1
+
+     try:
+       updateApelCounts(dirPrefix, dayDir[:6], increments = increments, tmpDir = tmpDir)
+     except Exception as e:
+       logLine('Failed updating APEL job counts (' + str(e) + ')')
+
+   return len(indexLines)
+
+def countApelRecords(dirPrefix, targetYearMonth):
+   # Count the job records in apel-archive for the month YYYYMM, returning
+   # { site : { submitHost : numberJobs } }. Records in YYYYMMDD.index files
+   # are counted from there, and any older single-record files without
+   # index entries by opening them
+
+   counts       = {}
+   indexedFiles = set()
+
+   for indexFileName in glob.glob(dirPrefix + '/apel-archive/' + targetYearMonth + '*.index'):
+      for line in open(indexFileName, 'r'):
+        try:
+          entry = json.loads(line)
+        except:
+          continue
+
+        indexedFiles.add(dirPrefix + '/apel-archive/' + str(entry['file']))
+
+        if entry.get('site') and entry.get('submit_host'):
+          counts.setdefault(str(entry['site']), {}).setdefault(str(entry['submit_host']), 0)
+          counts[str(entry['site'])][str(entry['submit_host'])] += 1
+
+   for fileName in glob.glob(dirPrefix + '/apel-archive/' + targetYearMonth + '*/*'):
+      if fileName in indexedFiles:
+        continue
 
-   for fileName in recordsList:
       thisSite = None
       thisSubmitHost = None
 
@@ -709,35 +1830,152 @@ def makeSyncRecord(dirPrefix, targetYearMonth, tmpDir):
         if thisSite and thisSubmitHost:
           break
 
-      if thisSite is None:
-        print 'No Site given in ' + fileName + ' !! - please fix this - skipping'
+      if thisSite is None or thisSubmitHost is None:
+        print 'No Site or SubmitHost given in ' + fileName + ' !! - please fix this - skipping'
         continue
 
-      if thisSubmitHost is None:
-        print 'No SubmitHost given in ' + fileName + ' !! - please fix this - skipping'
-        continue
+      counts.setdefault(thisSite, {}).setdefault(thisSubmitHost, 0)
+      counts[thisSite][thisSubmitHost] += 1
 
-      if site is None:
-        site = thisSite
-      elif site != thisSite:
-        print 'Site changes from ' + site + ' to ' + thisSite + ' - please fix ' + fileName + ' - skipping'
-        continue
+   return counts
 
-      if submitHost is None:
-        submitHost = thisSubmitHost
-      elif submitHost != thisSubmitHost:
-        print 'SubmitHost changes from ' + submitHost + ' to ' + thisSubmitHost + ' - please fix ' + fileName + ' - skipping'
+def updateApelCounts(dirPrefix, yearMonth, counts = None, increments = None, tmpDir = None):
+   # Add increments { site : { submitHost : n } } to the running job counts
+   # for month YYYYMM in apel-archive/YYYYMM.counts, or replace the counts
+   # entirely if counts is given. Returns the new counts
+
+   lockFile = open(dirPrefix + '/apel-archive/counts.lock', 'a')
+   fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+
+   try:
+     if counts is None:
+       try:
+         counts = json.load(open(dirPrefix + '/apel-archive/' + yearMonth + '.counts', 'r'))
+       except:
+         # First records of the month, or the counts must be rebuilt
+         counts = countApelRecords(dirPrefix, yearMonth)
+       else:
+         for site in increments or {}:
+           for submitHost in increments[site]:
+             counts.setdefault(site, {}).setdefault(submitHost, 0)
+             counts[site][submitHost] += increments[site][submitHost]
+
+     if not createFile(dirPrefix + '/apel-archive/' + yearMonth + '.counts', json.dumps(counts),
+                       stat.S_IWUSR + stat.S_IRUSR + stat.S_IRGRP + stat.S_IROTH, tmpDir):
+       raise VacutilsError('Failed to save APEL job counts for ' + yearMonth)
+
+   finally:
+     lockFile.close()
+
+   return counts
+
+def readHeartbeatIndex(indexPath, maxAgeSeconds = 86400, httpdGroup = 'apache'):
+   # Read the "TIME MACHINE FILE" lines appended to indexPath by vcycle-wsgi
+   # and vcycle-cgi when files are uploaded to joboutputs, returning
+   # { machineName : { fileName : time } } with the latest times. The
+   # index is created writable only by us and httpdGroup if it does not
+   # exist, and rewritten without superseded or old lines once they build up
+
+   try:
+     os.makedirs(os.path.dirname(indexPath), stat.S_IWUSR + stat.S_IXUSR + stat.S_IRUSR +
+                                             stat.S_IXGRP + stat.S_IRGRP + stat.S_IXOTH + stat.S_IROTH)
+   except:
+     pass
+
+   fd = os.open(indexPath, os.O_RDWR | os.O_CREAT, 0664)
+
+   try:
+     os.fchown(fd, -1, grp.getgrnam(httpdGroup).gr_gid)
+     os.fchmod(fd, 0664)
+   except Exception as e:
+     # httpd cannot record uploads, so heartbeat files are used instead
+     os.fchmod(fd, 0644)
+     logLine('Cannot give group ' + httpdGroup + ' write access to ' + indexPath + ' (' + str(e) + ')')
+
+   f = os.fdopen(fd, 'r+')
+
+   fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+   try:
+     index    = {}
+     numLines = 0
+
+     for line in f:
+       try:
+         (timeStr, machineName, fileName) = line.split()
+         heartbeatTime = int(timeStr)
+       except:
+         continue
+
+       numLines += 1
+
+       if heartbeatTime > index.setdefault(machineName, {}).get(fileName, 0):
+         index[machineName][fileName] = heartbeatTime
+
+     numEntries = sum([ len(files) for files in index.itervalues() ])
+
+     if numLines > 2 * numEntries + 1000:
+       minTime = int(time.time()) - maxAgeSeconds
+
+       for machineName in index.keys():
+         for fileName in index[machineName].keys():
+           if index[machineName][fileName] < minTime:
+             del index[machineName][fileName]
+
+         if not index[machineName]:
+           del index[machineName]
+
+       f.seek(0)
+       f.truncate()
+
+       for machineName in index:
+         for fileName in index[machineName]:
+           f.write('%d %s %s\n' % (index[machineName][fileName], machineName, fileName))
+
+       f.flush()
+
+   finally:
+     f.close()
+
+   return index
+
+def makeSyncRecord(dirPrefix, targetYearMonth, tmpDir, sites = None):
+   # Write APEL sync records for the month YYYYMM to apel-outgoing, one
+   # for each Site and SubmitHost, optionally only for the given sites.
+   # The job counts are kept up to date by writeApelRecords(), and are
+   # recounted if apel-archive/YYYYMM.counts does not exist
+
+   try:
+      targetMonth = int(targetYearMonth[4:6])
+      targetYear  = int(targetYearMonth[0:4])
+   except:
+      print 'Cannot parse as YYYYMM: ' + targetYearMonth
+      return 1
+
+   try:
+      counts = json.load(open(dirPrefix + '/apel-archive/' + targetYearMonth + '.counts', 'r'))
+   except:
+      counts = updateApelCounts(dirPrefix, targetYearMonth, counts = countApelRecords(dirPrefix, targetYearMonth), tmpDir = tmpDir)
+
+   syncRecord = ''
+
+   for site in sorted(counts):
+      if sites is not None and site not in sites:
         continue
 
-      numberJobs += 1
+      for submitHost in sorted(counts[site]):
+        syncRecord += 'Site: ' + site + '\n'                                  \
+                      'SubmitHost: ' + submitHost + '\n'                      \
+                      'NumberOfJobs: ' + str(counts[site][submitHost]) + '\n' \
+                      'Month: ' + str(targetMonth) + '\n'                     \
+                      'Year: ' + str(targetYear) + '\n'                       \
+                      '%%\n'
+
+   if not syncRecord:
+      print 'No jobs found for ' + targetYearMonth
+      return 0
 
-   syncRecord = 'APEL-sync-message: v0.1\n'               \
-                'Site: ' + site + '\n'                    \
-                'SubmitHost: ' + submitHost + '\n'        \
-                'NumberOfJobs: ' + str(numberJobs) + '\n' \
-                'Month: ' + str(targetMonth) + '\n'       \
-                'Year: ' + str(targetYear) + '\n'         \
-                '%%\n'
+   syncRecord = 'APEL-sync-message: v0.1\n' + syncRecord
 
    gmtime = time.gmtime()
 
@@ -756,6 +1994,219 @@ def makeSyncRecord(dirPrefix, targetYearMonth, tmpDir):
    return 2
 
 
+def apelRecordInfo(text):
+   # Get the index values of one APEL job record from its fields
+
+   info   = {}
+   fields = { 'Site'       : 'site',
+              'SubmitHost' : 'submit_host',
+              'Queue'      : 'machinetype',
+              'LocalJobId' : 'local_job_id',
+              'EndTime'    : 'end_time' }
+
+   for line in text.splitlines():
+     if ':' in line and line.split(':', 1)[0] in fields:
+       info[fields[line.split(':', 1)[0]]] = line.split(':', 1)[1].strip()
+
+   try:
+     info['end_time'] = int(info['end_time'])
+   except:
+     pass
+
+   return info
+
+def readApelDay(dirPrefix, day):
+   # Return [ (fileName, contents, [ entry, ... ]) ] for the message files of
+   # apel-archive/YYYYMMDD, with index entries for each record. Files with no
+   # entries in YYYYMMDD.index, from older versions, are single records
+
+   entries = {}
+
+   try:
+     for line in open(dirPrefix + '/apel-archive/' + day + '.index', 'r'):
+       try:
+         entry = json.loads(line)
+         entries.setdefault(str(entry['file']), []).append(entry)
+       except:
+         pass
+   except IOError:
+     pass
+
+   dayFiles = []
+
+   for fileName in sorted(os.listdir(dirPrefix + '/apel-archive/' + day)):
+     contents = open(dirPrefix + '/apel-archive/' + day + '/' + fileName, 'r').read()
+
+     if day + '/' + fileName in entries:
+       fileEntries = entries[day + '/' + fileName]
+     else:
+       if contents.startswith('APEL-individual-job-message:'):
+         offset = len(contents.split('\n', 1)[0]) + 1
+       else:
+         offset = 0
+
+       entry = apelRecordInfo(contents[offset:])
+       entry['file']   = day + '/' + fileName
+       entry['offset'] = offset
+       entry['length'] = len(contents) - offset
+       fileEntries = [ entry ]
+
+     dayFiles.append((fileName, contents, fileEntries))
+
+   return dayFiles
+
+def compactApelArchive(dirPrefix, tmpDir, beforeDay = None):
+   # Roll the day directories of apel-archive before beforeDay (default
+   # today) into compressed, append-only monthly bundles. Each message file
+   # becomes one gzip member of apel-archive/YYYYMM.bundle.gz, so the
+   # bundle can also be read with zcat, and each record gets a JSON line
+   # in apel-archive/YYYYMM.bundle.index giving the offset and length of
+   # its member and its place within the file. Returns the number of days
+
+   if beforeDay is None:
+     beforeDay = time.strftime('%Y%m%d')
+
+   lockFile = open(dirPrefix + '/apel-archive/compact.lock', 'a')
+   fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+
+   numDays = 0
+
+   try:
+     for day in sorted(os.listdir(dirPrefix + '/apel-archive')):
+       if len(day) != 8 or not day.isdigit() or day >= beforeDay or \
+          not os.path.isdir(dirPrefix + '/apel-archive/' + day):
+         continue
+
+       bundleName = dirPrefix + '/apel-archive/' + day[:6] + '.bundle'
+
+       # A day already in the bundle index was compacted by a run that
+       # stopped before removing the day directory
+       compactedDays = set()
+       try:
+         for line in open(bundleName + '.index', 'r'):
+           compactedDays.add(json.loads(line)['day'])
+       except:
+         pass
+
+       if day not in compactedDays:
+         indexLines = []
+         bundle     = open(bundleName + '.gz', 'ab')
+
+         try:
+           for (fileName, contents, fileEntries) in readApelDay(dirPrefix, day):
+             memberBuffer = StringIO.StringIO()
+             member = gzip.GzipFile(filename = fileName, mode = 'wb', fileobj = memberBuffer)
+             member.write(contents)
+             member.close()
+
+             bundleOffset = bundle.tell()
+             bundle.write(memberBuffer.getvalue())
+
+             for entry in fileEntries:
+               entry['day']           = day
+               entry['bundle_offset'] = bundleOffset
+               entry['bundle_length'] = len(memberBuffer.getvalue())
+               indexLines.append(json.dumps(entry) + '\n')
+
+           bundle.flush()
+           os.fsync(bundle.fileno())
+         finally:
+           bundle.close()
+
+         fd = os.open(bundleName + '.index', os.O_WRONLY | os.O_APPEND | os.O_CREAT, stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH)
+         try:
+           os.write(fd, ''.join(indexLines))
+           os.fsync(fd)
+         finally:
+           os.close(fd)
+
+         logLine('Compacted %d APEL records of %s into %s.gz' % (len(indexLines), day, bundleName))
+
+       # The day index goes first, as its records are now also in the bundle
+       # index and countApelRecords() would count them twice. If we stop
+       # before the day directory is removed, its files are still in the
+       # bundle index so they are not counted again from the files either
+       try:
+         os.remove(dirPrefix + '/apel-archive/' + day + '.index')
+       except OSError as e:
+         if e.errno != errno.ENOENT:
+           raise
+
+       shutil.rmtree(dirPrefix + '/apel-archive/' + day)
+
+       numDays += 1
+
+   finally:
+     lockFile.close()
+
+   return numDays
+
+def iterApelRecords(dirPrefix, fromDay = None, toDay = None, machinetype = None):
+   # Yield (entry, text) for each APEL job record archived on the days
+   # fromDay to toDay inclusive (YYYYMMDD), optionally only those of one
+   # machinetype, from both the monthly bundles and the day directories
+
+   def wanted(day, entry):
+     return (fromDay is None or day >= fromDay) and \
+            (toDay   is None or day <= toDay) and \
+            (machinetype is None or entry.get('machinetype') == machinetype)
+
+   for name in sorted(os.listdir(dirPrefix + '/apel-archive')):
+
+     if name.endswith('.bundle.index'):
+       month = name[:6]
+
+       if (fromDay is not None and month < fromDay[:6]) or \
+          (toDay   is not None and month > toDay[:6]):
+         continue
+
+       bundle = open(dirPrefix + '/apel-archive/' + month + '.bundle.gz', 'rb')
+       member = (None, None)
+
+       for line in open(dirPrefix + '/apel-archive/' + name, 'r'):
+         entry = json.loads(line)
+
+         if not wanted(str(entry['day']), entry):
+           continue
+
+         if member[0] != entry['bundle_offset']:
+           bundle.seek(entry['bundle_offset'])
+           member = (entry['bundle_offset'],
+                     gzip.GzipFile(fileobj = StringIO.StringIO(bundle.read(entry['bundle_length']))).read())
+
+         yield (entry, member[1][entry['offset']:entry['offset'] + entry['length']])
+
+       bundle.close()
+
+     elif len(name) == 8 and name.isdigit() and os.path.isdir(dirPrefix + '/apel-archive/' + name):
+       for (fileName, contents, fileEntries) in readApelDay(dirPrefix, name):
+         for entry in fileEntries:
+           if wanted(name, entry):
+             yield (entry, contents[entry['offset']:entry['offset'] + entry['length']])
+
+def reemitApelRecords(dirPrefix, tmpDir, fromDay = None, toDay = None, machinetype = None):
+   # Write archived records to apel-outgoing again for resubmission, as
+   # files with their original names. Without a machinetype, these are
+   # copies of the original files. Returns the number of records
+
+   files = {}
+
+   for (entry, text) in iterApelRecords(dirPrefix, fromDay, toDay, machinetype):
+     files.setdefault(str(entry['file']), []).append(text)
+
+   for (fileName, texts) in files.iteritems():
+     try:
+       os.makedirs(dirPrefix + '/apel-outgoing/' + os.path.dirname(fileName), stat.S_IRUSR|stat.S_IWUSR|stat.S_IXUSR|stat.S_IRGRP|stat.S_IXGRP|stat.S_IROTH|stat.S_IXOTH)
+     except:
+       pass
+
+     if not createFile(dirPrefix + '/apel-outgoing/' + fileName,
+                       'APEL-individual-job-message: v0.3\n' + ''.join(texts),
+                       stat.S_IRUSR|stat.S_IWUSR|stat.S_IRGRP|stat.S_IROTH, tmpDir):
+       raise VacutilsError('Failed creating ' + dirPrefix + '/apel-outgoing/' + fileName)
+
+   return sum([ len(texts) for texts in files.values() ])
+
 def makeSshFingerprint(pubFileLine):
    # Convert a line from an ssh id_rsa.pub (or id_dsa.pub) file to a fingerprint
 
@@ -816,6 +2267,40 @@ def memInfo():
    else:
      return None
 
+def pressureInfo():
+   # Get the some/full avg10/avg60 pressure stall information for cpu,
+   # memory and io from /proc/pressure, if the kernel provides it
+   result = {}
+
+   for resource in ['cpu', 'memory', 'io']:
+     try:
+       f = open('/proc/pressure/' + resource, 'r')
+     except:
+       continue
+
+     for line in f:
+       fields = line.split()
+
+       for field in fields[1:]:
+         (name, value) = field.split('=', 1)
+
+         if name in ('avg10', 'avg60'):
+           result[resource + '_' + fields[0] + '_' + name] = float(value)
+
+     f.close()
+
+   return result
+
+def cpuTimes():
+   # Get the total and iowait jiffies from the cpu line of /proc/stat
+
+   try:
+     fields = open('/proc/stat', 'r').readline().split()
+     return { 'total' : sum([ int(field) for field in fields[1:] ]), 'iowait' : int(fields[5]) }
+   except Exception as e:
+     print 'Failed to parse /proc/stat (' + str(e) + ')'
+     return None
+
 def updateSpaceInGOCDB(siteName, spaceName, serviceType, certPath, keyPath, caPath, versionString, spaceValues, machinetypesValues):
 
    id            = None